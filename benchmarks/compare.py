@@ -0,0 +1,29 @@
+"""
+Compares two result files of `suite.py`, benchmark by benchmark.
+
+    python3 benchmarks/compare.py <before.json> <after.json>
+"""
+import json, sys
+
+def load(path):
+    with open(path) as results_file:
+        report = json.load(results_file)
+    return report, {result["name"]: result["seconds"] for result in report["results"]}
+
+def main(args):
+    before_report, before = load(args[1])
+    after_report, after = load(args[2])
+    print("{:<28} {:>12} {:>12} {:>8}".format("", before_report.get("commit") or args[1],
+        after_report.get("commit") or args[2], "ratio"))
+    for name in before:
+        if name in after:
+            ratio = after[name] / before[name] if before[name] > 0 else float("inf")
+            print("{:<28} {:>10.4f} s {:>10.4f} s {:>7.2f}x".format(name, before[name], after[name], ratio))
+        else:
+            print("{:<28} {:>10.4f} s {:>12}".format(name, before[name], "-"))
+    for name in after:
+        if name not in before:
+            print("{:<28} {:>12} {:>10.4f} s".format(name, "-", after[name]))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,85 @@
+"""
+Benchmark of `GpsTrack.find_point_at_distance()`: the former binary search
+over one object per point against `trackindex.TrackIndex`.
+
+    python3 benchmarks/lookup.py [points] [queries]
+"""
+import math, os, sys, time, collections
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cyclingtracker"))
+import track
+from trackindex import TrackIndex
+
+LegacyPoint = collections.namedtuple("LegacyPoint", track.COLUMNS)
+
+def legacy_find_point_at_distance(gps_points, distance):
+    """
+    `GpsTrack.find_point_at_distance()` as it was with one ORM object per point
+    """
+    closeness = math.inf
+    last_closeness = None
+
+    index_bottom = 0
+    index_top = len(gps_points)
+
+    found_point = None
+
+    while index_top - index_bottom > 1:
+        index = round((index_bottom + index_top) / 2)
+        point = gps_points[index]
+        if last_closeness and last_closeness < closeness:
+            # the new point is not closer than the previous one
+            return found_point
+        if abs(point.cumulative_length - distance) < closeness:
+            last_closeness = closeness
+            closeness = abs(point.cumulative_length - distance)
+            found_point = point
+        if point.cumulative_length > distance: # need to lookup lower
+            index_top = index
+        elif point.cumulative_length < distance: # need to lookup higher
+            index_bottom = index
+
+    return found_point
+
+def random_track(count, seed=0):
+    random = numpy.random.default_rng(seed)
+    latitude = 45 + numpy.cumsum(random.normal(0, 0.00005, count))
+    longitude = 6 + numpy.cumsum(random.normal(0, 0.00007, count))
+    elevation = 500 + numpy.cumsum(random.normal(0, 0.5, count))
+    lengths = numpy.concatenate(([0], numpy.cumsum(track.segment_lengths(latitude, longitude, elevation))))
+    return track.TrackArrays(1.5e9 + numpy.arange(count), latitude, longitude, elevation, lengths)
+
+def run(count, queries):
+    arrays = random_track(count)
+    gps_points = list(arrays.iter_points())
+    distances = numpy.random.default_rng(1).uniform(0, arrays.cumulative_length[-1], queries).tolist()
+
+    start = time.perf_counter()
+    legacy_points = [legacy_find_point_at_distance(gps_points, distance) for distance in distances]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = TrackIndex(arrays)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    points = [index.point_at_distance(distance) for distance in distances]
+    index_seconds = time.perf_counter() - start
+
+    legacy_error = max(abs(point.cumulative_length - distance) for point, distance in zip(legacy_points, distances))
+    index_error = max(abs(point.cumulative_length - distance) for point, distance in zip(points, distances))
+    latitudes = numpy.random.default_rng(2).uniform(arrays.latitude.min(), arrays.latitude.max(), queries)
+    longitudes = numpy.random.default_rng(3).uniform(arrays.longitude.min(), arrays.longitude.max(), queries)
+    start = time.perf_counter()
+    for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist()):
+        index.nearest_index(latitude, longitude)
+    nearest_seconds = time.perf_counter() - start
+
+    print("{} points, {} queries".format(count, queries))
+    print("  legacy search   : {:8.2f} µs/query, max error {:.1f} m".format(legacy_seconds / queries * 1e6, legacy_error))
+    print("  index build     : {:8.2f} ms".format(build_seconds * 1e3))
+    print("  index distance  : {:8.2f} µs/query, max error {:.1f} m".format(index_seconds / queries * 1e6, index_error))
+    print("  index nearest   : {:8.2f} µs/query".format(nearest_seconds / queries * 1e6))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
@@ -0,0 +1,194 @@
+"""
+Headless benchmark suite: imports synthetic rides into a fresh database,
+then times listing, selection, lookups and elevation profile rendering.
+Results are written as JSON, see `compare.py` to compare two runs.
+
+    python3 benchmarks/suite.py [--points 1000,10000,100000] [--activities 50]
+        [--format gpx|fit] [--output results.json]
+"""
+import argparse, json, os, platform, subprocess, sys, tempfile, time
+import numpy
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIRECTORY, "..", "cyclingtracker"))
+import callback, repository, synthetic
+from elevationprofile import ElevationProfile
+
+# lookups per timed lookup benchmark
+LOOKUP_QUERIES = 10000
+PROFILE_SIZE = (800, 200)
+
+class _Handler(callback.ActivityImportedHandler, callback.ActivitiesLoadedHandler,
+        callback.TrackLoadedHandler, callback.BatchImportHandler):
+    """
+    (Private) keeps what the repository hands back
+    """
+
+    def on_activity_imported(self, activity=None, problem=None, report=None):
+        if problem:
+            raise RuntimeError(problem)
+        self.activity = activity
+
+    def on_activities_loaded(self, activities):
+        self.activities = activities
+
+    def on_track_loaded(self, activity, arrays, levels):
+        self.arrays = arrays
+        self.levels = levels
+
+    def on_batch_progress(self, progress, activity=None):
+        pass
+
+    def on_batch_imported(self, progress):
+        self.progress = progress
+
+def best_of(repeat, function):
+    """
+    Returns the shortest of `repeat` timings of `function()`, in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIRECTORY,
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+class Suite(object):
+
+    def __init__(self, options, directory):
+        self.options = options
+        self.directory = directory
+        self.results = []
+        self.handler = _Handler()
+
+    def record(self, name, seconds, **values):
+        result = dict(name=name, seconds=seconds, **values)
+        self.results.append(result)
+        print("{:<28} {:10.4f} s  {}".format(name, seconds,
+            " ".join("{}={}".format(key, value) for key, value in values.items())), file=sys.stderr)
+
+    def run(self):
+        os.chdir(self.directory)
+        os.makedirs("db", exist_ok=True)
+        self.repo = repository.Repository()
+        self.repo.init_database()
+        file_type = repository.FileType[self.options.format]
+
+        activities = dict()
+        for points in self.options.points:
+            path, = synthetic.write_activities(os.path.join(self.directory, "single", str(points)),
+                points, 1, self.options.format)
+            start = time.perf_counter()
+            self.repo.import_activity(callback.ImportActivityMethodArgs(path, file_type), self.handler)
+            seconds = time.perf_counter() - start
+            activities[points] = self.handler.activity
+            self.record("import[{}]".format(points), seconds, points=points,
+                points_per_second=round(points / seconds))
+
+        if self.options.activities:
+            batch_directory = os.path.join(self.directory, "batch")
+            synthetic.write_activities(batch_directory, self.options.activity_points,
+                self.options.activities, self.options.format)
+            start = time.perf_counter()
+            self.repo.import_directory(callback.ImportDirectoryMethodArgs(batch_directory, self.options.workers),
+                self.handler)
+            seconds = time.perf_counter() - start
+            self.record("import_directory", seconds, files=self.options.activities,
+                files_per_second=round(self.options.activities / seconds, 1))
+
+        seconds = best_of(self.options.repeat, lambda: self.repo.get_all_activities(None, self.handler))
+        self.record("list", seconds, activities=len(self.handler.activities))
+
+        for points, activity in activities.items():
+            self.run_track(points, activity)
+
+        self.repo.storage.stop()
+        return self.results
+
+    def run_track(self, points, activity):
+        """
+        Selection, lookups and profile of the activity of `points` points
+        """
+        def select():
+            self.repo.track_cache.invalidate(activity.gps_track.id)
+            self.repo.load_activity_track(activity, self.handler)
+        seconds = best_of(self.options.repeat, select)
+        self.record("select[{}]".format(points), seconds, points=points)
+        seconds = best_of(self.options.repeat, lambda: self.repo.load_activity_track(activity, self.handler))
+        self.record("select_cached[{}]".format(points), seconds, points=points)
+        gps_track = activity.gps_track
+        gps_track.arrays = self.handler.arrays
+        gps_track.levels = self.handler.levels
+
+        random = numpy.random.default_rng(0)
+        distances = random.uniform(0, activity.length, LOOKUP_QUERIES).tolist()
+        start = time.perf_counter()
+        gps_track.get_index()
+        self.record("index[{}]".format(points), time.perf_counter() - start, points=points)
+        seconds = best_of(self.options.repeat, lambda: [gps_track.find_point_at_distance(distance)
+            for distance in distances])
+        self.record("lookup_distance[{}]".format(points), seconds, queries=LOOKUP_QUERIES,
+            microseconds_per_query=round(seconds / LOOKUP_QUERIES * 1e6, 2))
+        latitudes = random.uniform(gps_track.latitude_min, gps_track.latitude_max, LOOKUP_QUERIES).tolist()
+        longitudes = random.uniform(gps_track.longitude_min, gps_track.longitude_max, LOOKUP_QUERIES).tolist()
+        seconds = best_of(self.options.repeat, lambda: [gps_track.find_nearest_point(latitude, longitude)
+            for latitude, longitude in zip(latitudes, longitudes)])
+        self.record("lookup_nearest[{}]".format(points), seconds, queries=LOOKUP_QUERIES,
+            microseconds_per_query=round(seconds / LOOKUP_QUERIES * 1e6, 2))
+
+        try:
+            import cairo
+        except ImportError:
+            print("profile[{}]: skipped, pycairo is not installed".format(points), file=sys.stderr)
+            return
+        width, height = PROFILE_SIZE
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        def draw():
+            profile = ElevationProfile(gps_track.arrays, activity.length, gps_track.elevation_min,
+                gps_track.elevation_max)
+            profile.draw(cairo.Context(surface), width, height)
+        seconds = best_of(self.options.repeat, draw)
+        self.record("profile[{}]".format(points), seconds, points=points, width=width, height=height)
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Times the repository and the rendering on synthetic rides")
+    parser.add_argument("--points", default="1000,10000,100000",
+        type=lambda value: [int(points) for points in value.split(",")],
+        help="comma separated sizes of the single activities (points)")
+    parser.add_argument("--activities", type=int, default=50, help="activities imported as a directory")
+    parser.add_argument("--activity-points", type=int, default=3600, help="points of each of those")
+    parser.add_argument("--format", choices=["gpx", "fit"], default="gpx")
+    parser.add_argument("--workers", type=int, default=None, help="import processes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each read benchmark, the best is kept")
+    parser.add_argument("--directory", default=None, help="working directory, temporary by default")
+    parser.add_argument("--output", default=None, help="JSON results file, standard output by default")
+    return parser.parse_args(args)
+
+def main(args):
+    options = parse_arguments(args)
+    output = os.path.abspath(options.output) if options.output else None
+    directory = options.directory or tempfile.mkdtemp(prefix="cyclingtracker-benchmarks-")
+    results = Suite(options, os.path.abspath(directory)).run()
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "format": options.format,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
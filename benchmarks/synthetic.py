@@ -0,0 +1,85 @@
+"""
+Synthetic rides for the benchmarks: a random but reproducible walk at
+cycling speed, one point per second, written as GPX or FIT files.
+
+    python3 benchmarks/synthetic.py <directory> [points] [activities] [gpx|fit]
+"""
+import datetime, math, os, struct, sys
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cyclingtracker"))
+import fit
+
+START_TIME = datetime.datetime(2016, 8, 9, 8, 40, tzinfo=datetime.timezone.utc).timestamp()
+# points written per call to `write()`
+WRITE_CHUNK_SIZE = 10000
+
+def random_ride(count, seed=0, start_time=START_TIME):
+    """
+    Returns `count` points as a `(count, 4)` array of time, latitude,
+    longitude and elevation: about 8 m/s, slowly turning, over rolling hills
+    """
+    random = numpy.random.default_rng(seed)
+    speed = numpy.clip(8 + numpy.cumsum(random.normal(0, 0.05, count)) % 6 - 3, 1, 15)
+    heading = numpy.cumsum(random.normal(0, 0.02, count)) + random.uniform(0, 2 * math.pi)
+    north = numpy.cumsum(speed * numpy.cos(heading))
+    east = numpy.cumsum(speed * numpy.sin(heading))
+    latitude = 45 + numpy.degrees(north / 6378137)
+    longitude = 6 + numpy.degrees(east / (6378137 * math.cos(math.radians(45))))
+    distance = numpy.cumsum(speed)
+    elevation = 500 + 200 * numpy.sin(distance / 7000) + 50 * numpy.sin(distance / 900) + random.normal(0, 1, count)
+    timestamp = start_time + numpy.arange(count, dtype=numpy.float64)
+    return numpy.column_stack((timestamp, latitude, longitude, elevation))
+
+def write_gpx(path, points):
+    with open(path, "w") as gpx_file:
+        gpx_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="benchmarks" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            '<trk><name>Synthetic</name><trkseg>\n')
+        for start in range(0, len(points), WRITE_CHUNK_SIZE):
+            gpx_file.write("".join(
+                '<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele><time>{}</time></trkpt>\n'.format(
+                    latitude, longitude, elevation,
+                    datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+                for timestamp, latitude, longitude, elevation in points[start:start + WRITE_CHUNK_SIZE].tolist()))
+        gpx_file.write("</trkseg></trk></gpx>\n")
+
+# record fields written by `write_fit()`: number, size, base type
+FIT_RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84)]
+FIT_RECORD_DTYPE = numpy.dtype([("header", "u1"), ("timestamp", "<u4"), ("latitude", "<i4"),
+    ("longitude", "<i4"), ("altitude", "<u2")])
+
+def write_fit(path, points):
+    """
+    Writes a FIT activity file holding one record message per point
+    """
+    definition = struct.pack("<BBBHB", 0x40, 0, 0, fit.RECORD_MESSAGE, len(FIT_RECORD_FIELDS)) +\
+        bytes(value for field in FIT_RECORD_FIELDS for value in field)
+    records = numpy.zeros(len(points), dtype=FIT_RECORD_DTYPE)
+    records["timestamp"] = points[:, 0] - fit.FIT_EPOCH
+    records["latitude"] = numpy.round(points[:, 1] / fit.SEMICIRCLE_TO_DEGREES)
+    records["longitude"] = numpy.round(points[:, 2] / fit.SEMICIRCLE_TO_DEGREES)
+    # altitude is stored with a scale of 5 and an offset of 500 m
+    records["altitude"] = numpy.round((points[:, 3] + 500) * 5)
+    body = definition + records.tobytes()
+    header = struct.pack("<BBHI4sH", 14, 0x10, 2100, len(body), b".FIT", 0)
+    with open(path, "wb") as fit_file:
+        fit_file.write(header + body + b"\0\0")
+
+def write_activities(directory, points, activities, file_type="gpx"):
+    """
+    Writes `activities` rides of `points` points each, one day apart.
+    Returns their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(activities):
+        path = os.path.join(directory, "ride-{:05d}.{}".format(index, file_type))
+        ride = random_ride(points, seed=index, start_time=START_TIME + index * 86400)
+        (write_fit if file_type == "fit" else write_gpx)(path, ride)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    write_activities(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 1, sys.argv[4] if len(sys.argv) > 4 else "gpx")
@@ -1,15 +1,44 @@
+import time
+
 class ActivitiesLoadedHandler:
     def on_activities_loaded(self, activities):
         raise NotImplementedError
 
 class ActivityImportedHandler:
-    def on_activity_imported(self, activity = None, problem = None):
+    def on_activity_imported(self, activity = None, problem = None, report = None):
         raise NotImplementedError
 
 class ActivityDeletedHandler:
     def on_activity_deleted(self, activity):
         raise NotImplementedError
 
+class TrackLoadedHandler:
+    def on_track_loaded(self, activity, arrays, levels):
+        raise NotImplementedError
+
+class BatchImportHandler:
+    def on_batch_progress(self, progress, activity = None):
+        raise NotImplementedError
+
+    def on_batch_imported(self, progress):
+        raise NotImplementedError
+
+class RollupsLoadedHandler:
+    def on_rollups_loaded(self, period, rollups):
+        raise NotImplementedError
+
+class SegmentEffortsLoadedHandler:
+    def on_segment_efforts_loaded(self, segment_id, efforts):
+        raise NotImplementedError
+
+class ExportHandler:
+    def on_exported(self, report):
+        raise NotImplementedError
+
+class HeatmapUpdatedHandler:
+    def on_heatmap_updated(self, tiles):
+        raise NotImplementedError
+
 class SlowMethodArgs:
     def __init__(self):
         return
@@ -18,3 +47,118 @@ class ImportActivityMethodArgs(SlowMethodArgs):
     def __init__(self, file_name, file_type):
         self.file_name = file_name
         self.file_type = file_type
+
+class ImportDirectoryMethodArgs(SlowMethodArgs):
+    def __init__(self, directory, workers = None):
+        self.directory = directory
+        self.workers = workers
+
+class AreaMethodArgs(SlowMethodArgs):
+    def __init__(self, bounds, refine = False):
+        self.bounds = bounds
+        self.refine = refine
+
+class RollupsMethodArgs(SlowMethodArgs):
+    def __init__(self, period, start = None, end = None):
+        self.period = period
+        self.start = start
+        self.end = end
+
+class SegmentMethodArgs(SlowMethodArgs):
+    def __init__(self, segment_id):
+        self.segment_id = segment_id
+
+class ExportMethodArgs(SlowMethodArgs):
+    def __init__(self, path, activities = None):
+        self.path = path
+        self.activities = activities
+
+class ImportReport:
+    """
+    Throughput of an activity import
+    """
+    def __init__(self, file_name, points, rows, seconds):
+        self.file_name = file_name
+        self.points = points
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else float("inf")
+
+    @property
+    def points_per_second(self):
+        return self.points / self.seconds if self.seconds > 0 else float("inf")
+
+    def __str__(self):
+        return "{} points ({} lignes) importés en {:.2f} s : {:.0f} points/s, {:.0f} lignes/s".format(
+            self.points, self.rows, self.seconds, self.points_per_second, self.rows_per_second)
+
+class ExportReport:
+    """
+    Throughput of an export. `bytes` counts the GPX written, before any
+    compression.
+    """
+    def __init__(self, path, activities, points, bytes, seconds):
+        self.path = path
+        self.activities = activities
+        self.points = points
+        self.bytes = bytes
+        self.seconds = seconds
+
+    @property
+    def points_per_second(self):
+        return self.points / self.seconds if self.seconds > 0 else float("inf")
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds > 0 else float("inf")
+
+    def __str__(self):
+        return "{} activités ({} points, {:.1f} Mo) exportées en {:.2f} s : {:.0f} points/s, {:.1f} Mo/s".format(
+            self.activities, self.points, self.bytes / 1e6, self.seconds, self.points_per_second,
+            self.bytes_per_second / 1e6)
+
+class BatchImportProgress:
+    """
+    Progress and throughput of a batch import. `failures` lists the
+    `(file_name, problem)` of the files that could not be imported.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.imported = 0
+        self.skipped = 0
+        self.failures = []
+        self.points = 0
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    @property
+    def done(self):
+        return self.imported + self.skipped + len(self.failures)
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def files_per_second(self):
+        return self.done / self.seconds if self.seconds > 0 else float("inf")
+
+    @property
+    def points_per_second(self):
+        return self.points / self.seconds if self.seconds > 0 else float("inf")
+
+    def add_imported(self, points, rows):
+        self.imported += 1
+        self.points += points
+        self.rows += rows
+
+    def add_failure(self, file_name, problem):
+        self.failures.append((file_name, problem))
+
+    def __str__(self):
+        return "{}/{} fichiers : {} importés, {} déjà présents, {} échecs ({:.1f} fichiers/s, {:.0f} points/s)".format(
+            self.done, self.total, self.imported, self.skipped, len(self.failures),
+            self.files_per_second, self.points_per_second)
@@ -0,0 +1,234 @@
+"""
+Command line interface, without GTK nor a display:
+
+    python3 cli.py list
+    python3 cli.py stats [--period week|month|year] [--last N]
+    python3 cli.py import <file>...
+    python3 cli.py import-dir <directory> [--workers N]
+    python3 cli.py delete <id>...
+    python3 cli.py export <archive or directory> [--id ID]...
+    python3 cli.py heatmap [--workers N]
+
+`list` and `stats` read the database with `sqlite3` alone; the other
+commands import `repository` (SQLAlchemy, numpy) when they run. Imports and
+deletions update the heatmap, once built (see `heatmap`).
+"""
+import argparse, datetime, os, sqlite3, sys
+import callback, rollups
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# as `repository.DATABASE_PATH`, which is not imported to start faster
+DATABASE_PATH = os.path.join("db", "tracker.db")
+
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    return "{}h{:02d}".format(seconds // 3600, seconds // 60 % 60)
+
+def format_activity(activity_id, start_timestamp, name, length, total_ascent, duration):
+    return "{:>6}  {}  {:>7.1f} km  {:>5} m  {:>6}  {}".format(activity_id,
+        datetime.datetime.fromtimestamp(start_timestamp or 0).strftime("%d/%m/%Y %H:%M"),
+        (length or 0) / 1000, total_ascent or 0, format_duration(duration), name or "")
+
+def open_repository():
+    import repository
+    repo = repository.Repository()
+    repo.init_database()
+    return repo
+
+def query(sql, parameters=()):
+    """
+    Runs a read-only query. A database that does not exist yet, or was
+    written by an older version, is first created or migrated by
+    `Repository.init_database()`.
+    """
+    for attempt in range(2):
+        try:
+            connection = sqlite3.connect("file:" + DATABASE_PATH + "?mode=ro", uri=True)
+            try:
+                return connection.execute(sql, parameters).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.OperationalError:
+            if attempt:
+                raise
+            open_repository().storage.stop()
+
+class ImportHandler(callback.ActivityImportedHandler, callback.BatchImportHandler):
+    """
+    Prints the progress of imports
+    """
+
+    def __init__(self):
+        self.failed = False
+        self.activities = []
+
+    def on_activity_imported(self, activity = None, problem = None, report = None):
+        if problem:
+            print(problem, file=sys.stderr)
+            self.failed = True
+        else:
+            self.activities.append(activity)
+            print(format_activity(activity.id, activity.start_timestamp, activity.name, activity.length,
+                activity.total_ascent, activity.duration))
+            print(report)
+
+    def on_batch_progress(self, progress, activity = None):
+        if activity is not None:
+            self.activities.append(activity)
+            print("{}/{}  {}".format(progress.imported + progress.skipped + len(progress.failures),
+                progress.total, activity.name))
+
+    def on_batch_imported(self, progress):
+        for file_name, problem in progress.failures:
+            print(file_name + " : " + problem, file=sys.stderr)
+        self.failed = bool(progress.failures)
+        print(progress)
+
+class HeatmapHandler(callback.HeatmapUpdatedHandler):
+    def on_heatmap_updated(self, tiles):
+        print("Carte de chaleur : {} tuiles mises à jour".format(tiles))
+
+class DeleteHandler(callback.ActivityDeletedHandler):
+    def on_activity_deleted(self, activity):
+        print("Supprimée : " + str(activity.id) + " " + activity.name)
+
+class ExportHandler(callback.ExportHandler):
+    def on_exported(self, report):
+        print(report)
+
+def list_activities(args):
+    for row in query("SELECT id, start_timestamp, name, length, total_ascent, duration FROM activities "
+            "ORDER BY start_timestamp, id"):
+        print(format_activity(*row))
+    return 0
+
+def print_stats(args):
+    count, length, duration, ascent = query(
+        "SELECT count(*), sum(length), sum(duration), sum(total_ascent) FROM activities")[0]
+    print("{} activités, {:.1f} km, {}, {} m".format(count, (length or 0) / 1000,
+        format_duration(duration), ascent or 0))
+    rows = query("SELECT period_start, activity_count, distance, duration, ascent FROM rollups "
+        "WHERE period = ? ORDER BY period_start DESC LIMIT ?", (args.period, args.last))
+    for period_start, activity_count, distance, period_duration, period_ascent in reversed(rows):
+        print("{:<22} {:>4}  {:>8.1f} km  {:>7}  {:>6.0f} m".format(rollups.period_label(args.period, period_start),
+            activity_count, distance / 1000, format_duration(period_duration), period_ascent))
+    return 0
+
+def import_files(args):
+    import importer, heatmap
+    repo = open_repository()
+    handler = ImportHandler()
+    try:
+        for file_name in args.files:
+            file_type = importer.file_type_of(file_name)
+            if file_type is None:
+                print(file_name + " : Opération non supportée", file=sys.stderr)
+                handler.failed = True
+                continue
+            repo.import_activity(callback.ImportActivityMethodArgs(file_name, file_type), handler)
+        heatmap.Heatmap(repo).add_activities(handler.activities, HeatmapHandler())
+    finally:
+        repo.storage.stop()
+    return 1 if handler.failed else 0
+
+def import_directory(args):
+    import heatmap
+    repo = open_repository()
+    handler = ImportHandler()
+    try:
+        repo.import_directory(callback.ImportDirectoryMethodArgs(args.directory, args.workers), handler)
+        heatmap.Heatmap(repo).add_activities(handler.activities, HeatmapHandler())
+    finally:
+        repo.storage.stop()
+    return 1 if handler.failed else 0
+
+def delete_activities(args):
+    import heatmap
+    repo = open_repository()
+    activity_heatmap = heatmap.Heatmap(repo)
+    status = 0
+    try:
+        for activity_id in args.ids:
+            activity = repo.get_activity(activity_id)
+            if activity is None:
+                print("Activité introuvable : " + str(activity_id), file=sys.stderr)
+                status = 1
+                continue
+            activity_heatmap.delete_activity(activity, DeleteHandler())
+    finally:
+        repo.storage.stop()
+    return status
+
+def export_activities(args):
+    import export
+    repo = open_repository()
+    try:
+        activities = None
+        if args.ids:
+            activities = [repo.get_activity(activity_id) for activity_id in args.ids]
+            if None in activities:
+                print("Activité introuvable", file=sys.stderr)
+                return 1
+        export.Exporter(repo).export(callback.ExportMethodArgs(args.path, activities), ExportHandler())
+    finally:
+        repo.storage.stop()
+    return 0
+
+def build_heatmap(args):
+    import heatmap
+    repo = open_repository()
+    try:
+        print(heatmap.Heatmap(repo).build(args.workers))
+    finally:
+        repo.storage.stop()
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tracker", description="Cycling Tracker sans interface graphique")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("list", help="liste les activités")
+    command.set_defaults(function=list_activities)
+
+    command = commands.add_parser("stats", help="totaux par période")
+    command.add_argument("--period", choices=rollups.PERIODS, default="month")
+    command.add_argument("--last", type=int, default=12, help="nombre de périodes")
+    command.set_defaults(function=print_stats)
+
+    command = commands.add_parser("import", help="importe des fichiers GPX ou FIT")
+    command.add_argument("files", nargs="+")
+    command.set_defaults(function=import_files)
+
+    command = commands.add_parser("import-dir", help="importe un dossier")
+    command.add_argument("directory")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(function=import_directory)
+
+    command = commands.add_parser("delete", help="supprime des activités")
+    command.add_argument("ids", nargs="+", type=int)
+    command.set_defaults(function=delete_activities)
+
+    command = commands.add_parser("export", help="exporte en GPX vers un dossier ou une archive")
+    command.add_argument("path")
+    command.add_argument("--id", dest="ids", type=int, action="append")
+    command.set_defaults(function=export_activities)
+
+    command = commands.add_parser("heatmap", help="construit la carte de chaleur")
+    command.add_argument("--workers", type=int, default=None)
+    command.set_defaults(function=build_heatmap)
+    return parser
+
+def main(args):
+    arguments = build_parser().parse_args(args[1:])
+    # paths are given from the current directory, the database is found
+    # from this one
+    for name in ("files", "directory", "path"):
+        if hasattr(arguments, name):
+            value = getattr(arguments, name)
+            setattr(arguments, name, [os.path.abspath(path) for path in value]
+                if isinstance(value, list) else os.path.abspath(value))
+    os.chdir(DIRECTORY)
+    return arguments.function(arguments)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
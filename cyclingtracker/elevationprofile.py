@@ -0,0 +1,119 @@
+"""
+Elevation profile of a track, colored by grade. The grade segmentation
+only depends on the track and is computed once; drawing only depends on
+the target size.
+"""
+import numpy
+
+# length (m) of the segments over which the grade is measured
+GRADE_SEGMENT_LENGTH = 100
+# grade difference above which a new colored chunk is started
+GRADE_CHANGE = 0.01
+MARGIN = 10
+
+def grade_color(grade):
+    """
+    Returns the `(r, g, b)` color of a grade, from white to red
+    """
+    x = 1 - 7 * grade
+    return (max(min(3 * x, 1), 0), max(min((x - 0.4) * 3, 1), 0), max(min((x - 0.8) * 5, 1), 0))
+
+def grade_chunks(cumulative_length, elevation):
+    """
+    Splits a track into chunks of similar grade. The track is walked in
+    segments of `GRADE_SEGMENT_LENGTH` meters; a chunk ends at the end of a
+    segment whose grade differs from the grade of the chunk so far.
+    Returns a list of `(start, stop, grade)`, `stop` being inclusive.
+    """
+    chunks = []
+    count = len(cumulative_length)
+    segment_start = 0
+    segment_distance = 0
+    chunk_start = 0
+    while True:
+        # first point more than a segment length away from the segment start
+        end = int(numpy.searchsorted(cumulative_length, segment_distance + GRADE_SEGMENT_LENGTH, side="right"))
+        if end >= count:
+            break
+        segment_length = cumulative_length[end] - segment_distance
+        segment_grade = (elevation[end] - elevation[segment_start]) / segment_length
+        chunk_length = cumulative_length[end] - cumulative_length[chunk_start]
+        chunk_grade = (elevation[end] - elevation[chunk_start]) / chunk_length
+        if abs(chunk_grade - segment_grade) > GRADE_CHANGE:
+            chunks.append((chunk_start, end, float(segment_grade)))
+            chunk_start = end
+        segment_distance = cumulative_length[end]
+        segment_start = end + 1
+    if chunk_start < count - 1:
+        # trailing points, shorter than a segment
+        length = cumulative_length[-1] - cumulative_length[chunk_start]
+        grade = (elevation[-1] - elevation[chunk_start]) / length if length > 0 else 0
+        chunks.append((chunk_start, count - 1, float(grade)))
+    return chunks
+
+class ElevationProfile(object):
+    """
+    Draws the elevation profile of `arrays` (`track.TrackArrays`) on a cairo
+    context, leaving a `MARGIN` around the plot
+    """
+
+    def __init__(self, arrays, length, elevation_min, elevation_max):
+        self.distances = arrays.cumulative_length
+        self.elevations = numpy.nan_to_num(arrays.elevation, nan=elevation_min)
+        self.length = length if length > 0 else 1
+        self.elevation_min = elevation_min
+        self.elevation_max = elevation_max if elevation_max > elevation_min else elevation_min + 1
+        self.chunks = grade_chunks(self.distances, self.elevations)
+        self.set_size(2 * MARGIN + 1, 2 * MARGIN + 1)
+
+    def set_size(self, width, height):
+        self.plot_width = max(width - 2 * MARGIN, 1)
+        self.plot_height = max(height - 2 * MARGIN, 1)
+        # all points projected on the plot once per size
+        self.xs = self.dist_to_x(self.distances)
+        self.ys = self.ele_to_y(self.elevations)
+
+    def ele_to_y(self, ele):
+        return self.plot_height * (self.elevation_max - ele) / (self.elevation_max - self.elevation_min) + MARGIN
+
+    def dist_to_x(self, dist):
+        return self.plot_width * (dist / self.length) + MARGIN
+
+    def y_to_ele(self, y):
+        return self.elevation_max - (y - MARGIN) / self.plot_height * (self.elevation_max - self.elevation_min)
+
+    def x_to_dist(self, x):
+        return (x - MARGIN) / self.plot_width * self.length
+
+    def draw(self, cr, width, height):
+        """
+        Draws the axes and the profile for a `width` x `height` area
+        """
+        if (width - 2 * MARGIN, height - 2 * MARGIN) != (self.plot_width, self.plot_height):
+            self.set_size(width, height)
+        baseline = self.plot_height + MARGIN
+
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1)
+        cr.move_to(MARGIN, MARGIN)
+        cr.line_to(MARGIN, baseline)
+        cr.line_to(width - MARGIN, baseline)
+        cr.stroke()
+
+        for start, stop, grade in self.chunks:
+            xs = self.xs[start:stop + 1].tolist()
+            ys = self.ys[start:stop + 1].tolist()
+
+            cr.set_source_rgb(*grade_color(grade))
+            cr.move_to(xs[0], baseline)
+            for x, y in zip(xs, ys):
+                cr.line_to(x, y)
+            cr.line_to(xs[-1], baseline)
+            cr.close_path()
+            cr.fill()
+
+            cr.set_source_rgb(0, 0, 0)
+            cr.move_to(xs[0], ys[0])
+            for x, y in zip(xs, ys):
+                cr.line_to(x, y)
+            cr.stroke()
@@ -0,0 +1,233 @@
+"""
+Streaming GPX export. The points of each track are read one chunk at a time
+(see `Repository.iter_track_chunks()`) and written as soon as formatted, so
+that memory does not depend on the size of the tracks nor of the archive.
+
+Many activities go to an archive, chosen by its extension (`ARCHIVE_TYPES`),
+written next to its final path and renamed once complete:
+
+    python3 export.py <archive or directory>
+"""
+import datetime, os, re, sys, tarfile, tempfile, time, zipfile
+import numpy
+from xml.sax.saxutils import escape
+import callback
+
+# tarfile mode by extension, None for zip
+ARCHIVE_TYPES = {
+    ".zip": None,
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tar.xz": "w:xz",
+}
+# bytes of a GPX kept in memory before spilling to a temporary file, for
+# tar archives which need the size of a member before its content
+SPOOL_SIZE = 8 * 1024 * 1024
+
+def archive_type(path):
+    """
+    Returns the extension of `path` in `ARCHIVE_TYPES`, or None
+    """
+    lower_path = path.lower()
+    for extension in sorted(ARCHIVE_TYPES, key=len, reverse=True):
+        if lower_path.endswith(extension):
+            return extension
+    return None
+
+def file_name(activity):
+    """
+    Name of the GPX of an activity, unique in an archive
+    """
+    name = re.sub(r"[^\w.-]+", "_", activity.name or "").strip("_")
+    return "{:06d}_{}.gpx".format(activity.id, name or "activite")
+
+def format_times(timestamps):
+    """
+    Formats POSIX timestamps as GPX (ISO 8601, UTC) times
+    """
+    unit = "s" if numpy.all(numpy.mod(timestamps, 1) == 0) else "ms"
+    milliseconds = numpy.round(timestamps * 1000).astype(numpy.int64)
+    return [text + "Z" for text in numpy.datetime_as_string(milliseconds.astype("datetime64[ms]"), unit=unit)]
+
+def format_points(arrays):
+    """
+    Returns the `<trkpt>` elements of a chunk of points as one string
+    """
+    times = format_times(arrays.timestamp)
+    elevations = ["<ele>{:.1f}</ele>".format(elevation) if elevation == elevation else ""
+        for elevation in arrays.elevation.tolist()]
+    return "".join('<trkpt lat="{:.7f}" lon="{:.7f}">{}<time>{}</time></trkpt>\n'.format(*point)
+        for point in zip(arrays.latitude.tolist(), arrays.longitude.tolist(), elevations, times))
+
+def iter_gpx(activity, chunks):
+    """
+    Yields the GPX document of `activity`, as encoded pieces: the header,
+    then the points of each of `chunks` (`track.TrackArrays`), then the end
+    """
+    start = datetime.datetime.fromtimestamp(activity.start_timestamp or 0, datetime.timezone.utc)
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="cyclingtracker" xmlns="http://www.topografix.com/GPX/1/1">\n'
+        '<metadata><name>{name}</name><time>{time}</time></metadata>\n'
+        '<trk><name>{name}</name><trkseg>\n').format(
+        name=escape(activity.name or ""), time=start.strftime("%Y-%m-%dT%H:%M:%SZ")).encode("utf-8")
+    for arrays in chunks:
+        if len(arrays):
+            yield format_points(arrays).encode("utf-8")
+    yield b"</trkseg></trk>\n</gpx>\n"
+
+class Exporter(object):
+    """
+    Exports activities of `repo` (a `repository.Repository`)
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def iter_activity_gpx(self, activity, counts):
+        """
+        `iter_gpx()` of an activity read from the database. Adds the points
+        and bytes to the dict `counts`.
+        """
+        chunks = self.repo.iter_track_chunks(activity.gps_track.id) if activity.gps_track else []
+        for piece in iter_gpx(activity, self._count_points(chunks, counts)):
+            counts["bytes"] += len(piece)
+            yield piece
+
+    def _count_points(self, chunks, counts):
+        """
+        (Private) passes `chunks` through, counting their points
+        """
+        for arrays in chunks:
+            counts["points"] += len(arrays)
+            yield arrays
+
+    def write_activity(self, activity, output, counts):
+        """
+        Writes the GPX of an activity to the binary file `output`
+        """
+        for piece in self.iter_activity_gpx(activity, counts):
+            output.write(piece)
+
+    def export_activity(self, activity, path):
+        """
+        Writes the GPX of an activity to `path`, returns a
+        `callback.ExportReport`
+        """
+        start = time.perf_counter()
+        counts = {"points": 0, "bytes": 0}
+        with _replaced_on_success(path) as temporary_path:
+            with open(temporary_path, "wb") as output:
+                self.write_activity(activity, output, counts)
+        return callback.ExportReport(path, 1, counts["points"], counts["bytes"], time.perf_counter() - start)
+
+    def export_directory(self, directory, activities=None):
+        """
+        Writes one GPX per activity in `directory`, every activity by
+        default. Returns a `callback.ExportReport`.
+        """
+        start = time.perf_counter()
+        counts = {"points": 0, "bytes": 0}
+        count = 0
+        os.makedirs(directory, exist_ok=True)
+        for activity in self._activities(activities):
+            with _replaced_on_success(os.path.join(directory, file_name(activity))) as temporary_path:
+                with open(temporary_path, "wb") as output:
+                    self.write_activity(activity, output, counts)
+            count += 1
+        return callback.ExportReport(directory, count, counts["points"], counts["bytes"],
+            time.perf_counter() - start)
+
+    def export_archive(self, path, activities=None):
+        """
+        Writes an archive of the GPX of `activities`, every activity by
+        default, its type given by the extension of `path`. Returns a
+        `callback.ExportReport`.
+        """
+        extension = archive_type(path)
+        if extension is None:
+            raise ValueError("unknown archive type: " + path)
+        start = time.perf_counter()
+        counts = {"points": 0, "bytes": 0}
+        count = 0
+        with _replaced_on_success(path) as temporary_path:
+            if ARCHIVE_TYPES[extension] is None:
+                with zipfile.ZipFile(temporary_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                    for activity in self._activities(activities):
+                        with archive.open(file_name(activity), "w", force_zip64=True) as output:
+                            self.write_activity(activity, output, counts)
+                        count += 1
+            else:
+                with tarfile.open(temporary_path, ARCHIVE_TYPES[extension]) as archive:
+                    for activity in self._activities(activities):
+                        self._add_to_tar(archive, activity, counts)
+                        count += 1
+        return callback.ExportReport(path, count, counts["points"], counts["bytes"], time.perf_counter() - start)
+
+    def _add_to_tar(self, archive, activity, counts):
+        """
+        (Private) adds the GPX of an activity to a tar archive, through a
+        temporary file spilling to disk past `SPOOL_SIZE`
+        """
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            self.write_activity(activity, spool, counts)
+            info = tarfile.TarInfo(file_name(activity))
+            info.size = spool.tell()
+            info.mtime = activity.start_timestamp or 0
+            spool.seek(0)
+            archive.addfile(info, spool)
+
+    def _activities(self, activities):
+        return self.repo.iter_activities() if activities is None else activities
+
+    def export(self, args: callback.ExportMethodArgs, handler: callback.ExportHandler):
+        """
+        Slow method exporting to an archive, or to a directory if `args.path`
+        is not an archive
+        """
+        if archive_type(args.path) is None:
+            report = self.export_directory(args.path, args.activities)
+        else:
+            report = self.export_archive(args.path, args.activities)
+        handler.on_exported(report)
+
+class _replaced_on_success(object):
+    """
+    (Private) context giving a temporary path next to `path`, renamed to
+    `path` on success and removed on failure
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = "{}.{}.tmp".format(path, os.getpid())
+
+    def __enter__(self):
+        return self.temporary_path
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            os.replace(self.temporary_path, self.path)
+        elif os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+        return False
+
+def main(args):
+    """
+    Exports every activity: `python3 export.py <archive or directory>`
+    """
+    import repository
+    repo = repository.Repository()
+    repo.init_database()
+    exporter = Exporter(repo)
+    try:
+        if archive_type(args[1]) is None:
+            report = exporter.export_directory(args[1])
+        else:
+            report = exporter.export_archive(args[1])
+    finally:
+        repo.storage.stop()
+    print(report)
+
+if __name__ == "__main__":
+    main(sys.argv)
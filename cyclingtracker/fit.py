@@ -0,0 +1,221 @@
+"""
+Garmin FIT reader. The file is scanned once through a `memoryview` to
+locate messages; `record` messages are then decoded in bulk, one numpy
+structured array per message definition, rather than field by field.
+"""
+import struct
+import numpy
+
+# seconds between the POSIX epoch and the FIT epoch (1989-12-31 00:00 UTC)
+FIT_EPOCH = 631065600
+SEMICIRCLE_TO_DEGREES = 180 / 2**31
+
+RECORD_MESSAGE = 20
+TIMESTAMP_FIELD = 253
+# record fields: name, number, size in bytes, numpy type, invalid value
+RECORD_FIELDS = [
+    ("timestamp", TIMESTAMP_FIELD, 4, "u4", 0xFFFFFFFF),
+    ("position_lat", 0, 4, "i4", 0x7FFFFFFF),
+    ("position_long", 1, 4, "i4", 0x7FFFFFFF),
+    ("altitude", 2, 2, "u2", 0xFFFF),
+    ("distance", 5, 4, "u4", 0xFFFFFFFF),
+    ("enhanced_altitude", 78, 4, "u4", 0xFFFFFFFF),
+]
+
+class FitError(Exception):
+    pass
+
+class _Definition(object):
+    """
+    (Private) layout of the data messages of one local message type
+    """
+    def __init__(self, global_number, big_endian, fields, size):
+        self.global_number = global_number
+        self.big_endian = big_endian
+        # field number -> (offset in message, size)
+        self.fields = fields
+        self.size = size
+        # offsets of this definition's data messages (after their header)
+        self.offsets = []
+        # indices in `offsets` of messages with a compressed timestamp header,
+        # and their resolved timestamps (FIT epoch)
+        self.compressed = []
+        # offset in message of a full timestamp (field 253), or None
+        self.timestamp_offset = None
+        if TIMESTAMP_FIELD in fields and fields[TIMESTAMP_FIELD][1] == 4:
+            self.timestamp_offset = fields[TIMESTAMP_FIELD][0]
+
+    def record_dtype(self):
+        """
+        Structured dtype decoding the known record fields of these messages
+        """
+        names, formats, offsets = [], [], []
+        byte_order = ">" if self.big_endian else "<"
+        for name, number, size, numpy_type, invalid in RECORD_FIELDS:
+            if number in self.fields and self.fields[number][1] == size:
+                names.append(name)
+                formats.append(byte_order + numpy_type)
+                offsets.append(self.fields[number][0])
+        return numpy.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": self.size})
+
+def _scan(data):
+    """
+    (Private) walks all the messages of `data` (a memoryview) and returns
+    the definitions of record messages, with their message offsets.
+
+    A compressed timestamp is a 5 bits offset from the last full timestamp
+    in file order, whatever the message type, so the position of the last
+    timestamp field is kept, and only decoded when such a header follows.
+    """
+    record_definitions = []
+    offset = 0
+    # last timestamp (FIT epoch), and the message of a newer one not decoded yet
+    last_timestamp = None
+    timestamp_definition = timestamp_message = None
+    while offset + 12 <= len(data):
+        header_size = data[offset]
+        if bytes(data[offset + 8:offset + 12]) != b".FIT":
+            raise FitError("En-tête FIT invalide")
+        data_size = struct.unpack_from("<I", data, offset + 4)[0]
+        end = offset + header_size + data_size
+        if end > len(data):
+            raise FitError("Fichier FIT tronqué")
+        offset += header_size
+        local_definitions = dict()
+
+        while offset < end:
+            header = data[offset]
+            if header & 0x80:
+                # compressed timestamp header, always a data message
+                local_type = (header >> 5) & 0x03
+                definition = local_definitions.get(local_type)
+                if definition is None:
+                    raise FitError("Message sans définition")
+                if timestamp_definition is not None:
+                    last_timestamp = _read_timestamp(data, timestamp_definition, timestamp_message, last_timestamp)
+                    timestamp_definition = None
+                if last_timestamp is not None:
+                    last_timestamp += ((header & 0x1F) - last_timestamp) & 0x1F
+                    if definition.global_number == RECORD_MESSAGE:
+                        definition.compressed.append((len(definition.offsets), last_timestamp))
+                if offset + 1 + definition.size > end:
+                    raise FitError("Fichier FIT tronqué")
+                if definition.global_number == RECORD_MESSAGE:
+                    definition.offsets.append(offset + 1)
+                offset += 1 + definition.size
+            elif header & 0x40:
+                big_endian = data[offset + 2] == 1
+                global_number = struct.unpack_from(">H" if big_endian else "<H", data, offset + 3)[0]
+                field_count = data[offset + 5]
+                fields = dict()
+                size = 0
+                position = offset + 6
+                for index in range(field_count):
+                    fields[data[position]] = (size, data[position + 1])
+                    size += data[position + 1]
+                    position += 3
+                if header & 0x20:
+                    # developer fields are skipped, only their size matters
+                    developer_field_count = data[position]
+                    position += 1
+                    for index in range(developer_field_count):
+                        size += data[position + 1]
+                        position += 3
+                if position > end:
+                    raise FitError("Fichier FIT tronqué")
+                definition = _Definition(global_number, big_endian, fields, size)
+                local_definitions[header & 0x0F] = definition
+                if global_number == RECORD_MESSAGE:
+                    record_definitions.append(definition)
+                offset = position
+            else:
+                definition = local_definitions.get(header & 0x0F)
+                if definition is None:
+                    raise FitError("Message sans définition")
+                if offset + 1 + definition.size > end:
+                    raise FitError("Fichier FIT tronqué")
+                if definition.global_number == RECORD_MESSAGE:
+                    definition.offsets.append(offset + 1)
+                if definition.timestamp_offset is not None:
+                    timestamp_definition = definition
+                    timestamp_message = offset
+                offset += 1 + definition.size
+        # file CRC
+        offset = end + 2
+    return record_definitions
+
+def _read_timestamp(data, definition, offset, default):
+    """
+    (Private) decodes the timestamp field of the message at `offset` (its
+    header), or returns `default` if it is invalid
+    """
+    timestamp = struct.unpack_from(">I" if definition.big_endian else "<I", data,
+        offset + 1 + definition.timestamp_offset)[0]
+    return default if timestamp == 0xFFFFFFFF else timestamp
+
+def _field(records, name, invalid):
+    """
+    (Private) returns a record field as float64, with NaN for invalid values
+    """
+    if name not in records.dtype.names:
+        return numpy.full(len(records), numpy.nan)
+    values = records[name]
+    return numpy.where(values == invalid, numpy.nan, values.astype(numpy.float64))
+
+def read_records(fit_file):
+    """
+    Decodes all record messages of `fit_file` (a binary file object).
+    Returns a dict of float64 arrays in file order: `time` (POSIX
+    timestamp), `latitude`, `longitude` (degrees), `elevation` and
+    `distance` (m), NaN where the device gave no value.
+    """
+    data = memoryview(fit_file.read())
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    invalid = {name: invalid for name, number, size, numpy_type, invalid in RECORD_FIELDS}
+
+    try:
+        record_definitions = _scan(data)
+    except (IndexError, struct.error):
+        raise FitError("Fichier FIT tronqué")
+
+    parts = []
+    for definition in record_definitions:
+        if not definition.offsets:
+            continue
+        offsets = numpy.array(definition.offsets, dtype=numpy.int64)
+        # gathers all messages of this definition into one contiguous block
+        block = raw[offsets[:, None] + numpy.arange(definition.size)]
+        records = block.view(definition.record_dtype()).reshape(len(offsets))
+
+        timestamp = _field(records, "timestamp", invalid["timestamp"])
+        for index, compressed_timestamp in definition.compressed:
+            timestamp[index] = compressed_timestamp
+        elevation = _field(records, "enhanced_altitude", invalid["enhanced_altitude"])
+        altitude = _field(records, "altitude", invalid["altitude"])
+        elevation = numpy.where(numpy.isnan(elevation), altitude, elevation) / 5 - 500
+        parts.append((offsets,
+            timestamp + FIT_EPOCH,
+            _field(records, "position_lat", invalid["position_lat"]) * SEMICIRCLE_TO_DEGREES,
+            _field(records, "position_long", invalid["position_long"]) * SEMICIRCLE_TO_DEGREES,
+            elevation,
+            _field(records, "distance", invalid["distance"]) / 100))
+
+    if not parts:
+        columns = [numpy.empty(0)] * 6
+    else:
+        columns = [numpy.concatenate(column) for column in zip(*parts)]
+        order = numpy.argsort(columns[0], kind="stable")
+        columns = [column[order] for column in columns]
+    return dict(zip(("offset", "time", "latitude", "longitude", "elevation", "distance"), columns))
+
+def iter_chunks(fit_file, chunk_size):
+    """
+    Yields the positioned records of `fit_file` as arrays of at most
+    `chunk_size` `(time, latitude, longitude, elevation)` rows, i.e. the
+    same points as `gpxstream.iter_chunks()`
+    """
+    records = read_records(fit_file)
+    points = numpy.column_stack((records["time"], records["latitude"], records["longitude"], records["elevation"]))
+    points = points[~numpy.isnan(points[:, :3]).any(axis=1)]
+    for start in range(0, len(points), chunk_size):
+        yield points[start:start + chunk_size]
@@ -0,0 +1,75 @@
+"""
+Streaming GPX reader. The document is parsed incrementally and every
+point is discarded from the element tree once read, so memory does not
+depend on the size of the file.
+"""
+import datetime, math
+import xml.etree.ElementTree as ElementTree
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def parse_time(text):
+    """
+    Parses a GPX (ISO 8601) time into a POSIX timestamp. Times without
+    timezone are UTC, as mandated by the GPX schema.
+    """
+    text = text.strip()
+    if text.endswith("Z") or text.endswith("z"):
+        text = text[:-1] + "+00:00"
+    time = datetime.datetime.fromisoformat(text)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time.timestamp()
+
+def iter_points(gpx_file):
+    """
+    Yields the `(time, latitude, longitude, elevation)` of every track point
+    of `gpx_file` (a file name or a binary file object), track by track and
+    segment by segment. Missing elevations are NaN.
+    """
+    segment = None
+    in_point = False
+    time = None
+    elevation = math.nan
+
+    for event, element in ElementTree.iterparse(gpx_file, events=("start", "end")):
+        name = _local_name(element.tag)
+        if event == "start":
+            if name == "trkseg":
+                segment = element
+            elif name == "trkpt" and segment is not None:
+                in_point = True
+                time = None
+                elevation = math.nan
+            continue
+
+        if not in_point:
+            if name == "trkseg":
+                segment.clear()
+                segment = None
+            continue
+        if name == "ele" and element.text:
+            elevation = float(element.text)
+        elif name == "time" and element.text:
+            time = parse_time(element.text)
+        elif name == "trkpt":
+            in_point = False
+            if time is not None:
+                yield (time, float(element.get("lat")), float(element.get("lon")), elevation)
+            # drop points already read
+            segment.clear()
+
+def iter_chunks(gpx_file, chunk_size):
+    """
+    Groups the points yielded by `iter_points()` into lists of at most
+    `chunk_size` points
+    """
+    chunk = []
+    for point in iter_points(gpx_file):
+        chunk.append(point)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -1,4 +1,4 @@
-import gi, callback, math
+import gi, callback, math, cairo, bisect, scheduler, instrumentation, time, tilecache, rollups, difflib, heatmap
 from gi.repository import GObject, Gtk, Gio, GLib, Gdk
 gi.require_version('GtkChamplain', '0.12')
 from gi.repository import GtkChamplain
@@ -7,6 +7,8 @@ from gi.repository import Champlain
 gi.require_version('OsmGpsMap', '1.0')
 from gi.repository import OsmGpsMap
 from repository import Repository, FileType
+from importer import file_type_of
+from elevationprofile import ElevationProfile
 
 class GladeHandler(object):
     """
@@ -14,8 +16,13 @@ class GladeHandler(object):
     Subclasses will contain signal handling and UI manipulation.
     Slow operations should be run through `execute_slow_method()`
     UI shall only be manipulated within a call to `run_update_ui()`.
+    Slow operations share the threads of `scheduler.get_default()`.
+    Glade files are read once, see `get_template()`.
     """
 
+    # contents of the glade files read so far, by file name
+    templates = dict()
+
     def __init__(self, repository, glade_file_name, object_name):
         """
         """
@@ -29,10 +36,22 @@ class GladeHandler(object):
         and connects its signals it to `self`
         """
         self.builder = Gtk.Builder()
-        self.builder.add_from_file("glade/" + self.glade_file_name)
+        self.builder.add_from_string(self.get_template(self.glade_file_name))
         self.builder.connect_signals(self)
         return self.get_object()
 
+    @staticmethod
+    def get_template(glade_file_name):
+        """
+        Returns the content of a glade file, read on first use only
+        """
+        template = GladeHandler.templates.get(glade_file_name)
+        if template is None:
+            with open("glade/" + glade_file_name, encoding="utf-8") as glade_file:
+                template = glade_file.read()
+            GladeHandler.templates[glade_file_name] = template
+        return template
+
     def get_object(self):
         """
         Returns the object relevant to `self` (i.e. top-level container)
@@ -45,36 +64,44 @@ class GladeHandler(object):
         """
         return self.builder.get_object(object_name)
     
-    def execute_slow_method(self, method, args = None, callback_handler = None):
+    def execute_slow_method(self, method, args = None, callback_handler = None,
+            priority = scheduler.Priority.INTERACTIVE, group = None):
         """
-        Executes `method` as a GTK-friendly background task.
+        Executes `method` as a GTK-friendly background task, with signature
+        `method(args, callback)` i.e. in `Repository`.
         Arguments are passed to the method through `args`.
         Backgound method can be given a `callback` that can be called
-        upon completion
+        upon completion. A call supersedes the calls of the same `group`,
+        whose callbacks are then ignored. Returns the `scheduler.Job`.
         """
-        Gio.io_scheduler_push_job(self._dispatch_method,
-            [method, args, callback_handler], GLib.PRIORITY_DEFAULT, None)
-    
-    def _dispatch_method(self, job, cancellable, method_data):
-        """
-        (Private) dispatches args and callback to the correct method, to match
-        signature as `method(args, callback)` i.e. in `Repository`
-        """
-        to_call = method_data[0]
-        args = method_data[1]
-        callback_handler = method_data[2]
-        to_call(args, callback_handler)
+        return scheduler.get_default().submit(method, args, callback_handler, priority, group)
 
     def run_update_ui(self, method, args = None):
         """
         Ececutes a UI-modifying method in a GTK-friendly manner
         """
-        if args:
+        if instrumentation.ENABLED:
+            method = self._traced_ui_method(method)
+        if args is not None:
             GLib.idle_add(method, args)
         else:
             GLib.idle_add(method)
 
-class ApplicationHeaderHandler(GladeHandler, callback.ActivityImportedHandler):
+    def _traced_ui_method(self, method):
+        """
+        (Private) wraps a UI method to record how long it waited for the
+        main loop and how long it ran
+        """
+        name = "ui." + method.__name__
+        queued_at = time.perf_counter()
+        def traced(*args):
+            instrumentation.record(name + ".wait", queued_at, time.perf_counter())
+            with instrumentation.span(name):
+                return method(*args)
+        return traced
+
+class ApplicationHeaderHandler(GladeHandler, callback.ActivityImportedHandler, callback.BatchImportHandler,
+    callback.HeatmapUpdatedHandler):
     """
     Handler class for the Header Bar
     """
@@ -82,6 +109,8 @@ class ApplicationHeaderHandler(GladeHandler, callback.ActivityImportedHandler):
     def __init__(self, repository, main_window_handler):
         super().__init__(repository, "applicationHeaderBar.glade", "ApplicationHeaderBar")
         self.window_handler = main_window_handler
+        # activities of the running batch import, added to the heatmap at its end
+        self.batch_activities = []
 
     def on_import_click(self, *args):
         dialog = Gtk.FileChooserDialog("Choisir une activité à importer", self.window_handler.get_object(),
@@ -111,20 +140,96 @@ class ApplicationHeaderHandler(GladeHandler, callback.ActivityImportedHandler):
                 file_type = FileType.fit
             elif filter == filter_gpx:
                 file_type = FileType.gpx
+            else:
+                file_type = file_type_of(file_name)
             self.import_activity(file_name, file_type)
 
         dialog.destroy()
 
+    def on_import_directory_click(self, *args):
+        dialog = Gtk.FileChooserDialog("Choisir un dossier d'activités à importer", self.window_handler.get_object(),
+            Gtk.FileChooserAction.SELECT_FOLDER,
+            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+             Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+
+        dialog.set_default_size(0, 0)
+
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            self.import_directory(dialog.get_filename())
+
+        dialog.destroy()
+
+    def import_directory(self, directory):
+        args = callback.ImportDirectoryMethodArgs(directory)
+        self.run_update_ui(self.window_handler.activities_tab_handler.add_spinner)
+        self.execute_slow_method(self.repository.import_directory, args, self, scheduler.Priority.BULK)
+
+    def on_batch_progress(self, progress, activity=None):
+        self.run_update_ui(self.show_import_report, str(progress))
+        if activity is not None:
+            # no tile prefetch: thousands of activities would scrape the tile server
+            self.batch_activities.append(activity)
+
+    def on_batch_imported(self, progress):
+        self.run_update_ui(self.show_import_report, str(progress))
+        # a single reload rather than one list update per imported activity
+        self.window_handler.activities_tab_handler.fetch_activities()
+        activities, self.batch_activities = self.batch_activities, []
+        self.execute_slow_method(heatmap.get_default(self.repository).add_activities, activities, self,
+            scheduler.Priority.BULK)
+        if progress.failures:
+            problems = "\n".join(file_name + " : " + problem for file_name, problem in progress.failures[:20])
+            self.run_update_ui(self.show_error_dialog, problems)
+
     def import_activity(self, filename, filetype):
         args = callback.ImportActivityMethodArgs(filename, filetype)
         self.run_update_ui(self.window_handler.activities_tab_handler.add_spinner)
-        self.execute_slow_method(self.repository.import_activity, args, self)
+        self.execute_slow_method(self.repository.import_activity, args, self, scheduler.Priority.BULK)
     
-    def on_activity_imported(self, activity=None, problem=None):
+    def on_activity_imported(self, activity=None, problem=None, report=None):
         if problem:
             self.run_update_ui(self.show_error_dialog, problem)
         else:
             self.window_handler.activities_tab_handler.add_activity(activity)
+            self.prefetch_tiles(activity)
+            self.execute_slow_method(heatmap.get_default(self.repository).add_activity, activity, self,
+                scheduler.Priority.BULK)
+            if report:
+                self.run_update_ui(self.show_import_report, str(report))
+
+    def prefetch_tiles(self, activity):
+        """
+        Fetches the map tiles of an activity imported on its own in the
+        background, so that it opens without waiting for the network
+        """
+        self.execute_slow_method(tilecache.get_default().prefetch_activity, activity, None,
+            scheduler.Priority.BULK)
+
+    def on_heatmap_toggled(self, button):
+        """
+        Shows or hides the heatmap over the map, building it first if needed
+        """
+        ActivityDetailsHandler.heatmap_visible = button.get_active()
+        activity_heatmap = heatmap.get_default(self.repository)
+        if button.get_active() and not activity_heatmap.is_built():
+            self.show_import_report("Construction de la carte de chaleur…")
+            self.execute_slow_method(activity_heatmap.build_heatmap, None, self, scheduler.Priority.BULK,
+                group="heatmap")
+        else:
+            self.window_handler.activities_tab_handler.show_heatmap(button.get_active())
+
+    def on_heatmap_updated(self, tiles):
+        self.run_update_ui(self.refresh_heatmap, tiles)
+
+    def refresh_heatmap(self, tiles):
+        self.show_import_report("Carte de chaleur : {} tuiles mises à jour".format(tiles))
+        activities_tab_handler = self.window_handler.activities_tab_handler
+        activities_tab_handler.show_heatmap(ActivityDetailsHandler.heatmap_visible)
+        activities_tab_handler.refresh_heatmap()
+
+    def show_import_report(self, report):
+        self.get_object().set_subtitle(report)
     
     def show_error_dialog(self, problem):
         self.window_handler.activities_tab_handler.hide_spinner()
@@ -144,6 +249,7 @@ class MainWindowHandler(GladeHandler):
     def __init__(self, repository):
         super().__init__(repository, "mainWindow.glade", "MainApplicationWindow")
         self.activities_tab_handler = None
+        self.training_tab_handler = None
 
     def on_destroy(self, *args):
         """
@@ -156,71 +262,238 @@ class MainWindowHandler(GladeHandler):
         self.activities_tab_handler.build_view()
         activities_paned = self.activities_tab_handler.get_object()
         self.get_object_by_name("ActivitiesTabBox").add(activities_paned)
+        self.training_tab_handler = TrainingTabHandler(self.repository)
+        self.training_tab_handler.build_view()
+        self.get_object_by_name("TrainingTabBox").pack_start(self.training_tab_handler.get_object(), True, True, 0)
 
-class ActivitiesTabHandler(GladeHandler, callback.ActivitiesLoadedHandler, callback.ActivityDeletedHandler):
+class TrainingTabHandler(GladeHandler, callback.RollupsLoadedHandler):
+    """
+    Handler of the training tab: distance, duration and ascent per week,
+    month or year, read from the rollups whenever the tab is shown
+    """
+
+    def __init__(self, repository):
+        super().__init__(repository, "trainingBox.glade", "TrainingBox")
+
+    def on_map(self, *args):
+        self.fetch_rollups()
+
+    def on_period_changed(self, *args):
+        self.fetch_rollups()
+
+    def fetch_rollups(self):
+        period = self.get_object_by_name("PeriodComboBox").get_active_id() or "week"
+        self.execute_slow_method(self.repository.load_rollups, callback.RollupsMethodArgs(period), self,
+            group="rollups")
+
+    def on_rollups_loaded(self, period, rollups):
+        self.run_update_ui(self.update_rollups_view, (period, rollups))
+
+    def update_rollups_view(self, loaded_rollups):
+        period, period_rollups = loaded_rollups
+        list_store = self.get_object_by_name("RollupsListStore")
+        list_store.clear()
+        for rollup in period_rollups:
+            list_store.append([rollups.period_label(period, rollup.period_start), rollup.activity_count,
+                str(round(rollup.distance / 1000, 1)) + " km",
+                str(math.floor(rollup.duration / 3600)) + "h " + str(math.floor(rollup.duration / 60) % 60) + "m",
+                str(round(rollup.ascent)) + " m"])
+
+class ActivityItem(GObject.Object):
+    """
+    Item of the activities list model: wraps an activity summary, or stands
+    for the spinner row when `activity` is None
+    """
+    def __init__(self, activity=None):
+        super().__init__()
+        self.activity = activity
+        # `ActivityListItemHandler` of the row, once created
+        self.row_handler = None
+
+def activity_sort_key(activity):
+    """
+    Activities are listed from the most recent one
+    """
+    return (-(activity.start_timestamp or 0), -activity.id)
+
+class ActivitiesTabHandler(GladeHandler, callback.ActivitiesLoadedHandler, callback.ActivityDeletedHandler,
+    callback.TrackLoadedHandler):
     """
     Handler class for the 'Activities' tab (`ActivitiesPaned` in Glade).
     Has a spinner whislt no data is loaded.
-    Loads activities from database on realize and then feeds the list with
-    activities (filtering out the spinner row).
-    Displays selected activity in the right pane.
+    Loads activity summaries from database on realize and then feeds the list
+    with activities.
+    The list is bound to a `Gio.ListStore`: adding or deleting an activity
+    inserts or removes a single row. Rows are only created for the activities
+    loaded in the model, one page at a time as the list is scrolled down.
+    Reloading the activities keeps the rows of those still listed.
+    Displays selected activity in the right pane, once its track is loaded.
+    Only the displayed activity holds its points; selecting another one again
+    finds its track in `Repository.track_cache` unless evicted.
     """
+
+    # number of rows added to the list each time its bottom is reached
+    PAGE_SIZE = 100
+
     def __init__(self, repository):
         super().__init__(repository, "activitiesPaned.glade", "ActivitiesPaned")
         self.activity_rows_to_lih = dict()
+        # all activities, sorted by `activity_sort_key()`, and their keys
         self.activities = []
+        self.activity_keys = []
+        # number of activities (first ones of `activities`) in `list_store`
+        self.loaded_count = 0
+        self.list_store = Gio.ListStore(item_type=ActivityItem)
+        self.spinner_item = ActivityItem()
+        self.spinner_shown = False
         self.displayed_activity = None
+        self.requested_track_activity = None
         self.activity_details_handler = None
 
-    def hide_spinner(self):
+    def build_view(self):
+        res = super().build_view()
         list_box = self.get_object_by_name("ActivitiesListBox")
-        list_box.set_filter_func(self.filter_func, False)
+        list_box.bind_model(self.list_store, self.create_row)
+        return res
+
+    def create_row(self, item):
+        """
+        Builds the row of a model item, called by the list box as items are
+        added to the model
+        """
+        if item.activity is None:
+            sih = ActivitySpinnerItemHandler(self.repository)
+            return sih.build_view()
+        lih = ActivityListItemHandler(self.repository, item.activity)
+        list_box_row = lih.build_view()
+        item.row_handler = lih
+        self.activity_rows_to_lih[list_box_row] = lih
+        list_box_row.connect("destroy", self.on_row_destroyed)
+        if self.displayed_activity and self.displayed_activity.id == item.activity.id:
+            GLib.idle_add(self.get_object_by_name("ActivitiesListBox").select_row, list_box_row)
+        return list_box_row
+
+    def on_row_destroyed(self, list_box_row):
+        self.activity_rows_to_lih.pop(list_box_row, None)
+
+    def hide_spinner(self):
+        if self.spinner_shown:
+            self.spinner_shown = False
+            self.list_store.remove(0)
 
     def add_spinner(self):
-        list_box = self.get_object_by_name("ActivitiesListBox")
-        list_box.set_filter_func(lambda row: True)
-        sih = ActivitySpinnerItemHandler(self.repository)
-        sih.build_view()
-        spinner_row = sih.get_object()
-        list_box.add(spinner_row)
-    
-    def filter_func(self, row, show_spinner):
-        if show_spinner and row not in self.activity_rows_to_lih:
-            return True
-        if row in self.activity_rows_to_lih and not show_spinner:
-            return True
-        else:
-            return False
+        if not self.spinner_shown:
+            self.spinner_shown = True
+            self.list_store.insert(0, self.spinner_item)
+
+    def _store_position(self, index):
+        """
+        (Private) position in `list_store` of `activities[index]`
+        """
+        return index + (1 if self.spinner_shown else 0)
 
     def on_realize(self, *args):
         self.add_spinner()
         self.fetch_activities()
     
     def on_activities_loaded(self, activities):
-        self.activities = activities
-        self.run_update_ui(self.update_list_view)
+        self.run_update_ui(self.update_list_view, activities)
+
+    def on_list_edge_reached(self, scrolled_window, position):
+        if position == Gtk.PositionType.BOTTOM:
+            self.load_next_page()
+
+    def load_next_page(self):
+        """
+        Adds the next `PAGE_SIZE` activities to the model, in a single splice
+        """
+        page = self.activities[self.loaded_count:self.loaded_count + self.PAGE_SIZE]
+        if page:
+            self.list_store.splice(self._store_position(self.loaded_count), 0,
+                [ActivityItem(activity) for activity in page])
+            self.loaded_count += len(page)
     
     def on_row_selected(self, list_box, list_box_row):
-        if list_box_row:
+        if list_box_row and list_box_row in self.activity_rows_to_lih:
             lih = self.activity_rows_to_lih[list_box_row]
+            if self.displayed_activity and self.displayed_activity is not lih.activity_data:
+                # only the displayed activity keeps its points in memory
+                self.displayed_activity.gps_track.arrays = None
+                self.displayed_activity.gps_track.levels = None
             self.displayed_activity = lih.activity_data
+        if self.displayed_activity and self.displayed_activity.gps_track.arrays is None:
+            self.fetch_track(self.displayed_activity)
+        self.update_activity_view()
+
+    def fetch_track(self, activity):
+        if self.requested_track_activity is activity:
+            return
+        self.requested_track_activity = activity
+        # loading another track supersedes this one
+        self.execute_slow_method(self.repository.load_activity_track, activity, self, group="track")
+
+    def on_track_loaded(self, activity, arrays, levels):
+        self.run_update_ui(self.display_track, (activity, arrays, levels))
+
+    def display_track(self, loaded_track):
+        activity, arrays, levels = loaded_track
+        if self.requested_track_activity is activity:
+            self.requested_track_activity = None
+        if activity is not self.displayed_activity:
+            # selection changed whilst loading
+            return
+        activity.gps_track.arrays = arrays
+        activity.gps_track.levels = levels
         self.update_activity_view()
 
     def on_delete_clicked(self, *args):
-        self.execute_slow_method(self.repository.delete_activity, self.displayed_activity, self)
+        # removed from the heatmap whilst its track can still be read
+        self.execute_slow_method(heatmap.get_default(self.repository).delete_activity, self.displayed_activity, self)
 
     def on_activity_deleted(self, activity):
-        self.displayed_activity = None
-        self.activities.remove(activity)
-        self.run_update_ui(self.update_activity_view)
-        self.run_update_ui(self.update_list_view)
+        self.run_update_ui(self.remove_activity, activity)
+
+    def remove_activity(self, activity):
+        """
+        Removes the row of a deleted activity
+        """
+        if self.displayed_activity is activity:
+            self.displayed_activity = None
+            self.update_activity_view()
+        index = bisect.bisect_left(self.activity_keys, activity_sort_key(activity))
+        if index < len(self.activities) and self.activities[index].id == activity.id:
+            del self.activities[index]
+            del self.activity_keys[index]
+            if index < self.loaded_count:
+                self.list_store.remove(self._store_position(index))
+                self.loaded_count -= 1
 
     def fetch_activities(self):
         self.execute_slow_method(self.repository.get_all_activities, None, self)
 
     def add_activity(self, activity):
-        self.activities.append(activity)
-        self.run_update_ui(self.update_list_view)
+        self.run_update_ui(self.insert_activity, activity)
+
+    def insert_activity(self, activity):
+        """
+        Adds the row of an imported activity at its place in the list
+        """
+        key = activity_sort_key(activity)
+        index = bisect.bisect_left(self.activity_keys, key)
+        self.activities.insert(index, activity)
+        self.activity_keys.insert(index, key)
+        if index <= self.loaded_count:
+            self.list_store.insert(self._store_position(index), ActivityItem(activity))
+            self.loaded_count += 1
+        self.hide_spinner()
+
+    def show_heatmap(self, visible):
+        if self.activity_details_handler:
+            self.activity_details_handler.show_heatmap(visible)
+
+    def refresh_heatmap(self):
+        if self.activity_details_handler:
+            self.activity_details_handler.refresh_heatmap()
 
     def update_activity_view(self):
         box = self.get_object_by_name("ActivityDetailsPaneBox")
@@ -228,8 +501,12 @@ class ActivitiesTabHandler(GladeHandler, callback.ActivitiesLoadedHandler, callb
 
         if self.activity_details_handler:
             box.remove(self.activity_details_handler.get_object())
+            self.activity_details_handler = None
 
-        if self.displayed_activity:
+        if self.displayed_activity and self.displayed_activity.gps_track.arrays is None:
+            # track still loading, see `display_track()`
+            button_delete.set_visible(True)
+        elif self.displayed_activity:
             self.activity_details_handler = ActivityDetailsHandler(self.repository, self.displayed_activity)
             adb = self.activity_details_handler.build_view()
             box.add(adb)
@@ -238,21 +515,45 @@ class ActivitiesTabHandler(GladeHandler, callback.ActivitiesLoadedHandler, callb
         else:
             button_delete.set_visible(False)
 
-    def update_list_view(self):
-        self.empty_list_box()
-        list_box = self.get_object_by_name("ActivitiesListBox")
-        for activity in self.activities:
-            lih = ActivityListItemHandler(self.repository, activity)
-            list_box_row = lih.build_view()
-            self.activity_rows_to_lih[list_box_row] = lih
-            list_box.add(list_box_row)
-            if self.displayed_activity and self.displayed_activity.id == activity.id:
-                list_box.select_row(list_box_row)
+    def update_list_view(self, activities):
+        """
+        Replaces all the activities of the list, i.e. after (re)loading them
+        """
+        self.activities = sorted(activities, key=activity_sort_key)
+        self.activity_keys = [activity_sort_key(activity) for activity in self.activities]
+        if self.displayed_activity:
+            # keeps the displayed activity (and its loaded track) selected
+            for index, activity in enumerate(self.activities):
+                if activity.id == self.displayed_activity.id:
+                    self.activities[index] = self.displayed_activity
         self.hide_spinner()
+        self.reuse_rows(self.activities[:max(self.loaded_count, self.PAGE_SIZE)])
+
+    def reuse_rows(self, page):
+        """
+        Makes `page` the activities of the model, keeping the items (hence
+        the rows) of the activities already there: only the rows of the
+        activities added are built, instead of every row
+        """
+        items = [self.list_store.get_item(position) for position in range(self.loaded_count)]
+        matcher = difflib.SequenceMatcher(None, [item.activity.id for item in items],
+            [activity.id for activity in page], autojunk=False)
+        # from the end, so that positions before a change are still valid
+        for tag, old_start, old_end, new_start, new_end in reversed(matcher.get_opcodes()):
+            if tag == "equal":
+                for item, activity in zip(items[old_start:old_end], page[new_start:new_end]):
+                    item.activity = activity
+                    if item.row_handler is not None:
+                        item.row_handler.set_activity_data(activity)
+            else:
+                self.list_store.splice(old_start, old_end - old_start,
+                    [ActivityItem(activity) for activity in page[new_start:new_end]])
+        self.loaded_count = len(page)
 
     def empty_list_box(self):
-        list_box = self.get_object_by_name("ActivitiesListBox")
-        list_box.bind_model(None, None, None)
+        self.spinner_shown = False
+        self.list_store.remove_all()
+        self.loaded_count = 0
         self.activity_rows_to_lih = dict()
 
 class ActivityListItemHandler(GladeHandler):
@@ -262,10 +563,17 @@ class ActivityListItemHandler(GladeHandler):
 
     def build_view(self):
         res = super().build_view()
-        label = self.get_object_by_name("ActivityNameLabel")
-        label.set_label(self.activity_data.name)
+        self.set_activity_data(self.activity_data)
         return res
 
+    def set_activity_data(self, activity_data):
+        """
+        Shows `activity_data` in the row, i.e. a reloaded summary of the same
+        activity
+        """
+        self.activity_data = activity_data
+        self.get_object_by_name("ActivityNameLabel").set_label(activity_data.name)
+
     def get_activity_data(self):
         return self.activity_data
 
@@ -273,7 +581,50 @@ class ActivitySpinnerItemHandler(GladeHandler):
     def __init__(self, repository):
         super().__init__(repository, "spinnerListBoxRow.glade", "SpinnerListBoxRow")
 
+def create_map_source(tile_cache):
+    """
+    Map source reading the tiles of `tile_cache` (a `tilecache.TileCache`)
+    first, then the tile server, as `MapSourceFactory.create_cached_source()`
+    does but with the cache's directory, size and server
+    """
+    factory = Champlain.MapSourceFactory.dup_default()
+    network_source = Champlain.NetworkTileSource.new_full(tile_cache.source_id, tilecache.SOURCE_NAME,
+        "", "", tilecache.MIN_ZOOM, tilecache.MAX_ZOOM, 256, Champlain.MapProjection.MERCATOR,
+        tile_cache.url_template, Champlain.ImageRenderer())
+    chain = Champlain.MapSourceChain()
+    chain.push(factory.create_error_source(256))
+    chain.push(network_source)
+    chain.push(Champlain.FileCache.new_full(tile_cache.max_size, tile_cache.directory, Champlain.ImageRenderer()))
+    chain.push(Champlain.MemoryCache.new_full(100, Champlain.ImageRenderer()))
+    return chain
+
+def create_heatmap_source(activity_heatmap):
+    """
+    Overlay source reading the tiles of `activity_heatmap` (a
+    `heatmap.Heatmap`) from its directory, with no tile server behind
+    """
+    null_source = Champlain.NullTileSource.new_full(Champlain.ImageRenderer())
+    null_source.set_id(heatmap.SOURCE_ID)
+    null_source.set_name(heatmap.SOURCE_NAME)
+    null_source.set_min_zoom_level(min(activity_heatmap.zooms))
+    null_source.set_max_zoom_level(max(activity_heatmap.zooms))
+    null_source.set_tile_size(heatmap.TILE_SIZE)
+    null_source.set_projection(Champlain.MapProjection.MERCATOR)
+    chain = Champlain.MapSourceChain()
+    chain.push(null_source)
+    chain.push(Champlain.FileCache.new_full(heatmap.FILE_CACHE_SIZE, activity_heatmap.directory,
+        Champlain.ImageRenderer()))
+    return chain
+
 class ActivityDetailsHandler(GladeHandler):
+
+    # shared by the details of every activity, see `create_map_source()`
+    map_source = None
+    # overlay of the heatmap, see `create_heatmap_source()`, and whether it
+    # is shown (toggled in the header bar)
+    heatmap_source = None
+    heatmap_visible = False
+
     def __init__(self, repository, activity_data):
         super().__init__(repository, "activityDetailsBox.glade", "ActivityDetailsBox")
         self.activity_data = activity_data
@@ -286,33 +637,36 @@ class ActivityDetailsHandler(GladeHandler):
         map = GtkChamplain.Embed()
         map.set_vexpand(True)
         self.ch_view = map.get_view()
-        map_source = Champlain.MapSourceFactory().create("osm-cyclemap")
-        self.ch_view.set_map_source(map_source)
+        if ActivityDetailsHandler.map_source is None:
+            ActivityDetailsHandler.map_source = create_map_source(tilecache.get_default())
+        self.ch_view.set_map_source(ActivityDetailsHandler.map_source)
+        self.heatmap_shown = False
+        self.show_heatmap(ActivityDetailsHandler.heatmap_visible)
         # self.ch_view.set_animate_zoom(False)
 
         # track = OsmGpsMap.MapTrack()
-        path_layer = Champlain.PathLayer()
+        self.path_layer = Champlain.PathLayer()
+        self.path_level_zoom = None
         self.marker_layer = Champlain.MarkerLayer()
         # last_point = None
 
+        gps_track = self.activity_data.gps_track
         bounding_box = Champlain.BoundingBox()
-        # add the activity's track
-        for gps_point in self.activity_data.gps_track.gps_points:
-            # point = OsmGpsMap.MapPoint()
-            # point.set_degrees(gps_point.latitude, gps_point.longitude)
-            # track.add_point(point)
-            bounding_box.extend(gps_point.latitude, gps_point.longitude)
-            location = Champlain.Coordinate(latitude=gps_point.latitude, longitude=gps_point.longitude)
-            path_layer.add_node(location)
-            # last_point = gps_point
-        
-        
+        bounding_box.extend(gps_track.latitude_min, gps_track.longitude_min)
+        bounding_box.extend(gps_track.latitude_max, gps_track.longitude_max)
         center_latitude, center_longitude = bounding_box.get_center()
 
-        self.ch_view.add_layer(path_layer)
+        self.ch_view.add_layer(self.path_layer)
         self.ch_view.add_layer(self.marker_layer)
         self.ch_view.center_on(center_latitude, center_longitude)
         self.ch_view.set_zoom_level(10)
+        # add the activity's track, as detailed as the zoom level needs
+        self.update_path_layer()
+        self.ch_view.connect("notify::zoom-level", self.on_zoom_level_changed)
+        self.ch_view.set_reactive(True)
+        self.ch_view.connect("button-release-event", self.on_map_clicked)
+        self.click_marker_layer = Champlain.MarkerLayer()
+        self.ch_view.add_layer(self.click_marker_layer)
         
         #map.track_add(track)
         #map.set_center_and_zoom(last_point.latitude, last_point.longitude, 13)
@@ -334,7 +688,13 @@ class ActivityDetailsHandler(GladeHandler):
         drawing_area.add_events(Gdk.EventMask.POINTER_MOTION_MASK |
             Gdk.EventMask.ENTER_NOTIFY_MASK |
             Gdk.EventMask.LEAVE_NOTIFY_MASK )
+        gps_track = self.activity_data.gps_track
+        self.profile = ElevationProfile(gps_track.arrays, self.activity_data.length,
+            gps_track.elevation_min, gps_track.elevation_max)
+        self.profile_surface = None
+        self.profile_surface_size = None
         drawing_area.connect("draw", self.draw_callback)
+        drawing_area.connect("style-updated", self.on_style_updated)
         drawing_area.connect("enter-notify-event", self.on_enter_notify_event)
         drawing_area.connect("motion-notify-event", self.on_motion_notify_event)
         drawing_area.connect("leave-notify-event", self.on_leave_notify_event)
@@ -344,6 +704,69 @@ class ActivityDetailsHandler(GladeHandler):
 
         return res
 
+    def on_zoom_level_changed(self, view, param):
+        self.update_path_layer()
+
+    def show_heatmap(self, visible):
+        """
+        Adds or removes the heatmap overlay, if the heatmap was built
+        """
+        activity_heatmap = heatmap.get_default(self.repository)
+        if visible and not self.heatmap_shown and activity_heatmap.is_built():
+            if ActivityDetailsHandler.heatmap_source is None:
+                ActivityDetailsHandler.heatmap_source = create_heatmap_source(activity_heatmap)
+            self.ch_view.add_overlay_source(ActivityDetailsHandler.heatmap_source, heatmap.OPACITY)
+            self.heatmap_shown = True
+        elif not visible and self.heatmap_shown:
+            self.ch_view.remove_overlay_source(ActivityDetailsHandler.heatmap_source)
+            self.heatmap_shown = False
+
+    def refresh_heatmap(self):
+        """
+        Reads the tiles again, after the heatmap was updated
+        """
+        if self.heatmap_shown:
+            self.ch_view.reload_tiles()
+
+    def update_path_layer(self):
+        """
+        Draws the simplified level of the track fitting the current zoom,
+        unless it is already drawn
+        """
+        gps_track = self.activity_data.gps_track
+        zoom = self.ch_view.get_zoom_level()
+        level_zoom = gps_track.levels.level_zoom(zoom) if gps_track.levels else None
+        if self.path_layer.get_nodes() and level_zoom == self.path_level_zoom:
+            return
+        self.path_level_zoom = level_zoom
+
+        latitudes = gps_track.arrays.latitude
+        longitudes = gps_track.arrays.longitude
+        if level_zoom is not None:
+            indices = gps_track.levels.for_zoom(zoom)
+            latitudes = latitudes[indices]
+            longitudes = longitudes[indices]
+        self.path_layer.remove_all()
+        for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist()):
+            # point = OsmGpsMap.MapPoint()
+            # point.set_degrees(latitude, longitude)
+            # track.add_point(point)
+            self.path_layer.add_node(Champlain.Coordinate(latitude=latitude, longitude=longitude))
+
+    def on_map_clicked(self, view, event):
+        """
+        Marks the point of the track nearest to the click
+        """
+        x, y = event.x, event.y
+        gps_point = self.activity_data.gps_track.find_nearest_point(view.y_to_latitude(y), view.x_to_longitude(x))
+        self.click_marker_layer.remove_all()
+        if gps_point:
+            marker = Champlain.Label.new_with_text(str(round(gps_point.cumulative_length/1000, 1)) + " km, " +\
+                str(round(gps_point.elevation)) + " m", None, None, None)
+            marker.set_location(gps_point.latitude, gps_point.longitude)
+            self.click_marker_layer.add_marker(marker)
+        return False
+
     def on_enter_notify_event(self, widget, event):
         widget.get_tooltip_window().show_all()
         self.point_marker = Champlain.Point()
@@ -373,90 +796,32 @@ class ActivityDetailsHandler(GladeHandler):
             # self.ch_view.center_on(gps_point.latitude, gps_point.longitude)
         return False
 
+    @instrumentation.traced("ui.draw_profile")
     def draw_callback(self, widget, cr):
-        context = widget.get_style_context()
+        """
+        Paints the elevation profile, rendered off-screen once per size and
+        theme then reused on every redraw
+        """
         width = widget.get_allocated_width()
         height = widget.get_allocated_height()
 
-        Gtk.render_background(context, cr, 0, 0, width, height)
-        
-        cr.set_source_rgb(0, 0, 0)
-        cr.set_line_width(1)
+        if self.profile_surface is None or self.profile_surface_size != (width, height):
+            self.profile_surface = widget.get_window().create_similar_surface(
+                cairo.CONTENT_COLOR_ALPHA, width, height)
+            self.profile_surface_size = (width, height)
+            surface_cr = cairo.Context(self.profile_surface)
+            Gtk.render_background(widget.get_style_context(), surface_cr, 0, 0, width, height)
+            self.profile.draw(surface_cr, width, height)
 
-        cr.move_to(10, 10)
-        cr.line_to(10, height - 10)
-        cr.line_to(width - 10, height - 10)
-        
-        #color = context.get_color(context.get_state())
-        
-        cr.stroke()
-
-        plot_height = height - 20
-        plot_width = width - 20
-
-        ele_min = self.activity_data.gps_track.elevation_min
-        ele_max = self.activity_data.gps_track.elevation_max
-        length = self.activity_data.length
-
-        self.ele_to_y = lambda ele: plot_height * (ele_max - ele)/(ele_max-ele_min) + 10
-        self.dist_to_x = lambda dist: plot_width * (dist/length) + 10
-
-        self.y_to_ele = lambda y: ele_max - (y - 10)/plot_height * (ele_max-ele_min)
-        self.x_to_dist = lambda x: (x - 10)/plot_width * length
-
-        self.colormap = lambda x: (max(min(3*(1-7*x), 1), 0), max(min(((1-7*x) - 0.4)*3, 1) , 0), max(min(((1-7*x) - 0.8)*5, 1), 0))
-
-        cr.set_line_width(0)
-        cumulative_distance = 0
-        cumulative_distance_chunk = 0
-        segment_points = []
-        segment_points_chunk = []
-
-        for gps_point in self.activity_data.gps_track.gps_points:
-            segment_points.append(gps_point)
-            segment_points_chunk.append(gps_point)
-            segment_length = gps_point.cumulative_length - cumulative_distance
-            segment_length_chunk = gps_point.cumulative_length - cumulative_distance_chunk
-            if segment_length > 100: # grade coloring per 50m segment
-                segment_elevation = gps_point.elevation - segment_points[0].elevation
-                segment_grade = segment_elevation / segment_length
-                segment_elevation_chunk = gps_point.elevation - segment_points_chunk[0].elevation
-                segment_grade_chunk = segment_elevation_chunk / segment_length_chunk
-                cumulative_distance = gps_point.cumulative_length
-                segment_points = []
-                if (abs(segment_grade_chunk - segment_grade) > 0.01):
-                    # cr.move_to(self.dist_to_x(cumulative_distance_chunk), plot_height + 10)
-                    cr.stroke()
-                    cr.set_source_rgb(0, 0, 0) # good enough for now lol
-                    cr.set_line_width(1.0)
-                    for gps_point_to_draw in segment_points_chunk:
-                        elevation = gps_point_to_draw.elevation
-                        distance = gps_point_to_draw.cumulative_length
-                        cr.line_to(self.dist_to_x(distance), self.ele_to_y(elevation))
-                    cr.stroke()
-
-                    (c1, c2, c3) = self.colormap(segment_grade)
-                    cr.set_source_rgb(c1, c2, c3)
-                    cr.move_to(self.dist_to_x(cumulative_distance_chunk), plot_height + 10)                    
-                    for gps_point_to_draw in segment_points_chunk:
-                        elevation = gps_point_to_draw.elevation
-                        distance = gps_point_to_draw.cumulative_length
-                        cr.line_to(self.dist_to_x(distance), self.ele_to_y(elevation))
-
-                    cr.line_to(self.dist_to_x(segment_points_chunk[-1].cumulative_length), plot_height + 10)
-                    cr.close_path()
-                    cr.fill()
-                    cr.stroke()
-                    cumulative_distance_chunk =  gps_point.cumulative_length
-                    segment_points_chunk = [segment_points_chunk[-1]]
-                
-                    
-        
-        # for gps_point in self.activity_data.gps_track.gps_points:
-        #     elevation = gps_point.elevation
-        #     distance = gps_point.cumulative_length
-        #     cr.line_to(self.dist_to_x(distance), self.ele_to_y(elevation))
-        # cr.line_to(plot_width + 10, plot_height + 10)
-        # cr.line_to(10, plot_height + 10)
-        # cr.close_path()
-        # cr.fill()
+        cr.set_source_surface(self.profile_surface, 0, 0)
+        cr.paint()
+
+    def on_style_updated(self, widget):
+        """
+        Theme change: the cached profile has to be rendered again
+        """
+        self.profile_surface = None
+        widget.queue_draw()
+
+    def x_to_dist(self, x):
+        return self.profile.x_to_dist(x)
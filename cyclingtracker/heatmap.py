@@ -0,0 +1,464 @@
+"""
+Heatmap of every ride, drawn over the map as PNG tiles.
+
+At each zoom of `ZOOMS`, every 256x256 tile has a density grid: the number
+of activities going through each of its pixels. Grids are kept as `.npy`
+files under `<directory>/grids`, and tiles are rendered from them under
+`<directory>/<SOURCE_ID>`, the layout of Champlain's `FileCache`, which
+serves them as an overlay (see `handler.create_heatmap_source()`).
+
+`build()` bins every track in a pool of processes. Once built, importing or
+deleting an activity updates only the grids and tiles it goes through:
+
+    python3 heatmap.py
+"""
+import concurrent.futures, io, json, math, multiprocessing, os, shutil, struct, sys, threading, time, zlib
+import numpy
+
+SOURCE_ID = "heatmap"
+SOURCE_NAME = "Carte de chaleur"
+DIRECTORY = os.path.join("db", "heatmap")
+ZOOMS = range(5, 16)
+TILE_SIZE = 256
+# activities through a pixel from which its colour no longer changes
+SATURATION = 20
+# consecutive points further apart (pixels) are not joined, i.e. GPS gaps
+MAX_GAP = 2048
+# pixels of binned activities kept in memory before adding them to the grids
+MAX_PENDING_PIXELS = 16 * 1024 * 1024
+# opacity (0-255) of the overlay
+OPACITY = 200
+# size limit given to the Champlain `FileCache` serving the tiles
+FILE_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+# zlib level of the tiles: higher ones take 3 times longer for 30% smaller tiles
+PNG_COMPRESSION = 3
+
+def pixel_coordinates(latitude, longitude, zoom):
+    """
+    Web Mercator pixel coordinates at `zoom` of positions, as in
+    `tilecache.tile_xy()` but for arrays and in pixels
+    """
+    scale = TILE_SIZE * 2 ** zoom
+    latitude = numpy.radians(numpy.clip(latitude, -85.0511, 85.0511))
+    x = (numpy.asarray(longitude) + 180) / 360 * scale
+    y = (1 - numpy.arcsinh(numpy.tan(latitude)) / math.pi) / 2 * scale
+    return x, y
+
+def _join(x, y):
+    """
+    (Private) adds points between consecutive points so that the line they
+    draw has no hole, unless they are more than `MAX_GAP` pixels apart
+    """
+    if len(x) < 2:
+        return x, y
+    dx = numpy.diff(x)
+    dy = numpy.diff(y)
+    steps = numpy.ceil(numpy.hypot(dx, dy)).astype(numpy.int64)
+    steps[(steps < 1) | (steps > MAX_GAP)] = 1
+    segment = numpy.repeat(numpy.arange(len(dx)), steps)
+    offsets = numpy.cumsum(steps) - steps
+    fraction = (numpy.arange(len(segment)) - offsets[segment]) / steps[segment]
+    return (numpy.append(x[segment] + dx[segment] * fraction, x[-1]),
+        numpy.append(y[segment] + dy[segment] * fraction, y[-1]))
+
+def bin_track(latitude, longitude, zooms=ZOOMS):
+    """
+    Returns the pixels a track goes through, as a dict of `(zoom, x, y)` tile
+    to the sorted offsets (`y * TILE_SIZE + x` in the tile) of its pixels.
+    Meant to run in a worker process.
+    """
+    tiles = dict()
+    latitude = numpy.asarray(latitude, dtype=numpy.float64)
+    longitude = numpy.asarray(longitude, dtype=numpy.float64)
+    if not len(latitude):
+        return tiles
+    for zoom in zooms:
+        scale = TILE_SIZE * 2 ** zoom
+        x, y = _join(*pixel_coordinates(latitude, longitude, zoom))
+        x = numpy.clip(x.astype(numpy.int64), 0, scale - 1)
+        y = numpy.clip(y.astype(numpy.int64), 0, scale - 1)
+        # each pixel counts once per activity
+        pixels = numpy.unique(y * scale + x)
+        x = pixels % scale
+        y = pixels // scale
+        tile = (y // TILE_SIZE) * 2 ** zoom + x // TILE_SIZE
+        offset = ((y % TILE_SIZE) * TILE_SIZE + x % TILE_SIZE).astype(numpy.uint16)
+        order = numpy.argsort(tile, kind="stable")
+        tile = tile[order]
+        offset = offset[order]
+        bounds = numpy.flatnonzero(numpy.diff(tile)) + 1
+        for start, end in zip(numpy.concatenate(([0], bounds)).tolist(), numpy.concatenate((bounds, [len(tile)])).tolist()):
+            tile_x = int(tile[start] % 2 ** zoom)
+            tile_y = int(tile[start] // 2 ** zoom)
+            tiles[(zoom, tile_x, tile_y)] = offset[start:end]
+    return tiles
+
+_palette = None
+
+def palette():
+    """
+    RGBA colour of each count of a grid: transparent for none, then from red
+    to yellow to white up to `SATURATION`
+    """
+    global _palette
+    if _palette is None:
+        counts = numpy.arange(SATURATION + 1)
+        heat = numpy.log1p(counts) / math.log1p(SATURATION)
+        colours = numpy.empty((SATURATION + 1, 4), dtype=numpy.uint8)
+        colours[:, 0] = 255
+        colours[:, 1] = numpy.clip(heat / 0.6, 0, 1) * 255
+        colours[:, 2] = numpy.clip((heat - 0.6) / 0.4, 0, 1) * 255
+        colours[:, 3] = 128 + 127 * heat
+        colours[0] = 0
+        _palette = colours
+    return _palette
+
+def render_tile(grid):
+    """
+    Returns the RGBA pixels of a tile from its grid
+    """
+    return palette()[numpy.minimum(grid, SATURATION)]
+
+def render_png(grid):
+    """
+    Returns the PNG of the tile of a grid, None if empty. Meant to run in a
+    worker process.
+    """
+    if grid is None or not grid.any():
+        return None
+    return encode_png(render_tile(grid))
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_png(pixels):
+    """
+    Encodes RGBA pixels (`(height, width, 4)` bytes) as a PNG
+    """
+    height, width = pixels.shape[:2]
+    # a filter type byte (none) at the start of each row
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 4)
+    return b"".join((b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(rows.tobytes(), PNG_COMPRESSION)),
+        _png_chunk(b"IEND", b"")))
+
+def _write_file(path, data):
+    """
+    (Private) replaces a file at once, so that the map never reads a partial tile
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(temporary_path, "wb") as output:
+        output.write(data)
+    os.replace(temporary_path, path)
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class Heatmap(object):
+    """
+    Heatmap of the activities of `repository`. Thread-safe: activities are
+    added by the scheduler's threads. The ids of the activities in the
+    grids are saved with them, so that adding or removing one is done once.
+    """
+
+    def __init__(self, repository, directory=DIRECTORY, zooms=ZOOMS):
+        self.repository = repository
+        self.directory = directory
+        self.zooms = zooms
+        self.lock = threading.RLock()
+        # tile -> `(offsets, sign)` of the activities not yet in its grid
+        self.pending = dict()
+        self.pending_pixels = 0
+        # tiles to render again, their grids having changed
+        self.touched = set()
+        self.activity_ids = None
+        self.building = False
+        # activities removed whilst building, not to be added by the build
+        self.removed_ids = set()
+
+    def state_path(self):
+        return os.path.join(self.directory, "heatmap.json")
+
+    def grid_path(self, zoom, x, y):
+        return os.path.join(self.directory, "grids", str(zoom), str(x), str(y) + ".npy")
+
+    def tile_path(self, zoom, x, y):
+        return os.path.join(self.directory, SOURCE_ID, str(zoom), str(x), str(y) + ".png")
+
+    def is_built(self):
+        """
+        Tells whether the heatmap was built, without waiting for an update
+        """
+        return not self.building and os.path.exists(self.state_path())
+
+    def _load_state(self):
+        """
+        (Private) returns the ids of the activities in the grids, None if
+        the heatmap was not built (for the current `zooms`)
+        """
+        if self.activity_ids is None and not self.building:
+            try:
+                with open(self.state_path()) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                return None
+            if state.get("zooms") != list(self.zooms):
+                return None
+            self.activity_ids = set(state["activities"])
+        return self.activity_ids
+
+    def _save_state(self):
+        _write_file(self.state_path(), json.dumps(
+            {"zooms": list(self.zooms), "activities": sorted(self.activity_ids)}).encode("utf-8"))
+
+    def _merge(self, tiles, sign):
+        """
+        (Private) adds (`sign` 1) or removes (`sign` -1) the pixels of an
+        activity, as returned by `bin_track()`, to the grids. They are kept
+        until `MAX_PENDING_PIXELS`, so that each grid is read and written
+        once for many activities.
+        """
+        for tile, offsets in tiles.items():
+            self.pending.setdefault(tile, []).append((offsets, sign))
+            self.pending_pixels += len(offsets)
+        if self.pending_pixels > MAX_PENDING_PIXELS:
+            self._apply_pending()
+
+    def _apply_pending(self):
+        """
+        (Private) adds the pending pixels to the grids and saves them
+        """
+        for tile, parts in self.pending.items():
+            counts = numpy.zeros(TILE_SIZE * TILE_SIZE, dtype=numpy.int32)
+            # offsets are unique within a part
+            for offsets, sign in parts:
+                counts[offsets] += sign
+            path = self.grid_path(*tile)
+            try:
+                counts += numpy.load(path).reshape(-1)
+            except OSError:
+                pass
+            grid = numpy.clip(counts, 0, numpy.iinfo(numpy.uint16).max).astype(numpy.uint16)
+            if grid.any():
+                output = io.BytesIO()
+                numpy.save(output, grid.reshape(TILE_SIZE, TILE_SIZE))
+                _write_file(path, output.getvalue())
+            else:
+                _remove_file(path)
+            self.touched.add(tile)
+        self.pending.clear()
+        self.pending_pixels = 0
+
+    def _flush(self, pool=None):
+        """
+        (Private) saves the modified grids and renders their tiles again, in
+        `pool` if given. Returns the number of tiles rendered.
+        """
+        self._apply_pending()
+        touched = sorted(self.touched)
+        self.touched.clear()
+        grids = []
+        for tile in touched:
+            try:
+                grids.append(numpy.load(self.grid_path(*tile)))
+            except OSError:
+                grids.append(None)
+        renders = pool.map(render_png, grids, chunksize=16) if pool is not None else map(render_png, grids)
+        for tile, png in zip(touched, renders):
+            if png is None:
+                _remove_file(self.tile_path(*tile))
+            else:
+                _write_file(self.tile_path(*tile), png)
+        return len(touched)
+
+    def _bin_activity(self, activity):
+        if activity.gps_track is None:
+            return dict()
+        arrays = self.repository.load_track_arrays(activity.gps_track.id)
+        return bin_track(arrays.latitude, arrays.longitude, self.zooms)
+
+    def add_activities(self, args, handler=None):
+        """
+        Slow method adding the activities given as `args` (a list) to the
+        heatmap, if built, rendering their tiles once. Calls
+        `handler.on_heatmap_updated()` if given.
+        """
+        with self.lock:
+            activity_ids = self._load_state()
+            if activity_ids is None:
+                return
+            activities = [activity for activity in args if activity.id not in activity_ids]
+        for activity in activities:
+            tiles = self._bin_activity(activity)
+            with self.lock:
+                if self.activity_ids is None or activity.id in self.activity_ids or activity.id in self.removed_ids:
+                    continue
+                self.activity_ids.add(activity.id)
+                self._merge(tiles, 1)
+        with self.lock:
+            if self.building or self.activity_ids is None:
+                # added by the end of the build
+                return
+            count = self._flush()
+            self._save_state()
+        if handler is not None:
+            handler.on_heatmap_updated(count)
+
+    def add_activity(self, args, handler=None):
+        """
+        Slow method adding the activity given as `args`, see `add_activities()`
+        """
+        self.add_activities([args], handler)
+
+    def remove_activity(self, activity):
+        """
+        Removes an activity from the heatmap, if built. Its track is read,
+        so this comes before deleting the activity (see `delete_activity()`).
+        Returns the number of tiles rendered.
+        """
+        with self.lock:
+            activity_ids = self._load_state()
+            if activity_ids is None:
+                return 0
+            if self.building:
+                self.removed_ids.add(activity.id)
+            if activity.id not in activity_ids:
+                return 0
+        tiles = self._bin_activity(activity)
+        with self.lock:
+            if self.activity_ids is None or activity.id not in self.activity_ids:
+                return 0
+            self.activity_ids.discard(activity.id)
+            self._merge(tiles, -1)
+            if self.building:
+                return 0
+            count = self._flush()
+            self._save_state()
+        return count
+
+    def delete_activity(self, args, handler):
+        """
+        Slow method removing the activity given as `args` from the heatmap,
+        then deleting it as `Repository.delete_activity()`
+        """
+        self.remove_activity(args)
+        self.repository.delete_activity(args, handler)
+
+    def build(self, workers=None):
+        """
+        Builds the heatmap of every activity from scratch, binning the
+        tracks in `workers` processes. Returns a `HeatmapReport`.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            if self.building:
+                raise RuntimeError("heatmap already building")
+            self.building = True
+            self.activity_ids = set()
+            self.removed_ids = set()
+            self.pending.clear()
+            self.pending_pixels = 0
+            self.touched.clear()
+            shutil.rmtree(self.directory, ignore_errors=True)
+        points = 0
+        try:
+            workers = workers or os.cpu_count() or 1
+            pool = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"))
+            activities = iter(self.repository.iter_activities())
+            binning = dict()
+            with pool:
+                while True:
+                    # bounds the number of tracks read ahead of the workers
+                    for activity in activities:
+                        if activity.gps_track is None:
+                            continue
+                        arrays = self.repository.load_track_arrays(activity.gps_track.id)
+                        points += len(arrays)
+                        binning[pool.submit(bin_track, arrays.latitude, arrays.longitude, self.zooms)] = activity.id
+                        if len(binning) >= 2 * workers:
+                            break
+                    if not binning:
+                        break
+                    done, not_done = concurrent.futures.wait(binning, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        activity_id = binning.pop(future)
+                        tiles = future.result()
+                        with self.lock:
+                            if activity_id not in self.activity_ids and activity_id not in self.removed_ids:
+                                self.activity_ids.add(activity_id)
+                                self._merge(tiles, 1)
+                with self.lock:
+                    count = self._flush(pool)
+                    self._save_state()
+                    activity_count = len(self.activity_ids)
+        except BaseException:
+            with self.lock:
+                self.activity_ids = None
+                self.pending.clear()
+                self.pending_pixels = 0
+                self.touched.clear()
+            raise
+        finally:
+            with self.lock:
+                self.building = False
+        return HeatmapReport(activity_count, points, count, time.perf_counter() - start)
+
+    def build_heatmap(self, args=None, handler=None):
+        """
+        Slow method building the heatmap, `args` being the number of worker
+        processes or None. Calls `handler.on_heatmap_updated()` if given.
+        """
+        if self.building:
+            return
+        report = self.build(args)
+        if handler is not None:
+            handler.on_heatmap_updated(report.tiles)
+
+class HeatmapReport(object):
+    """
+    Throughput of a heatmap build
+    """
+
+    def __init__(self, activities, points, tiles, seconds):
+        self.activities = activities
+        self.points = points
+        self.tiles = tiles
+        self.seconds = seconds
+
+    def __str__(self):
+        return "Carte de chaleur : {} activités ({} points), {} tuiles en {:.2f} s : {:.0f} points/s".format(
+            self.activities, self.points, self.tiles, self.seconds,
+            self.points / self.seconds if self.seconds > 0 else float("inf"))
+
+_default = None
+
+def get_default(repository):
+    """
+    Returns the heatmap shared by the UI, created on first use
+    """
+    global _default
+    if _default is None:
+        _default = Heatmap(repository)
+    return _default
+
+def main(args):
+    """
+    Builds the heatmap: `python3 heatmap.py [workers]`
+    """
+    import repository
+    repo = repository.Repository()
+    repo.init_database()
+    try:
+        report = Heatmap(repo).build(int(args[1]) if len(args) > 1 else None)
+    finally:
+        repo.storage.stop()
+    print(report)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+"""
+Reading of activity files, independent of the database so that it can run
+in worker processes (see `Repository.import_directory()`).
+"""
+import hashlib, os, sys
+import callback, fit, gpxstream, track
+import xml.etree.ElementTree as ElementTree
+from enum import Enum
+from track import TrackBuilder
+
+class FileType(Enum):
+    fit = 1
+    gpx = 2
+
+FILE_EXTENSIONS = {".fit": FileType.fit, ".gpx": FileType.gpx}
+
+def file_type_of(file_name):
+    """
+    Guesses the `FileType` of `file_name` from its extension, or None
+    """
+    return FILE_EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+
+def hash_file(file_name):
+    """
+    Returns the SHA-1 of the content of `file_name`, used to recognize
+    files that were already imported
+    """
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as activity_file:
+        for block in iter(lambda: activity_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def iter_point_chunks(activity_file, file_type):
+    """
+    Yields the points of `activity_file` (a binary file object) as chunks of
+    `(time, latitude, longitude, elevation)` tuples. Raises
+    `UnsupportedFileType` for formats that cannot be read.
+    """
+    if file_type == FileType.gpx:
+        return gpxstream.iter_chunks(activity_file, track.CHUNK_SIZE)
+    if file_type == FileType.fit:
+        return fit.iter_chunks(activity_file, track.CHUNK_SIZE)
+    raise UnsupportedFileType(file_type)
+
+def pack_points(point_chunks):
+    """
+    Builds the track of `point_chunks` (see `iter_point_chunks()`) and packs
+    its points as `gpstrackchunks` rows, without track id. Returns the
+    `TrackBuilder` and the rows.
+    """
+    builder = TrackBuilder()
+    chunk_rows = []
+    for points in point_chunks:
+        arrays = builder.add_points(points)
+        chunk_rows.extend(arrays.to_chunk_rows(None, first_chunk_index=len(chunk_rows)))
+    return builder, chunk_rows
+
+class UnsupportedFileType(Exception):
+    pass
+
+# errors raised when reading malformed files
+READ_ERRORS = (fit.FitError, ElementTree.ParseError, ValueError)
+
+class PackedActivityFile(object):
+    """
+    Result of reading one activity file ahead of writing it: the running
+    totals of its track and its points packed as `gpstrackchunks` rows
+    (without track id). `problem` is set if the file could not be read,
+    `skipped` if it was already imported.
+    """
+    def __init__(self, file_name, source_hash, builder=None, chunk_rows=None, problem=None, skipped=False):
+        self.file_name = file_name
+        self.source_hash = source_hash
+        self.builder = builder
+        self.chunk_rows = chunk_rows
+        self.problem = problem
+        self.skipped = skipped
+
+_known_hashes = frozenset()
+
+def init_worker(known_hashes):
+    """
+    Process pool initializer: hashes of the files already imported
+    """
+    global _known_hashes
+    _known_hashes = frozenset(known_hashes)
+
+def pack_activity_file(file_name):
+    """
+    Reads, builds and packs `file_name`. Meant to run in a worker process.
+    """
+    try:
+        source_hash = hash_file(file_name)
+    except OSError as error:
+        return PackedActivityFile(file_name, None, problem=str(error))
+    if source_hash in _known_hashes:
+        return PackedActivityFile(file_name, source_hash, skipped=True)
+
+    try:
+        with open(file_name, 'rb') as activity_file:
+            builder, chunk_rows = pack_points(iter_point_chunks(activity_file, file_type_of(file_name)))
+    except UnsupportedFileType:
+        return PackedActivityFile(file_name, source_hash, problem="Opération non supportée")
+    except Exception as error:
+        return PackedActivityFile(file_name, source_hash, problem=str(error))
+    if builder.point_count == 0:
+        return PackedActivityFile(file_name, source_hash, problem="Le fichier ne contient aucun point")
+    return PackedActivityFile(file_name, source_hash, builder, chunk_rows)
+
+class ConsoleBatchImportHandler(callback.BatchImportHandler):
+    """
+    Reports the progress of a batch import on the standard output
+    """
+    def on_batch_progress(self, progress, activity=None):
+        print("\r" + str(progress), end="", flush=True)
+
+    def on_batch_imported(self, progress):
+        print("\r" + str(progress))
+        for file_name, problem in progress.failures:
+            print("Échec : " + file_name + " : " + problem)
+
+def main(args):
+    """
+    Headless batch import: `python3 importer.py <directory> [workers]`
+    """
+    import repository
+    repo = repository.Repository()
+    repo.init_database()
+    workers = int(args[2]) if len(args) > 2 else None
+    repo.import_directory(callback.ImportDirectoryMethodArgs(args[1], workers), ConsoleBatchImportHandler())
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,160 @@
+"""
+Timing of repository calls, background jobs, UI callbacks and drawing.
+Off unless the `CYCLINGTRACKER_TRACE` environment variable is set:
+
+    CYCLINGTRACKER_TRACE=1 (or summary) summary table on stderr at exit
+    CYCLINGTRACKER_TRACE=trace.json     same, plus a JSON trace (Chrome
+                                        trace event format, for Perfetto or
+                                        chrome://tracing)
+
+When off, `traced()` returns functions unchanged and `span()` a shared
+do-nothing context manager.
+"""
+import atexit, collections, functools, json, os, sys, threading, time
+
+TRACE_VARIABLE = "CYCLINGTRACKER_TRACE"
+SETTING = os.environ.get(TRACE_VARIABLE, "")
+ENABLED = SETTING not in ("", "0")
+# trace file, None for the summary only
+TRACE_FILE = None if SETTING.lower() in ("", "0", "1", "summary") else SETTING
+
+_events = []
+_local = threading.local()
+_start = time.perf_counter()
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def add(self, **values):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class Span(object):
+    """
+    A timed section of a thread. Counts (`sql`, `rows`, `points`...) are
+    added with `add()`, or `instrumentation.add()` from code it calls.
+    """
+
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+    def __enter__(self):
+        stack = _stack()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        end = time.perf_counter()
+        _stack().pop()
+        record(self.name, self.start, end, **self.values)
+        return False
+
+    def add(self, **values):
+        for name, value in values.items():
+            self.values[name] = self.values.get(name, 0) + value
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def span(name, **values):
+    """
+    Context manager timing the section it wraps as `name`
+    """
+    if not ENABLED:
+        return _NO_SPAN
+    return Span(name, values)
+
+def traced(name=None):
+    """
+    Decorator timing every call of a function, as `name` or the function's
+    qualified name
+    """
+    def decorate(function):
+        if not ENABLED:
+            return function
+        span_name = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(span_name, dict()):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def add(**values):
+    """
+    Adds counts to the innermost span of the current thread, if any
+    """
+    if ENABLED:
+        stack = _stack()
+        if stack:
+            stack[-1].add(**values)
+
+def record(name, start, end, **values):
+    """
+    Records a section that started at `start` and ended at `end`, both
+    `time.perf_counter()` values
+    """
+    if ENABLED:
+        _events.append((name, start, end, threading.get_ident(), values))
+
+def instrument_engine(engine):
+    """
+    Counts the SQL statements run by `engine` in the current span
+    """
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+    def count_statement(connection, cursor, statement, parameters, context, executemany):
+        add(sql=1)
+    event.listen(engine, "before_cursor_execute", count_statement)
+
+def summary():
+    """
+    Returns the calls, times and counts per span name, as a text table
+    """
+    totals = collections.OrderedDict()
+    for name, start, end, thread, values in list(_events):
+        total = totals.setdefault(name, {"calls": 0, "seconds": 0.0, "max": 0.0, "values": collections.Counter()})
+        total["calls"] += 1
+        total["seconds"] += end - start
+        total["max"] = max(total["max"], end - start)
+        total["values"].update(values)
+    lines = ["{:<40} {:>7} {:>11} {:>10} {:>10}  {}".format("", "calls", "total ms", "mean ms", "max ms", "counts")]
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append("{:<40} {:>7} {:>11.1f} {:>10.2f} {:>10.2f}  {}".format(name, total["calls"],
+            total["seconds"] * 1e3, total["seconds"] / total["calls"] * 1e3, total["max"] * 1e3,
+            " ".join("{}={}".format(key, round(value, 3)) for key, value in sorted(total["values"].items()))))
+    return "\n".join(lines)
+
+def trace():
+    """
+    Returns the recorded spans as Chrome trace events
+    """
+    process = os.getpid()
+    return {"traceEvents": [{"name": name, "ph": "X", "ts": (start - _start) * 1e6, "dur": (end - start) * 1e6,
+        "pid": process, "tid": thread, "args": values} for name, start, end, thread, values in list(_events)]}
+
+def export():
+    """
+    Prints the summary and writes the trace file, if one was asked for
+    """
+    if not _events:
+        return
+    print(summary(), file=sys.stderr)
+    if TRACE_FILE:
+        with open(TRACE_FILE, "w") as trace_file:
+            json.dump(trace(), trace_file)
+
+if ENABLED:
+    atexit.register(export)
@@ -4,7 +4,7 @@ from gi.repository import GtkClutter
 gi.require_version('Gtk', '3.0')
 from gi.repository import GtkClutter
 from gi.repository import Gtk, GObject, Gdk
-import sys, repository, handler
+import sys, repository, handler, scheduler, instrumentation
 
 def main(args):
     GObject.threads_init()
@@ -21,6 +21,10 @@ def main(args):
     main_window.set_titlebar(header)
     main_window.show_all()
     Gtk.main()
+    scheduler.get_default().shutdown(wait=False)
+    repo.storage.stop()
+    if instrumentation.ENABLED:
+        print(repo.track_cache.statistics(), file=sys.stderr)
 
 if __name__ == "__main__":
     main(sys.argv)
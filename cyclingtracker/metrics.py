@@ -0,0 +1,193 @@
+"""
+Metrics derived from the points of a track: ascent, moving time, grades,
+average speed and climbs. They are computed once, chunk by chunk while the
+track is built, and stored (see `Repository`) with `METRICS_VERSION`, so
+that they can be recomputed when the way they are computed changes.
+"""
+import json, sys
+import numpy
+
+# bump whenever the computation below changes, see `Repository.backfill_metrics()`
+METRICS_VERSION = 1
+
+# elevation changes smaller than this (m) are considered noise
+ASCENT_HYSTERESIS = 5
+# speed (m/s) under which the rider is considered stopped
+MIN_MOVING_SPEED = 1.0
+# grades are measured over segments of this length (m)
+GRADE_STEP = 100
+# a climb is a stretch of segments steeper than `CLIMB_GRADE`, allowing
+# `CLIMB_MAX_DIP` flatter segments in between, gaining at least `CLIMB_MIN_GAIN`
+CLIMB_GRADE = 0.03
+CLIMB_MAX_DIP = 2
+CLIMB_MIN_GAIN = 30
+
+def turning_points(values):
+    """
+    Returns the values of the local extrema of `values`, with its ends
+    """
+    if len(values) < 3:
+        return values
+    # plateaus are reduced to their first point
+    values = values[numpy.concatenate(([True], numpy.diff(values) != 0))]
+    if len(values) < 3:
+        return values
+    direction = numpy.sign(numpy.diff(values))
+    turns = numpy.flatnonzero(direction[1:] != direction[:-1]) + 1
+    return numpy.concatenate((values[:1], values[turns], values[-1:]))
+
+def find_climbs(profile):
+    """
+    Finds the climbs of an elevation `profile` sampled every `GRADE_STEP`
+    meters. Returns a list of dicts with their `start` and `end` distances,
+    `gain` and average `grade`.
+    """
+    if len(profile) < 2:
+        return []
+    steep = numpy.diff(profile) / GRADE_STEP >= CLIMB_GRADE
+    edges = numpy.diff(numpy.concatenate(([0], steep.astype(numpy.int8), [0])))
+    runs = list(zip(numpy.flatnonzero(edges == 1).tolist(), numpy.flatnonzero(edges == -1).tolist()))
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] <= CLIMB_MAX_DIP:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    climbs = []
+    for start, end in merged:
+        gain = float(profile[end] - profile[start])
+        if gain >= CLIMB_MIN_GAIN:
+            climbs.append({"start": start * GRADE_STEP, "end": end * GRADE_STEP,
+                "gain": round(gain, 1), "grade": round(gain / ((end - start) * GRADE_STEP), 4)})
+    return climbs
+
+class MetricsBuilder(object):
+    """
+    Computes the derived metrics of a track fed chunk by chunk (as
+    `track.TrackArrays`). Only running totals, the hysteresis state and an
+    elevation profile sampled every `GRADE_STEP` meters are kept.
+    """
+
+    def __init__(self):
+        self.last_time = None
+        self.last_length = None
+        self.last_elevation = None
+        self.moving_time = 0.0
+        # ascent hysteresis: 1 rising, -1 falling, 0 not known yet
+        self.state = 0
+        self.low = None
+        self.high = None
+        self.ascent = 0.0
+        self.next_mark = 0.0
+        self.profile = []
+
+    def add(self, arrays):
+        if len(arrays) == 0:
+            return
+        timestamp = arrays.timestamp
+        length = arrays.cumulative_length
+        elevation = arrays.elevation
+        if self.last_time is not None:
+            timestamp = numpy.concatenate(([self.last_time], timestamp))
+            length = numpy.concatenate(([self.last_length], length))
+            elevation = numpy.concatenate(([self.last_elevation], elevation))
+
+        durations = numpy.diff(timestamp)
+        distances = numpy.diff(length)
+        moving = (durations > 0) & (distances >= MIN_MOVING_SPEED * durations)
+        self.moving_time += float(durations[moving].sum())
+
+        known = ~numpy.isnan(elevation)
+        self._add_ascent(elevation[known])
+        if known.any():
+            self._add_profile(length[known], elevation[known])
+
+        self.last_time = float(timestamp[-1])
+        self.last_length = float(length[-1])
+        self.last_elevation = float(elevation[-1])
+
+    def _add_ascent(self, elevation):
+        """
+        (Private) zig-zag filter: a peak (or valley) only counts once the
+        elevation went back `ASCENT_HYSTERESIS` meters below (or above) it.
+        Only the turning points of the chunk need to be walked.
+        """
+        for value in turning_points(elevation).tolist():
+            if self.low is None:
+                self.low = self.high = value
+            elif self.state == 1:
+                if value > self.high:
+                    self.high = value
+                elif value < self.high - ASCENT_HYSTERESIS:
+                    self.ascent += self.high - self.low
+                    self.state = -1
+                    self.low = value
+            elif self.state == -1:
+                if value < self.low:
+                    self.low = value
+                elif value > self.low + ASCENT_HYSTERESIS:
+                    self.state = 1
+                    self.high = value
+            else:
+                if value > self.low + ASCENT_HYSTERESIS:
+                    self.state = 1
+                    self.high = value
+                elif value < self.high - ASCENT_HYSTERESIS:
+                    self.state = -1
+                    self.low = value
+                else:
+                    self.low = min(self.low, value)
+                    self.high = max(self.high, value)
+
+    def _add_profile(self, length, elevation):
+        """
+        (Private) samples the elevation every `GRADE_STEP` meters
+        """
+        marks = numpy.arange(self.next_mark, length[-1] + 1e-9, GRADE_STEP)
+        if len(marks):
+            self.profile.extend(numpy.interp(marks, length, elevation).tolist())
+            self.next_mark = float(marks[-1]) + GRADE_STEP
+
+    def result(self, length):
+        """
+        Returns the metrics of the track, whose total length is `length`
+        """
+        ascent = self.ascent
+        if self.state == 1:
+            ascent += self.high - self.low
+        profile = numpy.array(self.profile)
+        grades = numpy.diff(profile) / GRADE_STEP
+        gain = float(grades[grades > 0].sum()) * GRADE_STEP if len(grades) else 0.0
+        return {
+            "version": METRICS_VERSION,
+            "total_ascent": ascent,
+            "moving_time": self.moving_time,
+            "average_speed": length / self.moving_time if self.moving_time > 0 else 0.0,
+            "max_grade": float(grades.max()) if len(grades) else 0.0,
+            # elevation gained per meter ridden
+            "average_grade": gain / length if length > 0 else 0.0,
+            "climbs": json.dumps(find_climbs(profile)),
+        }
+
+def compute_metrics(arrays, chunk_size):
+    """
+    Computes the metrics of a whole track (`track.TrackArrays`), chunk by chunk
+    """
+    builder = MetricsBuilder()
+    for start in range(0, len(arrays), chunk_size):
+        builder.add(arrays.slice(start, start + chunk_size))
+    length = float(arrays.cumulative_length[-1]) if len(arrays) else 0.0
+    return builder.result(length)
+
+def main(args):
+    """
+    Recomputes stale metrics: `python3 metrics.py`
+    """
+    import repository
+    repo = repository.Repository()
+    repo.init_database()
+    count = repo.backfill_metrics()
+    print(str(count) + " activités recalculées")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,10 +1,27 @@
-import time, callback, gpxpy, datetime, math, sys
-from enum import Enum
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship, subqueryload
+import time, callback, importer, datetime, math, sys, track, os, simplify, metrics, storage, instrumentation, rollups
+import segments, trackcache
+import concurrent.futures, multiprocessing
+from sqlalchemy import inspect, select, text, Column, Integer, String, Float, ForeignKey, LargeBinary
+from sqlalchemy.orm import relationship, joinedload
 from sqlalchemy.ext.declarative import declarative_base
+from track import TrackArrays, TrackBuilder, BoundingBox
+from simplify import TrackLevels
+from segments import SegmentShape
+from trackindex import TrackIndex
+from importer import FileType
 Base = declarative_base()
 
+# database file, relative to the working directory
+DATABASE_PATH = 'db/tracker.db'
+# number of `gpstrackchunks` rows written per bulk insert
+INSERT_BATCH_SIZE = 64
+
+# columns added since the first version of the schema: (table, column, type)
+ADDED_COLUMNS = [
+    ("gpstracks", "point_count", "INTEGER"),
+    ("activities", "source_hash", "VARCHAR"),
+]
+
 class Activity(Base):
     __tablename__ = 'activities'
     id = Column(Integer, primary_key = True)
@@ -13,36 +30,125 @@ class Activity(Base):
     duration = Column(Integer)
     length = Column(Float)
     total_ascent = Column(Integer)
+    source_hash = Column(String, index=True)
     gps_track = relationship("GpsTrack", uselist=False, back_populates="activity",
         cascade="all, delete, delete-orphan")
+    metrics = relationship("ActivityMetrics", uselist=False, lazy="joined",
+        cascade="all, delete, delete-orphan")
 
     def to_markup(self):
-        return "<big><b>" + self.name + "</b></big>\n" +\
+        markup = "<big><b>" + self.name + "</b></big>\n" +\
             "<b>Départ</b> : " + (datetime.datetime.fromtimestamp(self.start_timestamp)).ctime() + "\n" +\
             "<b>Longueur</b> : " + str(round(self.length/1000, 1)) + "km\n" +\
             "<b>Dénivelé pos.</b> : " + str(self.total_ascent) + "m\n" +\
             "<b>Durée totale</b> : " + str(math.floor(self.duration/3600)) + "h " + str(math.floor(self.duration/60)%60) + "m";
+        if self.metrics is not None:
+            markup += "\n<b>Vitesse moy.</b> : " + str(round(self.metrics.average_speed * 3.6, 1)) + "km/h"
+        return markup
+
+class ActivityMetrics(Base):
+    """
+    Metrics derived from the points of an activity's track (see `metrics`),
+    computed by version `version` of the computation
+    """
+    __tablename__ = 'activitymetrics'
+    activity_id = Column(Integer, ForeignKey('activities.id'), primary_key=True)
+    version = Column(Integer, index=True)
+    total_ascent = Column(Float)
+    moving_time = Column(Float)
+    average_speed = Column(Float)
+    max_grade = Column(Float)
+    average_grade = Column(Float)
+    # JSON list of `metrics.find_climbs()`
+    climbs = Column(String)
+
+class Rollup(Base):
+    """
+    Totals of the activities started in a week, month or year (see `rollups`)
+    """
+    __tablename__ = 'rollups'
+    period = Column(String, primary_key=True)
+    period_start = Column(Integer, primary_key=True)
+    activity_count = Column(Integer)
+    distance = Column(Float)
+    duration = Column(Float)
+    ascent = Column(Float)
+
+class Segment(Base):
+    """
+    A segment (see `segments.SegmentShape`). `latitude_min`... is the box
+    that the box of a track going through it contains. Its efforts are
+    cached in `segmentefforts` while `efforts_generation` equals
+    `generation`, which imports crossing the box increment.
+    """
+    __tablename__ = 'segments'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    start_latitude = Column(Float)
+    start_longitude = Column(Float)
+    end_latitude = Column(Float)
+    end_longitude = Column(Float)
+    # JSON list of `(latitude, longitude)`, or None
+    polyline = Column(String)
+    radius = Column(Float)
+    length = Column(Float)
+    latitude_min = Column(Float)
+    latitude_max = Column(Float)
+    longitude_min = Column(Float)
+    longitude_max = Column(Float)
+    generation = Column(Integer, default=0)
+    efforts_generation = Column(Integer, default=-1)
 
-class GpsPoint(Base):
-    __tablename__ = 'gpspoints'
+class SegmentEffort(Base):
+    """
+    A pass of an activity on a segment (see `segments.find_efforts()`)
+    """
+    __tablename__ = 'segmentefforts'
     id = Column(Integer, primary_key=True)
-    seq_number = Column(Integer)
-    timestamp = Column(Integer)
-    latitude = Column(Float)
-    longitude = Column(Float)
-    elevation = Column(Float)
-    cumulative_length = Column(Float)
-    gps_track_id = Column(Integer, ForeignKey('gpstracks.id'))
-    gps_track = relationship("GpsTrack", back_populates="gps_points")
+    segment_id = Column(Integer, ForeignKey('segments.id'), index=True)
+    activity_id = Column(Integer, ForeignKey('activities.id'), index=True)
+    start_index = Column(Integer)
+    end_index = Column(Integer)
+    start_timestamp = Column(Float)
+    elapsed_time = Column(Float)
+    distance = Column(Float)
+    average_grade = Column(Float)
+
+class GpsTrackChunk(Base):
+    """
+    Up to `track.CHUNK_SIZE` consecutive points of a track, stored as one
+    packed blob per column (see `track.TrackArrays`)
+    """
+    __tablename__ = 'gpstrackchunks'
+    id = Column(Integer, primary_key=True)
+    gps_track_id = Column(Integer, ForeignKey('gpstracks.id'), index=True)
+    chunk_index = Column(Integer)
+    point_count = Column(Integer)
+    timestamps = Column(LargeBinary)
+    latitudes = Column(LargeBinary)
+    longitudes = Column(LargeBinary)
+    elevations = Column(LargeBinary)
+    cumulative_lengths = Column(LargeBinary)
+
+class GpsTrackLevel(Base):
+    """
+    Indices of the points of a track kept at a given zoom level (see
+    `simplify.TrackLevels`)
+    """
+    __tablename__ = 'gpstracklevels'
+    id = Column(Integer, primary_key=True)
+    gps_track_id = Column(Integer, ForeignKey('gpstracks.id'), index=True)
+    zoom = Column(Integer)
+    point_count = Column(Integer)
+    indices = Column(LargeBinary)
 
 class GpsTrack(Base):
     __tablename__ = 'gpstracks'
     id = Column(Integer, primary_key=True)
     activity_id = Column(Integer, ForeignKey('activities.id'))
     activity = relationship("Activity", back_populates="gps_track")
-    gps_points = relationship("GpsPoint", back_populates="gps_track",
-        cascade="all, delete, delete-orphan")
-    
+    point_count = Column(Integer)
+
     elevation_min = Column(Float)
     elevation_max = Column(Float)
     latitude_min = Column(Float)
@@ -50,150 +156,751 @@ class GpsTrack(Base):
     longitude_min = Column(Float)
     longitude_max = Column(Float)
 
-    def __init__(self):
-        self.gps_points = []
+    # `track.TrackArrays` of the points and their `simplify.TrackLevels`, not
+    # persisted as such: filled in by `Repository` when the track is loaded
+    arrays = None
+    levels = None
+    _index = None
+
+    def bounding_box(self):
+        return BoundingBox(self.latitude_min, self.latitude_max, self.longitude_min, self.longitude_max)
 
-    def add_point(self, gps_point: GpsPoint):
-        self.gps_points.append(gps_point)
+    def get_index(self):
+        """
+        Returns the `trackindex.TrackIndex` of the loaded points, built on
+        first use
+        """
+        if self._index is None or self._index.arrays is not self.arrays:
+            self._index = TrackIndex(self.arrays)
+        return self._index
 
     def find_point_at_distance(self, distance):
-        closeness = math.inf
-        last_closeness = None
-
-        index_bottom = 0
-        index_top = len(self.gps_points)
-        
-        found_point = None
-
-        while index_top - index_bottom > 1:
-            index = round((index_bottom + index_top) / 2)
-            point = self.gps_points[index]
-            if last_closeness and last_closeness < closeness:
-                # the new point is not closer than the previous one
-                return found_point
-            if abs(point.cumulative_length - distance) < closeness:
-                last_closeness = closeness
-                closeness = abs(point.cumulative_length - distance)
-                found_point = point
-            if point.cumulative_length > distance: # need to lookup lower
-                index_top = index
-            elif point.cumulative_length < distance: # need to lookup higher
-                index_bottom = index
-        
-        return found_point
-
-class FileType(Enum):
-    fit = 1
-    gpx = 2
+        """
+        Returns the point at `distance` along the track, interpolated
+        between the two closest points
+        """
+        return self.get_index().point_at_distance(distance)
+
+    def find_nearest_point(self, latitude, longitude):
+        return self.get_index().nearest_point(latitude, longitude)
 
 class Repository(object):
+    """
+    Reads go through `session_maker`, whose sessions are read-only; writes
+    are functions of a session run by `storage.write()`, in the writer thread.
+    """
     
     def init_database(self):
-        engine = create_engine('sqlite:///db/tracker.db', echo=False, connect_args={'check_same_thread':False})
+        self.storage = storage.Storage(DATABASE_PATH)
+        engine = self.storage.writer_engine
         Base.metadata.create_all(engine)
-        self.session_maker = sessionmaker(bind=engine)
+        self._migrate_database(engine)
+        self.storage.start()
+        self.session_maker = self.storage.session_maker
+        self.track_cache = trackcache.TrackCache()
+
+    def _migrate_database(self, engine):
+        """
+        (Private) brings databases created by older versions up to date.
+        Tracks used to be stored as one `gpspoints` row per point: those are
+        packed into `gpstrackchunks` and the old table is dropped.
+        """
+        with engine.begin() as connection:
+            for table, column, column_type in ADDED_COLUMNS:
+                columns = [existing["name"] for existing in inspect(connection).get_columns(table)]
+                if column not in columns:
+                    connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type)))
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_activities_source_hash ON activities (source_hash)"))
+            if inspect(connection).has_table("gpspoints"):
+                self._migrate_gps_points(connection)
+            self._create_spatial_index(connection)
+            self._fill_rollups(connection)
+            self._update_segment_bounds(connection)
+
+    def _migrate_gps_points(self, connection):
+        """
+        (Private) packs the tracks stored in the former `gpspoints` table
+        """
+        track_ids = connection.execute(text("SELECT id FROM gpstracks WHERE point_count IS NULL")).scalars().all()
+        for track_id in track_ids:
+            rows = connection.execute(text(
+                "SELECT timestamp, latitude, longitude, elevation, cumulative_length FROM gpspoints "
+                "WHERE gps_track_id = :track_id ORDER BY seq_number"), {"track_id": track_id}).all()
+            columns = list(zip(*rows)) if rows else [[]] * len(track.COLUMNS)
+            arrays = TrackArrays(*[[math.nan if value is None else value for value in column]
+                for column in columns])
+            self._insert_track_arrays(connection, track_id, arrays)
+            connection.execute(text("UPDATE gpstracks SET point_count = :count WHERE id = :track_id"),
+                {"count": len(arrays), "track_id": track_id})
+        connection.execute(text("DROP TABLE gpspoints"))
+
+    def _create_spatial_index(self, connection):
+        """
+        (Private) creates the R*Tree of the bounding boxes of the activities'
+        tracks, indexed by activity id, and adds the activities missing from it
+        """
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS activitybounds "
+            "USING rtree(id, latitude_min, latitude_max, longitude_min, longitude_max)"))
+        connection.execute(text(
+            "INSERT INTO activitybounds "
+            "SELECT activity_id, latitude_min, latitude_max, longitude_min, longitude_max FROM gpstracks "
+            "WHERE activity_id IS NOT NULL AND point_count > 0 "
+            "AND activity_id NOT IN (SELECT id FROM activitybounds)"))
+
+    def _fill_rollups(self, connection):
+        """
+        (Private) computes the rollups of databases created before them
+        """
+        if connection.execute(text("SELECT 1 FROM rollups LIMIT 1")).first() is not None:
+            return
+        for activity in connection.execute(select(Activity.start_timestamp, Activity.length,
+                Activity.duration, Activity.total_ascent)):
+            self._add_to_rollups(connection, activity)
+
+    def _update_segment_bounds(self, connection):
+        """
+        (Private) recomputes the boxes of the segments saved by older
+        versions, which were shrunk by the radius only. Their cached efforts
+        may miss tracks, so they are invalidated.
+        """
+        for segment in connection.execute(select(Segment)).all():
+            bounds = SegmentShape.from_row(segment).bounding_box()
+            if bounds == (segment.latitude_min, segment.latitude_max, segment.longitude_min, segment.longitude_max):
+                continue
+            connection.execute(text(
+                "UPDATE segments SET latitude_min = :latitude_min, latitude_max = :latitude_max, "
+                "longitude_min = :longitude_min, longitude_max = :longitude_max, generation = generation + 1 "
+                "WHERE id = :id"), dict(bounds._asdict(), id=segment.id))
 
+    def _add_to_rollups(self, connection, activity, sign=1):
+        """
+        (Private) adds (`sign` 1) or removes (`sign` -1) an activity's
+        distance, duration and ascent to the totals of its periods
+        """
+        if not activity.start_timestamp:
+            return
+        connection.execute(text(
+            "INSERT INTO rollups (period, period_start, {}) VALUES (:period, :period_start, {}) "
+            "ON CONFLICT (period, period_start) DO UPDATE SET {}".format(
+                ", ".join(rollups.TOTALS), ", ".join(":" + total for total in rollups.TOTALS),
+                ", ".join("{0} = {0} + excluded.{0}".format(total) for total in rollups.TOTALS))),
+            rollups.contributions(activity.start_timestamp, activity.length, activity.duration,
+                activity.total_ascent, sign))
+        if sign < 0:
+            connection.execute(text("DELETE FROM rollups WHERE activity_count <= 0"))
+
+    def _index_activity_bounds(self, connection, activity_id, bounds: BoundingBox):
+        """
+        (Private) adds the bounding box of an activity to the spatial index,
+        and invalidates the efforts of the segments it may go through
+        """
+        connection.execute(text(
+            "INSERT OR REPLACE INTO activitybounds VALUES "
+            "(:id, :latitude_min, :latitude_max, :longitude_min, :longitude_max)"),
+            dict(bounds._asdict(), id=activity_id))
+        connection.execute(text(
+            "UPDATE segments SET generation = generation + 1 "
+            "WHERE latitude_min >= :latitude_min AND latitude_max <= :latitude_max "
+            "AND longitude_min >= :longitude_min AND longitude_max <= :longitude_max"),
+            bounds._asdict())
+
+    def _insert_track_arrays(self, connection, track_id, arrays: TrackArrays):
+        """
+        (Private) writes the points of a track as packed chunks, with one
+        bulk insert per `INSERT_BATCH_SIZE` chunks. Returns the number of rows.
+        """
+        rows = arrays.to_chunk_rows(track_id)
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            connection.execute(GpsTrackChunk.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+        return len(rows)
+
+    def _load_track_arrays(self, connection, track_id):
+        """
+        (Private) reads the points of a track back from its packed chunks
+        """
+        rows = connection.execute(select(GpsTrackChunk.__table__)
+            .where(GpsTrackChunk.gps_track_id == track_id)
+            .order_by(GpsTrackChunk.chunk_index)).all()
+        return TrackArrays.concatenate(TrackArrays.from_chunk_row(row) for row in rows)
+
+    def iter_track_chunks(self, track_id):
+        """
+        Yields the points of the track `track_id` one chunk (`track.TrackArrays`
+        of up to `track.CHUNK_SIZE` points) at a time, as they are read
+        """
+        session = self.session_maker()
+        try:
+            rows = session.connection().execute(select(GpsTrackChunk.__table__)
+                .where(GpsTrackChunk.gps_track_id == track_id)
+                .order_by(GpsTrackChunk.chunk_index))
+            for row in rows:
+                yield TrackArrays.from_chunk_row(row)
+        finally:
+            session.close()
+
+    def _insert_track_levels(self, connection, track_id, levels: TrackLevels):
+        """
+        (Private) writes the simplified levels of a track
+        """
+        rows = levels.to_rows(track_id)
+        if rows:
+            connection.execute(GpsTrackLevel.__table__.insert(), rows)
+
+    def _save_track_levels(self, session, track_id, levels: TrackLevels):
+        """
+        (Private) writes the levels of a track, unless already written
+        """
+        if session.execute(select(GpsTrackLevel.id).where(GpsTrackLevel.gps_track_id == track_id)).first() is None:
+            self._insert_track_levels(session.connection(), track_id, levels)
+
+    @instrumentation.traced("repository.load_track_levels")
+    def load_track_levels(self, track_id, arrays: TrackArrays = None):
+        """
+        Returns the `simplify.TrackLevels` of the track `track_id`. Levels of
+        tracks imported before they existed are computed, from `arrays` if
+        given, and saved in the background.
+        """
+        session = self.session_maker()
+        rows = session.execute(select(GpsTrackLevel.__table__)
+            .where(GpsTrackLevel.gps_track_id == track_id)).all()
+        if rows:
+            session.close()
+            return TrackLevels.from_rows(rows)
+        if arrays is None:
+            arrays = self._load_track_arrays(session.connection(), track_id)
+        session.close()
+        levels = simplify.build_levels(arrays, track.CHUNK_SIZE)
+        self.storage.write(lambda session: self._save_track_levels(session, track_id, levels))
+        return levels
+
+    @instrumentation.traced("repository.load_track_arrays")
+    def load_track_arrays(self, track_id):
+        """
+        Returns the points of the track `track_id` as `track.TrackArrays`
+        """
+        session = self.session_maker()
+        arrays = self._load_track_arrays(session.connection(), track_id)
+        session.close()
+        return arrays
+
+    @instrumentation.traced("repository.import_activity")
     def import_activity(self, args: callback.ImportActivityMethodArgs, handler: callback.ActivityImportedHandler):
-        if args.file_type == FileType.gpx:
-            activity = self._import_gpx(args.file_name)
-            handler.on_activity_imported(activity)
-        else:
+        start = time.perf_counter()
+        source_hash = importer.hash_file(args.file_name)
+        if self.is_imported(source_hash):
+            handler.on_activity_imported(activity=None, problem="Cette activité a déjà été importée")
+            return
+        try:
+            with open(args.file_name, 'rb') as activity_file:
+                point_chunks = importer.iter_point_chunks(activity_file, args.file_type)
+                activity, rows = self._import_track(point_chunks, source_hash)
+        except importer.UnsupportedFileType:
             handler.on_activity_imported(activity=None, problem="Opération non supportée")
+            return
+        except importer.READ_ERRORS as error:
+            handler.on_activity_imported(activity=None, problem="Fichier illisible : " + str(error))
+            return
+        if activity is None:
+            handler.on_activity_imported(activity=None, problem="Le fichier ne contient aucun point")
+            return
+        report = callback.ImportReport(args.file_name, activity.gps_track.point_count, rows,
+            time.perf_counter() - start)
+        instrumentation.add(points=report.points, rows=rows)
+        handler.on_activity_imported(activity, report=report)
 
-    def _import_gpx(self, filename):
-        gpx_file = open(filename, 'r')
-        gpx = gpxpy.parse(gpx_file)
-
-        seq = 0
-        start_time = 0
-        end_time = 0
-        length = 0
-        last_location = None
+    def is_imported(self, source_hash):
+        """
+        Tells whether a file with content hash `source_hash` was already imported
+        """
+        session = self.session_maker()
+        found = session.query(Activity.id).filter(Activity.source_hash == source_hash).first()
+        session.close()
+        return found is not None
 
-        elevation_min = math.inf
-        elevation_max = -math.inf
-        latitude_min = math.inf
-        latitude_max = -math.inf
-        longitude_min = math.inf
-        longitude_max = -math.inf
+    def get_imported_hashes(self):
+        session = self.session_maker()
+        hashes = session.execute(select(Activity.source_hash)
+            .where(Activity.source_hash.isnot(None))).scalars().all()
+        session.close()
+        return set(hashes)
 
+    def _new_activity(self, session, source_hash):
+        """
+        (Private) adds an empty activity and its track to `session`, to be
+        completed by `_complete_activity()` once all points are written
+        """
         db_track = GpsTrack()
-
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    if seq == 0:
-                        start_time = point.time.timestamp()
-                    db_point = GpsPoint()
-                    db_point.seq_number = seq
-                    db_point.timestamp = point.time.timestamp()
-                    db_point.elevation = point.elevation
-                    db_point.latitude = point.latitude
-                    db_point.longitude = point.longitude
-                    
-                    end_time = db_point.timestamp
-                    location = gpxpy.geo.Location(point.latitude, point.longitude, point.elevation)
-
-                    if last_location:
-                        length += last_location.distance_3d(location)
-                    
-                    db_point.cumulative_length = length
-                    db_point.gps_track = db_track
-                    db_track.add_point(db_point)
-
-                    elevation_min = min(point.elevation, elevation_min)
-                    elevation_max = max(point.elevation, elevation_max)
-                    latitude_min = min(point.latitude, latitude_min)
-                    latitude_max = max(point.latitude, latitude_max)
-                    longitude_min = min(point.longitude, longitude_min)
-                    longitude_max = max(point.longitude, longitude_max)
-
-                    seq += 1
-                    last_location = location
-
-        db_track.elevation_min = elevation_min
-        db_track.elevation_max = elevation_max
-        db_track.latitude_min = latitude_min
-        db_track.latitude_max = latitude_max
-        db_track.longitude_min = longitude_min
-        db_track.longitude_max = longitude_max
-        
-        db_activity = Activity(name= "Activité de " + str(math.floor(length/1000+0.5)) + " km", start_timestamp= start_time,
-            duration= end_time-start_time, length= length, total_ascent= 0)
+        db_activity = Activity(name="", start_timestamp=0, duration=0, length=0, total_ascent=0,
+            source_hash=source_hash)
         db_activity.gps_track = db_track
         db_track.activity = db_activity
+        session.add(db_activity)
+        session.flush()
+        return db_activity
 
-        activity = self.save_activity(db_activity)
-        return activity
+    def _complete_activity(self, session, db_activity, builder: TrackBuilder):
+        """
+        (Private) fills the summary of an activity from the totals of its
+        track and writes the track's levels
+        """
+        db_track = db_activity.gps_track
+        self._insert_track_levels(session.connection(), db_track.id, builder.levels())
+        db_track.point_count = builder.point_count
+        db_track.elevation_min = builder.elevation_min
+        db_track.elevation_max = builder.elevation_max
+        db_track.latitude_min = builder.latitude_min
+        db_track.latitude_max = builder.latitude_max
+        db_track.longitude_min = builder.longitude_min
+        db_track.longitude_max = builder.longitude_max
 
-    def save_activity(self, activity: Activity):
+        self._index_activity_bounds(session.connection(), db_activity.id, builder.bounding_box())
+
+        db_activity.name = "Activité de " + str(math.floor(builder.length/1000+0.5)) + " km"
+        db_activity.start_timestamp = builder.start_time
+        db_activity.duration = builder.duration
+        db_activity.length = builder.length
+        self._store_metrics(db_activity, builder.metrics())
+        self._add_to_rollups(session.connection(), db_activity)
+
+    def _store_metrics(self, db_activity, values):
+        """
+        (Private) sets the derived metrics of an activity, `values` being
+        returned by `metrics.MetricsBuilder.result()`
+        """
+        if db_activity.metrics is None:
+            db_activity.metrics = ActivityMetrics()
+        for name, value in values.items():
+            setattr(db_activity.metrics, name, value)
+        db_activity.total_ascent = int(round(values["total_ascent"]))
+
+    def _compute_metrics(self, connection, track_id):
+        """
+        (Private) computes the derived metrics of a stored track, reading its
+        chunks one at a time
+        """
+        builder = metrics.MetricsBuilder()
+        length = 0
+        rows = connection.execute(select(GpsTrackChunk.__table__)
+            .where(GpsTrackChunk.gps_track_id == track_id)
+            .order_by(GpsTrackChunk.chunk_index))
+        for row in rows:
+            arrays = TrackArrays.from_chunk_row(row)
+            builder.add(arrays)
+            if len(arrays):
+                length = float(arrays.cumulative_length[-1])
+        return builder.result(length)
+
+    def _backfill_activity_metrics(self, session, activity_id):
+        """
+        (Private) recomputes the metrics of an activity, returns whether it has a track
+        """
+        db_activity = session.get(Activity, activity_id)
+        if db_activity is None or db_activity.gps_track is None:
+            return False
+        # the ascent of the rollups changes with the metrics
+        self._add_to_rollups(session.connection(), db_activity, -1)
+        self._store_metrics(db_activity, self._compute_metrics(session.connection(), db_activity.gps_track.id))
+        self._add_to_rollups(session.connection(), db_activity)
+        return True
+
+    @instrumentation.traced("repository.backfill_metrics")
+    def backfill_metrics(self):
+        """
+        Computes the derived metrics of the activities imported before them,
+        or computed by an older `metrics.METRICS_VERSION`. Each activity is a
+        write of its own. Returns how many were computed.
+        """
         session = self.session_maker()
-        session.add(activity)
-        session.commit()
-        loaded_activity = session.query(Activity)\
-            .options(subqueryload(Activity.gps_track).subqueryload(GpsTrack.gps_points))\
-            .order_by(Activity.id.desc())\
-            .first()
+        activity_ids = session.execute(select(Activity.id)
+            .outerjoin(ActivityMetrics, ActivityMetrics.activity_id == Activity.id)
+            .where((ActivityMetrics.version == None) | (ActivityMetrics.version < metrics.METRICS_VERSION))
+            ).scalars().all()
         session.close()
-        return loaded_activity
+        writes = [self.storage.write(lambda session, activity_id=activity_id:
+            self._backfill_activity_metrics(session, activity_id)) for activity_id in activity_ids]
+        return sum(write.result() for write in writes)
+
+    def _import_track(self, point_chunks, source_hash=None):
+        """
+        (Private) imports a track given as chunks of `(time, latitude,
+        longitude, elevation)` points. They are read and packed in the
+        calling thread, so that the writer thread only inserts rows. Returns
+        the saved activity (without its points) and the number of rows
+        written, or `(None, 0)` if there was no point at all.
+        """
+        builder, chunk_rows = importer.pack_points(point_chunks)
+        if builder.point_count == 0:
+            return None, 0
+        return self.save_packed_activity(importer.PackedActivityFile(None, source_hash, builder, chunk_rows)).result()
+
+    def save_packed_activity(self, packed: importer.PackedActivityFile):
+        """
+        Queues the write of an activity file read by
+        `importer.pack_activity_file()`. Returns the future of the saved
+        activity and the number of rows.
+        """
+        return self.storage.write(lambda session: self._write_packed_activity(session, packed))
 
+    def _write_packed_activity(self, session, packed: importer.PackedActivityFile):
+        db_activity = self._new_activity(session, packed.source_hash)
+        track_id = db_activity.gps_track.id
+        for row in packed.chunk_rows:
+            row["gps_track_id"] = track_id
+        connection = session.connection()
+        for start in range(0, len(packed.chunk_rows), INSERT_BATCH_SIZE):
+            connection.execute(GpsTrackChunk.__table__.insert(), packed.chunk_rows[start:start + INSERT_BATCH_SIZE])
+        self._complete_activity(session, db_activity, packed.builder)
+        return db_activity, 2 + len(packed.chunk_rows)
+
+    def _report_saved(self, saving, progress, handler, limit):
+        """
+        (Private) reports the writes of `saving`, a list of `(future, packed)`,
+        which are done, waiting for the oldest ones while more than `limit`
+        are pending. Returns the pending ones.
+        """
+        pending = []
+        for index, (future, packed) in enumerate(saving):
+            if not future.done() and len(saving) - index <= limit:
+                pending.append((future, packed))
+                continue
+            activity = None
+            try:
+                activity, rows = future.result()
+                progress.add_imported(packed.builder.point_count, rows)
+            except Exception as error:
+                progress.add_failure(packed.file_name, str(error))
+            handler.on_batch_progress(progress, activity)
+        return pending
+
+    @instrumentation.traced("repository.import_directory")
+    def import_directory(self, args: callback.ImportDirectoryMethodArgs, handler: callback.BatchImportHandler):
+        """
+        Imports every activity file of a directory (recursively). Files are
+        read and packed by a pool of `args.workers` processes whilst the
+        writer thread writes them. Files already imported, including
+        earlier in the same batch, are skipped.
+        """
+        file_names = []
+        for directory, subdirectories, names in os.walk(args.directory):
+            subdirectories.sort()
+            file_names.extend(os.path.join(directory, name) for name in sorted(names)
+                if importer.file_type_of(name))
+
+        known_hashes = self.get_imported_hashes()
+        progress = callback.BatchImportProgress(len(file_names))
+        handler.on_batch_progress(progress)
+
+        workers = args.workers or os.cpu_count() or 1
+        pool = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"),
+            initializer=importer.init_worker, initargs=(known_hashes,))
+        remaining = iter(file_names)
+        pending = dict()
+        saving = []
+        with pool:
+            while True:
+                # bounds the number of packed files waiting for the writer
+                for file_name in remaining:
+                    pending[pool.submit(importer.pack_activity_file, file_name)] = file_name
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    file_name = pending.pop(future)
+                    try:
+                        packed = future.result()
+                    except Exception as error:
+                        progress.add_failure(file_name, str(error))
+                        handler.on_batch_progress(progress)
+                        continue
+                    if packed.problem:
+                        progress.add_failure(file_name, packed.problem)
+                    elif packed.skipped or packed.source_hash in known_hashes:
+                        progress.skipped += 1
+                    else:
+                        # written in the background, committed along with the next ones
+                        saving.append((self.save_packed_activity(packed), packed))
+                        known_hashes.add(packed.source_hash)
+                        continue
+                    handler.on_batch_progress(progress)
+                saving = self._report_saved(saving, progress, handler, 2 * workers)
+
+        self._report_saved(saving, progress, handler, 0)
+        instrumentation.add(points=progress.points, rows=progress.rows)
+        handler.on_batch_imported(progress)
+
+    @instrumentation.traced("repository.save_activity")
+    def save_activity(self, activity: Activity):
+        """
+        Writes `activity`, its track and the track's points in a single
+        transaction. Returns the saved activity, detached from the session,
+        along with the number of rows written.
+        """
+        return self.storage.write(lambda session: self._write_activity(session, activity)).result()
+
+    def _write_activity(self, session, activity: Activity):
+        session.add(activity)
+        session.flush()
+        db_track = activity.gps_track
+        rows = 2 + self._insert_track_arrays(session.connection(), db_track.id, db_track.arrays)
+        if db_track.levels is None:
+            db_track.levels = simplify.build_levels(db_track.arrays, track.CHUNK_SIZE)
+        self._insert_track_levels(session.connection(), db_track.id, db_track.levels)
+        self._store_metrics(activity, metrics.compute_metrics(db_track.arrays, track.CHUNK_SIZE))
+        self._add_to_rollups(session.connection(), activity)
+        self._index_activity_bounds(session.connection(), activity.id, db_track.bounding_box())
+        return activity, rows
+
+    @instrumentation.traced("repository.get_all_activities")
     def get_all_activities(self, args, handler: callback.ActivitiesLoadedHandler):
+        """
+        Loads the summary of every activity: its own columns and the bounding
+        box of its track. Points are left out, see `load_activity_track()`.
+        """
         #time.sleep(1)
         session = self.session_maker()
         activities = session.query(Activity)\
-            .options(subqueryload(Activity.gps_track).subqueryload(GpsTrack.gps_points))\
+            .options(joinedload(Activity.gps_track))\
             .all()
         session.close()
+        instrumentation.add(rows=len(activities))
 
         handler.on_activities_loaded(activities)
 
-    def delete_activity(self, args, handler: callback.ActivityDeletedHandler):
+    def get_activity(self, activity_id):
+        """
+        Returns the summary of an activity, as `get_all_activities()`, or None
+        """
+        session = self.session_maker()
+        activity = session.get(Activity, activity_id, options=[joinedload(Activity.gps_track)])
+        session.close()
+        return activity
+
+    def iter_activities(self, batch_size=256):
+        """
+        Yields the summary of every activity, as `get_all_activities()`, in
+        order of id, reading `batch_size` of them at a time
+        """
+        last_id = -1
+        while True:
+            session = self.session_maker()
+            activities = session.query(Activity)\
+                .options(joinedload(Activity.gps_track))\
+                .filter(Activity.id > last_id)\
+                .order_by(Activity.id)\
+                .limit(batch_size)\
+                .all()
+            session.close()
+            if not activities:
+                return
+            yield from activities
+            last_id = activities[-1].id
+
+    @instrumentation.traced("repository.load_activity_track")
+    def load_activity_track(self, args, handler: callback.TrackLoadedHandler):
+        """
+        Loads the points of the track of the activity given as `args`, from
+        `track_cache` if there
+        """
         activity = args
+        track_id = activity.gps_track.id
+        cached = self.track_cache.get(track_id)
+        if cached is None:
+            arrays = self.load_track_arrays(track_id)
+            levels = self.load_track_levels(track_id, arrays)
+            self.track_cache.put(track_id, arrays, levels)
+            instrumentation.add(points=len(arrays))
+        else:
+            arrays, levels = cached
+            instrumentation.add(cache_hits=1)
+        handler.on_track_loaded(activity, arrays, levels)
+
+    @instrumentation.traced("repository.get_activity_ids_in_area")
+    def get_activity_ids_in_area(self, bounds: BoundingBox, refine=False):
+        """
+        Returns the ids of the activities whose track bounding box intersects
+        `bounds`, looked up in the R*Tree. With `refine`, only the activities
+        with at least one point inside `bounds` are kept.
+        """
         session = self.session_maker()
-        session.delete(activity)
-        session.commit()
+        activity_ids = session.execute(text(
+            "SELECT id FROM activitybounds "
+            "WHERE latitude_max >= :latitude_min AND latitude_min <= :latitude_max "
+            "AND longitude_max >= :longitude_min AND longitude_min <= :longitude_max"),
+            bounds._asdict()).scalars().all()
+        if refine and activity_ids:
+            connection = session.connection()
+            track_ids = dict(session.execute(select(GpsTrack.activity_id, GpsTrack.id)
+                .where(GpsTrack.activity_id.in_(activity_ids))).all())
+            activity_ids = [activity_id for activity_id in activity_ids
+                if self._track_crosses(connection, track_ids[activity_id], bounds)]
         session.close()
+        return activity_ids
+
+    def _track_crosses(self, connection, track_id, bounds: BoundingBox):
+        """
+        (Private) tells whether a point of a track lies within `bounds`,
+        reading its chunks one at a time and stopping at the first match
+        """
+        rows = connection.execute(select(GpsTrackChunk.point_count, GpsTrackChunk.latitudes, GpsTrackChunk.longitudes)
+            .where(GpsTrackChunk.gps_track_id == track_id)
+            .order_by(GpsTrackChunk.chunk_index))
+        for row in rows:
+            latitude = track.unpack_column(row.latitudes, row.point_count)
+            longitude = track.unpack_column(row.longitudes, row.point_count)
+            if bounds.contains(latitude, longitude).any():
+                rows.close()
+                return True
+        return False
+
+    @instrumentation.traced("repository.find_activities_in_area")
+    def find_activities_in_area(self, args: callback.AreaMethodArgs, handler: callback.ActivitiesLoadedHandler):
+        """
+        Loads the summary of the activities crossing `args.bounds`, see
+        `get_activity_ids_in_area()`
+        """
+        activity_ids = self.get_activity_ids_in_area(args.bounds, args.refine)
+        session = self.session_maker()
+        activities = session.query(Activity)\
+            .options(joinedload(Activity.gps_track))\
+            .filter(Activity.id.in_(activity_ids))\
+            .all() if activity_ids else []
+        session.close()
+        handler.on_activities_loaded(activities)
+
+    @instrumentation.traced("repository.get_rollups")
+    def get_rollups(self, period, start=None, end=None):
+        """
+        Returns the `Rollup`s of `period` ("week", "month" or "year")
+        starting between the timestamps `start` and `end` (both optional),
+        the latest first
+        """
+        query = select(Rollup).where(Rollup.period == period)
+        if start is not None:
+            query = query.where(Rollup.period_start >= start)
+        if end is not None:
+            query = query.where(Rollup.period_start < end)
+        session = self.session_maker()
+        rows = session.execute(query.order_by(Rollup.period_start.desc())).scalars().all()
+        session.close()
+        instrumentation.add(rows=len(rows))
+        return rows
+
+    def load_rollups(self, args: callback.RollupsMethodArgs, handler: callback.RollupsLoadedHandler):
+        handler.on_rollups_loaded(args.period, self.get_rollups(args.period, args.start, args.end))
+
+    def add_segment(self, name, start, end, polyline=None, radius=segments.RADIUS):
+        """
+        Saves a segment from `start` to `end` (`(latitude, longitude)`),
+        along `polyline` if given, and returns it
+        """
+        shape = SegmentShape(start, end, polyline, radius)
+        bounds = shape.bounding_box()
+        segment = Segment(name=name, start_latitude=shape.start[0], start_longitude=shape.start[1],
+            end_latitude=shape.end[0], end_longitude=shape.end[1], polyline=shape.polyline_json(),
+            radius=radius, length=shape.length, generation=0, efforts_generation=-1, **bounds._asdict())
+        def write(session):
+            session.add(segment)
+            session.flush()
+            return segment
+        return self.storage.write(write).result()
+
+    def get_segments(self):
+        session = self.session_maker()
+        all_segments = session.execute(select(Segment).order_by(Segment.name)).scalars().all()
+        session.close()
+        return all_segments
+
+    def delete_segment(self, segment_id):
+        def write(session):
+            session.execute(SegmentEffort.__table__.delete().where(SegmentEffort.segment_id == segment_id))
+            session.execute(Segment.__table__.delete().where(Segment.id == segment_id))
+        self.storage.write(write).result()
+
+    @instrumentation.traced("repository.find_segment_efforts")
+    def find_segment_efforts(self, segment_id):
+        """
+        Returns the efforts of every activity on a segment, the fastest
+        first. Unless cached, activities whose box contains the segment's
+        are looked up in the R*Tree and their tracks scanned; the efforts
+        found are then cached in the background.
+        """
+        session = self.session_maker()
+        segment = session.get(Segment, segment_id)
+        if segment is None:
+            session.close()
+            return []
+        if segment.efforts_generation == segment.generation:
+            efforts = session.execute(select(SegmentEffort).where(SegmentEffort.segment_id == segment_id)
+                .order_by(SegmentEffort.elapsed_time)).scalars().all()
+            session.close()
+            return efforts
+
+        generation = segment.generation
+        shape = SegmentShape.from_row(segment)
+        connection = session.connection()
+        tracks = connection.execute(text(
+            "SELECT gpstracks.activity_id, gpstracks.id FROM activitybounds "
+            "JOIN gpstracks ON gpstracks.activity_id = activitybounds.id "
+            "WHERE activitybounds.latitude_min <= :latitude_min AND activitybounds.latitude_max >= :latitude_max "
+            "AND activitybounds.longitude_min <= :longitude_min AND activitybounds.longitude_max >= :longitude_max"),
+            shape.bounding_box()._asdict()).all()
+        found = []
+        for activity_id, track_id in tracks:
+            arrays = self._load_track_arrays(connection, track_id)
+            found.extend(dict(effort, segment_id=segment_id, activity_id=activity_id)
+                for effort in segments.find_efforts(arrays, shape))
+            instrumentation.add(points=len(arrays))
+        session.close()
+
+        self.storage.write(lambda session: self._cache_segment_efforts(session, segment_id, generation, found))
+        return sorted((SegmentEffort(**effort) for effort in found), key=lambda effort: effort.elapsed_time)
+
+    def _cache_segment_efforts(self, session, segment_id, generation, found):
+        """
+        (Private) replaces the cached efforts of a segment, unless an import
+        invalidated them in the meantime
+        """
+        updated = session.execute(text(
+            "UPDATE segments SET efforts_generation = :generation WHERE id = :id AND generation = :generation"),
+            {"id": segment_id, "generation": generation}).rowcount
+        if not updated:
+            return
+        session.execute(SegmentEffort.__table__.delete().where(SegmentEffort.segment_id == segment_id))
+        # activities deleted whilst the tracks were scanned
+        existing = set(session.execute(select(Activity.id)
+            .where(Activity.id.in_({effort["activity_id"] for effort in found}))).scalars().all())
+        efforts = [effort for effort in found if effort["activity_id"] in existing]
+        if efforts:
+            session.execute(SegmentEffort.__table__.insert(), efforts)
+
+    def load_segment_efforts(self, args: callback.SegmentMethodArgs, handler: callback.SegmentEffortsLoadedHandler):
+        handler.on_segment_efforts_loaded(args.segment_id, self.find_segment_efforts(args.segment_id))
+
+    @instrumentation.traced("repository.delete_activity")
+    def delete_activity(self, args, handler: callback.ActivityDeletedHandler):
+        activity = args
+        self.storage.write(lambda session: self._delete_activity(session, activity)).result()
+        if activity.gps_track:
+            self.track_cache.invalidate(activity.gps_track.id)
         handler.on_activity_deleted(activity)
+
+    def _delete_activity(self, session, activity: Activity):
+        stored = session.execute(select(Activity.start_timestamp, Activity.length, Activity.duration,
+            Activity.total_ascent).where(Activity.id == activity.id)).first()
+        if stored is not None:
+            self._add_to_rollups(session.connection(), stored, -1)
+        session.execute(SegmentEffort.__table__.delete().where(SegmentEffort.activity_id == activity.id))
+        if activity.gps_track:
+            session.execute(GpsTrackChunk.__table__.delete()
+                .where(GpsTrackChunk.gps_track_id == activity.gps_track.id))
+            session.execute(GpsTrackLevel.__table__.delete()
+                .where(GpsTrackLevel.gps_track_id == activity.gps_track.id))
+        session.execute(text("DELETE FROM activitybounds WHERE id = :id"), {"id": activity.id})
+        session.delete(activity)
     
     def populate_activities(self):
         activities = \
@@ -0,0 +1,46 @@
+"""
+Training totals per week, month and year. Each activity adds its distance,
+duration and ascent to the three periods it starts in; the totals are kept
+in the `rollups` table (see `Repository`), updated along with the activity.
+"""
+import datetime
+
+PERIODS = ("week", "month", "year")
+# summed columns of the `rollups` table
+TOTALS = ("activity_count", "distance", "duration", "ascent")
+
+def period_start(timestamp, period):
+    """
+    Returns the timestamp of the start (local midnight) of the week
+    (from Monday), month or year containing `timestamp`
+    """
+    day = datetime.datetime.fromtimestamp(timestamp).date()
+    if period == "week":
+        day -= datetime.timedelta(days=day.weekday())
+    elif period == "month":
+        day = day.replace(day=1)
+    elif period == "year":
+        day = day.replace(month=1, day=1)
+    else:
+        raise ValueError("unknown period: " + str(period))
+    return int(datetime.datetime.combine(day, datetime.time()).timestamp())
+
+def contributions(start_timestamp, length, duration, total_ascent, sign=1):
+    """
+    Rows added (`sign` 1) or removed (`sign` -1) from the `rollups` table
+    by an activity
+    """
+    return [{"period": period, "period_start": period_start(start_timestamp, period),
+        "activity_count": sign, "distance": sign * (length or 0), "duration": sign * (duration or 0),
+        "ascent": sign * (total_ascent or 0)} for period in PERIODS]
+
+def period_label(period, start):
+    """
+    French label of the period starting at `start`
+    """
+    day = datetime.datetime.fromtimestamp(start)
+    if period == "week":
+        return "Semaine du " + day.strftime("%d/%m/%Y")
+    if period == "month":
+        return day.strftime("%m/%Y")
+    return day.strftime("%Y")
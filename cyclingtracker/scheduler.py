@@ -0,0 +1,185 @@
+"""
+Runs the slow `method(args, handler)` calls of the UI (see
+`handler.GladeHandler.execute_slow_method()`) on a bounded pool of threads.
+Interactive jobs go before bulk ones, which never take every thread; a
+job supersedes the jobs of its group; identical jobs waiting in the queue
+are only run once.
+"""
+import collections, enum, threading, time, traceback
+import instrumentation
+
+# threads of the pool
+WORKER_COUNT = 4
+# threads that bulk jobs may use at once
+BULK_WORKER_COUNT = 2
+
+class Priority(enum.IntEnum):
+    # the user waits for the result: loading activities, tracks, deleting
+    INTERACTIVE = 0
+    # imports
+    BULK = 1
+
+class Job(object):
+    """
+    A `method(args, handler)` call. Once cancelled, a job which has not
+    started is dropped and the calls of the method to its handler are ignored.
+    """
+
+    def __init__(self, method, args, handler, priority, group):
+        self.method = method
+        self.args = args
+        self.handler = handler
+        self.priority = priority
+        self.group = group
+        self.cancelled = False
+        self.started = False
+        self.submitted_at = time.perf_counter()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def same_call(self, method, args, handler):
+        return self.method == method and self.args is args and self.handler is handler
+
+class _JobHandler(object):
+    """
+    (Private) handler given to the method of a job: forwards to the job's
+    handler until the job is cancelled
+    """
+
+    def __init__(self, job):
+        self._job = job
+
+    def __getattr__(self, name):
+        attribute = getattr(self._job.handler, name)
+        if not callable(attribute):
+            return attribute
+        def forward(*args, **kwargs):
+            if not self._job.cancelled:
+                return attribute(*args, **kwargs)
+        return forward
+
+class Scheduler(object):
+
+    def __init__(self, workers=WORKER_COUNT, bulk_workers=BULK_WORKER_COUNT):
+        self.workers = workers
+        self.bulk_workers = min(bulk_workers, workers - 1) if workers > 1 else workers
+        self.queues = {priority: collections.deque() for priority in Priority}
+        self.running = []
+        self.running_bulk = 0
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopping = False
+
+    def submit(self, method, args=None, handler=None, priority=Priority.INTERACTIVE, group=None):
+        """
+        Queues `method(args, handler)` and returns its `Job`. If the same
+        call is queued, its job is returned instead. A running one may have
+        read its data before the caller's change, so it does not count.
+        Otherwise, the jobs of `group` (if any) are cancelled.
+        """
+        with self.condition:
+            for queue in self.queues.values():
+                for job in queue:
+                    if not job.cancelled and job.same_call(method, args, handler):
+                        return job
+            if group is not None:
+                self._cancel_group(group)
+            job = Job(method, args, handler, priority, group)
+            self.queues[priority].append(job)
+            self._start_thread()
+            self.condition.notify()
+            return job
+
+    def cancel_group(self, group):
+        with self.condition:
+            self._cancel_group(group)
+
+    def _cancel_group(self, group):
+        """
+        (Private) cancels the jobs of `group`, dropping the queued ones
+        """
+        for job in self._jobs():
+            if job.group == group:
+                job.cancel()
+        for queue in self.queues.values():
+            for job in [job for job in queue if job.cancelled]:
+                queue.remove(job)
+
+    def _jobs(self):
+        for queue in self.queues.values():
+            yield from queue
+        yield from self.running
+
+    def _start_thread(self):
+        """
+        (Private) adds a thread to the pool, up to `workers` threads
+        """
+        if len(self.threads) < self.workers and len(self.threads) < len(self.running) + \
+                sum(len(queue) for queue in self.queues.values()):
+            thread = threading.Thread(target=self._run_worker, name="scheduler-worker", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def _next_job(self):
+        """
+        (Private) takes the next job this thread may run, or None
+        """
+        if self.queues[Priority.INTERACTIVE]:
+            return self.queues[Priority.INTERACTIVE].popleft()
+        if self.queues[Priority.BULK] and self.running_bulk < self.bulk_workers:
+            self.running_bulk += 1
+            return self.queues[Priority.BULK].popleft()
+        return None
+
+    def _run_worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None and not self.stopping:
+                    self.condition.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                job.started = True
+                self.running.append(job)
+            name = "job." + getattr(job.method, "__name__", "method")
+            instrumentation.record(name + ".wait", job.submitted_at, time.perf_counter())
+            try:
+                with instrumentation.span(name):
+                    job.method(job.args, _JobHandler(job) if job.handler is not None else None)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.running.remove(job)
+                    if job.priority == Priority.BULK:
+                        self.running_bulk -= 1
+                        # a bulk thread is free again
+                        self.condition.notify_all()
+
+    def shutdown(self, wait=True):
+        """
+        Drops the queued jobs and stops the threads once the running jobs end
+        """
+        with self.condition:
+            self.stopping = True
+            for queue in self.queues.values():
+                for job in queue:
+                    job.cancel()
+                queue.clear()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+_default = None
+
+def get_default():
+    """
+    Returns the scheduler shared by the UI, created on first use
+    """
+    global _default
+    if _default is None:
+        _default = Scheduler()
+    return _default
@@ -0,0 +1,148 @@
+"""
+Efforts on a segment: the passes of a track from a start point to an end
+point, optionally along a polyline. Tracks are scanned as arrays; which
+tracks to scan and the caching of the efforts are up to `Repository`.
+"""
+import json, math
+import numpy
+from track import EARTH_RADIUS, BoundingBox
+
+# distance (m) from the start and end points within which a track passes them
+RADIUS = 25
+# distance (m) from the polyline within which a track follows it
+CORRIDOR = 50
+# an effort's length must be within these ratios of the segment's length
+MIN_LENGTH_RATIO = 0.8
+MAX_LENGTH_RATIO = 1.5
+
+def path_length(points):
+    """
+    Length (m) of a path of `(latitude, longitude)` points
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    if len(points) < 2:
+        return 0.0
+    latitude = numpy.radians(points[:, 0])
+    longitude = numpy.radians(points[:, 1])
+    a = numpy.sin(numpy.diff(latitude) / 2)**2 + \
+        numpy.cos(latitude[:-1]) * numpy.cos(latitude[1:]) * numpy.sin(numpy.diff(longitude) / 2)**2
+    return float((2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))).sum())
+
+class SegmentShape(object):
+    """
+    Start and end points of a segment, with the polyline between them if
+    any (list of `(latitude, longitude)`, ends included)
+    """
+
+    def __init__(self, start, end, polyline=None, radius=RADIUS):
+        self.start = (float(start[0]), float(start[1]))
+        self.end = (float(end[0]), float(end[1]))
+        self.polyline = [(float(point[0]), float(point[1])) for point in polyline] \
+            if polyline is not None and len(polyline) else None
+        self.radius = radius
+        self.length = path_length(self.polyline or [self.start, self.end])
+        self.origin_latitude = self.start[0]
+        self.origin_longitude = self.start[1]
+        self.longitude_scale = math.cos(math.radians(self.origin_latitude))
+
+    @classmethod
+    def from_row(cls, row):
+        return cls((row.start_latitude, row.start_longitude), (row.end_latitude, row.end_longitude),
+            json.loads(row.polyline) if row.polyline else None, row.radius)
+
+    def polyline_json(self):
+        return json.dumps(self.polyline) if self.polyline else None
+
+    def bounding_box(self, corridor=CORRIDOR):
+        """
+        Box that the box of any track going through the segment contains:
+        the box of the segment shrunk by the radius around the ends, and by
+        the corridor of `find_efforts()` around the points between them
+        (possibly inverted)
+        """
+        points = numpy.array(self.polyline or [self.start, self.end])
+        margins = numpy.full(len(points), math.degrees(max(self.radius, corridor) / EARTH_RADIUS))
+        margins[[0, -1]] = math.degrees(self.radius / EARTH_RADIUS)
+        longitude_margins = margins / max(self.longitude_scale, 1e-6)
+        return BoundingBox(float((points[:, 0] + margins).min()), float((points[:, 0] - margins).max()),
+            float((points[:, 1] + longitude_margins).min()), float((points[:, 1] - longitude_margins).max()))
+
+    def project(self, latitude, longitude):
+        """
+        Local equirectangular projection around the start, in meters
+        """
+        x = numpy.radians(numpy.asarray(longitude) - self.origin_longitude) * EARTH_RADIUS * self.longitude_scale
+        y = numpy.radians(numpy.asarray(latitude) - self.origin_latitude) * EARTH_RADIUS
+        return x, y
+
+def _passes(distance, radius):
+    """
+    (Private) index of the closest point of each run of consecutive points
+    within `radius`
+    """
+    near = distance <= radius
+    if not near.any():
+        return []
+    edges = numpy.diff(numpy.concatenate(([0], near.astype(numpy.int8), [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    return [int(start + distance[start:end].argmin()) for start, end in zip(starts.tolist(), ends.tolist())]
+
+def _distance_to_path(x, y, path_x, path_y):
+    """
+    (Private) distance of each point to the closest segment of a path
+    """
+    best = numpy.full(len(x), numpy.inf)
+    for index in range(len(path_x) - 1):
+        dx = path_x[index + 1] - path_x[index]
+        dy = path_y[index + 1] - path_y[index]
+        squared = dx * dx + dy * dy
+        ratio = numpy.clip(((x - path_x[index]) * dx + (y - path_y[index]) * dy) / squared, 0, 1) \
+            if squared > 0 else numpy.zeros(len(x))
+        best = numpy.minimum(best, numpy.hypot(x - path_x[index] - ratio * dx, y - path_y[index] - ratio * dy))
+    return best
+
+def find_efforts(arrays, shape: SegmentShape, corridor=CORRIDOR):
+    """
+    Returns the efforts on `shape` of a track (`track.TrackArrays`), as
+    dicts of `start_index`, `end_index`, `start_timestamp`, `elapsed_time`,
+    `distance` and `average_grade`. Efforts do not overlap.
+    """
+    if len(arrays) < 2:
+        return []
+    x, y = shape.project(arrays.latitude, arrays.longitude)
+    end_x, end_y = shape.project(shape.end[0], shape.end[1])
+    starts = _passes(numpy.hypot(x, y), shape.radius)
+    ends = _passes(numpy.hypot(x - end_x, y - end_y), shape.radius)
+    if not starts or not ends:
+        return []
+    if shape.polyline:
+        path_x, path_y = shape.project(*zip(*shape.polyline))
+        path_x, path_y = numpy.atleast_1d(path_x), numpy.atleast_1d(path_y)
+
+    efforts = []
+    ends = numpy.array(ends)
+    last_end = -1
+    for start in starts:
+        if start <= last_end:
+            continue
+        following = ends[ends > start]
+        if not len(following):
+            break
+        end = int(following[0])
+        distance = float(arrays.cumulative_length[end] - arrays.cumulative_length[start])
+        if not MIN_LENGTH_RATIO * shape.length <= distance <= MAX_LENGTH_RATIO * shape.length + 2 * shape.radius:
+            continue
+        if shape.polyline and _distance_to_path(x[start:end + 1], y[start:end + 1], path_x, path_y).max() > corridor:
+            continue
+        climb = float(arrays.elevation[end] - arrays.elevation[start])
+        efforts.append({
+            "start_index": start,
+            "end_index": end,
+            "start_timestamp": float(arrays.timestamp[start]),
+            "elapsed_time": float(arrays.timestamp[end] - arrays.timestamp[start]),
+            "distance": distance,
+            "average_grade": climb / distance if distance > 0 and not math.isnan(climb) else 0.0,
+        })
+        last_end = end
+    return efforts
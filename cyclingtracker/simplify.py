@@ -0,0 +1,164 @@
+"""
+Level of detail of tracks drawn on the map. Tracks are simplified with
+Douglas-Peucker in Web Mercator coordinates, with one level per zoom in
+`LEVEL_ZOOMS`: each level keeps the points needed for the simplified path
+to stay within half a pixel of the track at that zoom.
+"""
+import math, zlib
+import numpy
+
+# zoom levels for which a simplified path is kept, above the last one the
+# whole track is drawn
+LEVEL_ZOOMS = (6, 8, 10, 12, 14, 16)
+# Web Mercator meters per pixel at zoom 0 (256 pixels tiles)
+METERS_PER_PIXEL = 2 * math.pi * 6378137 / 256
+INDEX_DTYPE = numpy.dtype("<i4")
+
+def tolerance(zoom):
+    """
+    Maximum deviation (Web Mercator meters) of the path drawn at `zoom`
+    """
+    return 0.5 * METERS_PER_PIXEL / 2**zoom
+
+def mercator(latitude, longitude):
+    """
+    Projects degrees to Web Mercator meters
+    """
+    x = numpy.radians(longitude) * 6378137
+    y = numpy.log(numpy.tan(math.pi / 4 + numpy.radians(numpy.clip(latitude, -85, 85)) / 2)) * 6378137
+    return x, y
+
+def _distances(x, y, index, start, end):
+    """
+    (Private) distances of points `index` to the segments `start`-`end`
+    """
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    px = x[index] - x[start]
+    py = y[index] - y[start]
+    norm = numpy.hypot(dx, dy)
+    degenerate = norm == 0
+    return numpy.where(degenerate, numpy.hypot(px, py),
+        numpy.abs(dx * py - dy * px) / numpy.where(degenerate, 1, norm))
+
+def significance(x, y, minimum_tolerance=0):
+    """
+    Runs Douglas-Peucker down to `minimum_tolerance` and returns, for each
+    point, the largest tolerance at which it is kept (infinite for the end
+    points, 0 for points never kept). All ranges still to be split are
+    processed at once, in whole-array operations.
+    """
+    count = len(x)
+    result = numpy.zeros(count)
+    if count == 0:
+        return result
+    result[0] = result[-1] = math.inf
+    starts = numpy.array([0])
+    ends = numpy.array([count - 1])
+    parents = numpy.array([math.inf])
+
+    while len(starts):
+        inner = ends - starts - 1
+        has_inner = inner > 0
+        starts, ends, parents, inner = starts[has_inner], ends[has_inner], parents[has_inner], inner[has_inner]
+        if not len(starts):
+            break
+        first = numpy.cumsum(inner) - inner
+        ranges = numpy.repeat(numpy.arange(len(starts)), inner)
+        index = starts[ranges] + 1 + numpy.arange(inner.sum()) - first[ranges]
+        distances = _distances(x, y, index, starts[ranges], ends[ranges])
+
+        farthest_distance = numpy.maximum.reduceat(distances, first)
+        positions = numpy.where(distances == farthest_distance[ranges], numpy.arange(len(index)), len(index))
+        farthest = index[numpy.minimum.reduceat(positions, first)]
+
+        # a point is kept as long as its parents are
+        kept_until = numpy.minimum(farthest_distance, parents)
+        split = farthest_distance > minimum_tolerance
+        result[farthest[split]] = kept_until[split]
+
+        starts, ends, farthest, kept_until = starts[split], ends[split], farthest[split], kept_until[split]
+        starts, ends, parents = numpy.concatenate((starts, farthest)), numpy.concatenate((farthest, ends)),\
+            numpy.concatenate((kept_until, kept_until))
+    return result
+
+def max_deviation(x, y, indices):
+    """
+    Largest distance between the points of a track and the path going
+    through its points `indices` only
+    """
+    indices = numpy.asarray(indices)
+    if len(indices) < 2:
+        return 0.0
+    segment = numpy.searchsorted(indices, numpy.arange(len(x)), side="right") - 1
+    segment = numpy.clip(segment, 0, len(indices) - 2)
+    return float(_distances(x, y, numpy.arange(len(x)), indices[segment], indices[segment + 1]).max())
+
+class TrackLevels(object):
+    """
+    Indices of the points of a track kept at each zoom of `LEVEL_ZOOMS`
+    """
+
+    def __init__(self, indices=None):
+        # zoom -> int32 array of point indices
+        self.indices = indices if indices is not None else dict()
+
+    def for_zoom(self, zoom):
+        """
+        Indices to draw at `zoom`, or None to draw every point
+        """
+        for level_zoom in LEVEL_ZOOMS:
+            if zoom <= level_zoom and level_zoom in self.indices:
+                return self.indices[level_zoom]
+        return None
+
+    def level_zoom(self, zoom):
+        """
+        Zoom of the level drawn at `zoom`, or None for the whole track
+        """
+        for level_zoom in LEVEL_ZOOMS:
+            if zoom <= level_zoom and level_zoom in self.indices:
+                return level_zoom
+        return None
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls({row.zoom: numpy.frombuffer(zlib.decompress(row.indices), dtype=INDEX_DTYPE, count=row.point_count)
+            for row in rows})
+
+    def to_rows(self, gps_track_id):
+        """
+        Rows of the `gpstracklevels` table
+        """
+        return [{"gps_track_id": gps_track_id, "zoom": zoom, "point_count": len(indices),
+            "indices": zlib.compress(numpy.ascontiguousarray(indices, dtype=INDEX_DTYPE).tobytes(), 1)}
+            for zoom, indices in sorted(self.indices.items())]
+
+class LevelsBuilder(object):
+    """
+    Builds the `TrackLevels` of a track fed chunk by chunk. Chunks are
+    simplified independently, keeping their end points, so the deviation
+    bound of every level still holds.
+    """
+
+    def __init__(self):
+        self.parts = {zoom: [] for zoom in LEVEL_ZOOMS}
+
+    def add_chunk(self, latitude, longitude, first_index):
+        x, y = mercator(latitude, longitude)
+        point_significance = significance(x, y, tolerance(LEVEL_ZOOMS[-1]))
+        for zoom in LEVEL_ZOOMS:
+            self.parts[zoom].append(numpy.flatnonzero(point_significance > tolerance(zoom)) + first_index)
+
+    def levels(self):
+        return TrackLevels({zoom: numpy.concatenate(parts).astype(INDEX_DTYPE)
+            for zoom, parts in self.parts.items() if parts})
+
+def build_levels(arrays, chunk_size):
+    """
+    Computes the levels of a whole track (`track.TrackArrays`), chunk by chunk
+    """
+    builder = LevelsBuilder()
+    for start in range(0, len(arrays), chunk_size):
+        builder.add_chunk(arrays.latitude[start:start + chunk_size], arrays.longitude[start:start + chunk_size], start)
+    return builder.levels()
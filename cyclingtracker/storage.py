@@ -0,0 +1,151 @@
+"""
+Access to the SQLite database. The database is in WAL mode, so readers
+never wait for the writer: reads go through a bounded pool of read-only
+connections, writes are queued to a single writer thread, which commits
+them in batches.
+"""
+import queue, threading, time, instrumentation
+import concurrent.futures
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+# maximum number of queued writes committed together
+WRITE_BATCH_SIZE = 32
+# connections of the reading pool
+READER_COUNT = 4
+# how long (ms) a connection waits for a lock before giving up
+BUSY_TIMEOUT = 30000
+
+class _WriteJob(object):
+
+    def __init__(self, function):
+        self.function = function
+        self.future = concurrent.futures.Future()
+        self.queued_at = time.perf_counter()
+
+class Storage(object):
+    """
+    Engines and sessions of the database at `path`. `write()` runs a
+    function in the writer thread; `session_maker` makes read-only sessions.
+    """
+
+    def __init__(self, path, readers=READER_COUNT):
+        url = "sqlite:///" + path
+        self.writer_engine = create_engine(url, echo=False, pool_size=1, max_overflow=0,
+            connect_args={'check_same_thread': False})
+        event.listen(self.writer_engine, "connect", self._on_writer_connect)
+        event.listen(self.writer_engine, "begin", self._on_writer_begin)
+        self.reader_engine = create_engine(url, echo=False, pool_size=readers, max_overflow=0,
+            connect_args={'check_same_thread': False})
+        event.listen(self.reader_engine, "connect", self._on_reader_connect)
+        instrumentation.instrument_engine(self.writer_engine)
+        instrumentation.instrument_engine(self.reader_engine)
+
+        self.session_maker = sessionmaker(bind=self.reader_engine)
+        self.writer_session_maker = sessionmaker(bind=self.writer_engine, expire_on_commit=False)
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    @staticmethod
+    def _on_writer_connect(dbapi_connection, connection_record):
+        """
+        (Private) switches the database to WAL and lets SQLAlchemy emit the
+        transaction statements itself, which SAVEPOINTs need with pysqlite
+        """
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT))
+        cursor.close()
+
+    @staticmethod
+    def _on_writer_begin(connection):
+        # takes the write lock upfront rather than on the first write
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    @staticmethod
+    def _on_reader_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA query_only=ON")
+        cursor.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT))
+        cursor.close()
+
+    def start(self):
+        """
+        Starts the writer thread, once the schema is up to date
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run_writer, name="storage-writer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Waits for the queued writes, then stops the writer thread
+        """
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write(self, function):
+        """
+        Queues `function(session)` to the writer thread and returns a
+        `concurrent.futures.Future` of its result, set once committed. A
+        write raising an exception is rolled back alone.
+        """
+        job = _WriteJob(function)
+        self.jobs.put(job)
+        return job.future
+
+    def _run_writer(self):
+        """
+        (Private) runs the queued writes, committing together those queued
+        at the same time
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            started_at = time.perf_counter()
+            for job in batch:
+                instrumentation.record("storage.write_wait", job.queued_at, started_at)
+            with instrumentation.span("storage.write_batch", jobs=len(batch)):
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """
+        (Private) runs each job of `batch` in its own SAVEPOINT, then commits
+        """
+        session = self.writer_session_maker()
+        results = []
+        try:
+            for job in batch:
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with session.begin_nested():
+                        results.append((job, job.function(session), None))
+                except Exception as error:
+                    results.append((job, None, error))
+            session.commit()
+        except Exception as error:
+            session.rollback()
+            results = [(job, None, error) for job, result, job_error in results]
+        finally:
+            session.close()
+        for job, result, error in results:
+            if error is None:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(error)
@@ -0,0 +1,233 @@
+"""
+On-disk cache of the map tiles. Tiles are stored the way Champlain's
+`FileCache` stores them, `<directory>/<source id>/<zoom>/<x>/<y>.png`, so
+that the map reads the tiles fetched here without going to the network.
+The cache is bounded: least recently used tiles are removed first.
+
+The tiles covering an activity are fetched in the background when it is
+imported on its own (see `prefetch_activity()`), at most `PREFETCH_RATE`
+tiles per second so as to respect the usage policy of the tile server.
+Batch imports prefetch nothing. `CYCLINGTRACKER_TILE_URL` replaces the tile
+server, e.g. by a local one.
+"""
+import math, os, threading, time, urllib.request
+import concurrent.futures
+
+SOURCE_ID = "osm-cyclemap"
+SOURCE_NAME = "OpenCycleMap"
+# `#Z#`, `#X#` and `#Y#` are replaced as in Champlain's network tile sources
+TILE_URL = os.environ.get("CYCLINGTRACKER_TILE_URL", "http://tile.opencyclemap.org/cycle/#Z#/#X#/#Y#.png")
+DIRECTORY = os.path.join("db", "tiles")
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+# bytes of tiles kept on disk; eviction goes down to `EVICTION_RATIO` of it
+MAX_SIZE = 256 * 1024 * 1024
+EVICTION_RATIO = 0.9
+# Champlain fetches tiles again past this age (s), so prefetching does too
+MAX_AGE = 7 * 24 * 3600
+# zoom levels prefetched for an activity, and how many tiles at most
+PREFETCH_ZOOMS = range(8, 14)
+MAX_PREFETCH_TILES = 400
+# tiles per second downloaded by prefetching, whatever the number of activities
+PREFETCH_RATE = 4
+# connections to the tile server
+DOWNLOAD_WORKERS = 2
+USER_AGENT = "cyclingtracker"
+
+def tile_xy(latitude, longitude, zoom):
+    """
+    Returns the `(x, y)` of the Web Mercator tile containing a position
+    """
+    count = 2 ** zoom
+    latitude = max(min(latitude, 85.0511), -85.0511)
+    x = int((longitude + 180) / 360 * count)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * count)
+    return min(max(x, 0), count - 1), min(max(y, 0), count - 1)
+
+def tiles_in_bounds(bounds, zooms):
+    """
+    Yields the `(zoom, x, y)` of the tiles covering `bounds` (a
+    `track.BoundingBox`) at each of `zooms`, in order
+    """
+    for zoom in zooms:
+        x_min, y_min = tile_xy(bounds.latitude_max, bounds.longitude_min, zoom)
+        x_max, y_max = tile_xy(bounds.latitude_min, bounds.longitude_max, zoom)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                yield zoom, x, y
+
+class TileCache(object):
+
+    def __init__(self, directory=DIRECTORY, source_id=SOURCE_ID, url_template=TILE_URL, max_size=MAX_SIZE,
+            prefetch_rate=PREFETCH_RATE):
+        self.directory = directory
+        self.source_id = source_id
+        self.url_template = url_template
+        self.max_size = max_size
+        self.prefetch_rate = prefetch_rate
+        self.lock = threading.Lock()
+        # bytes on disk, counted on first use
+        self.size = None
+        # time before which the next prefetch download must wait
+        self.next_prefetch = 0.0
+        self.prefetch_lock = threading.Lock()
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.directory, self.source_id, str(zoom), str(x), str(y) + ".png")
+
+    def url(self, zoom, x, y):
+        return self.url_template.replace("#Z#", str(zoom)).replace("#X#", str(x)).replace("#Y#", str(y))
+
+    def get(self, zoom, x, y):
+        """
+        Returns the cached tile, or None
+        """
+        path = self.path(zoom, x, y)
+        try:
+            with open(path, "rb") as tile_file:
+                data = tile_file.read()
+        except OSError:
+            return None
+        self._touch(path)
+        return data
+
+    def _touch(self, path):
+        """
+        (Private) marks a tile as used, through its access time
+        """
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def is_fresh(self, zoom, x, y):
+        try:
+            return time.time() - os.stat(self.path(zoom, x, y)).st_mtime < MAX_AGE
+        except OSError:
+            return False
+
+    def fetch(self, zoom, x, y, throttled=False):
+        """
+        Downloads a tile unless a fresh one is cached. Returns True if it was
+        downloaded. `throttled` downloads wait for their turn, see
+        `PREFETCH_RATE`.
+        """
+        if self.is_fresh(zoom, x, y):
+            self._touch(self.path(zoom, x, y))
+            return False
+        if throttled:
+            self._wait_prefetch_turn()
+        request = urllib.request.Request(self.url(zoom, x, y), headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            data = response.read()
+        self.put(zoom, x, y, data)
+        return True
+
+    def _wait_prefetch_turn(self):
+        """
+        (Private) spaces the prefetch downloads of all threads by
+        `1 / prefetch_rate` seconds
+        """
+        with self.prefetch_lock:
+            now = time.monotonic()
+            start = max(now, self.next_prefetch)
+            self.next_prefetch = start + 1 / self.prefetch_rate
+        if start > now:
+            time.sleep(start - now)
+
+    def put(self, zoom, x, y, data):
+        """
+        Stores a tile, replacing the file at once so that the map never
+        reads a partial one, then evicts tiles if the cache is too large
+        """
+        path = self.path(zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            previous_size = os.stat(path).st_size
+        except OSError:
+            previous_size = 0
+        temporary_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary_path, "wb") as tile_file:
+            tile_file.write(data)
+        os.replace(temporary_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = self._disk_size()
+            else:
+                self.size += len(data) - previous_size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _tiles(self):
+        """
+        (Private) `(last use, size, path)` of every cached tile
+        """
+        tiles = []
+        for directory, subdirectories, names in os.walk(os.path.join(self.directory, self.source_id)):
+            for name in names:
+                if name.endswith(".png"):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    tiles.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+        return tiles
+
+    def _disk_size(self):
+        return sum(size for used, size, path in self._tiles())
+
+    def _evict(self):
+        """
+        (Private) removes the least recently used tiles until the cache is
+        down to `EVICTION_RATIO` of its maximum size
+        """
+        tiles = sorted(self._tiles())
+        self.size = sum(size for used, size, path in tiles)
+        target = self.max_size * EVICTION_RATIO
+        for used, size, path in tiles:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def prefetch(self, bounds, zooms=PREFETCH_ZOOMS, max_tiles=MAX_PREFETCH_TILES):
+        """
+        Downloads the missing or stale tiles covering `bounds`, lower zooms
+        first, `max_tiles` at most. Returns the number of tiles downloaded
+        and of failures.
+        """
+        tiles = []
+        for tile in tiles_in_bounds(bounds, zooms):
+            if len(tiles) >= max_tiles:
+                break
+            tiles.append(tile)
+        downloaded = 0
+        failures = 0
+        with concurrent.futures.ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+            for future in [pool.submit(self.fetch, *tile, throttled=True) for tile in tiles]:
+                try:
+                    downloaded += future.result()
+                except OSError:
+                    failures += 1
+        return downloaded, failures
+
+    def prefetch_activity(self, args, handler=None):
+        """
+        Slow method prefetching the tiles of the activity given as `args`
+        """
+        self.prefetch(args.gps_track.bounding_box())
+
+_default = None
+
+def get_default():
+    """
+    Returns the tile cache shared by the UI, created on first use
+    """
+    global _default
+    if _default is None:
+        _default = TileCache()
+    return _default
@@ -0,0 +1,225 @@
+"""
+Column-oriented, packed representation of a GPS track.
+Points are never materialized as individual objects: each column is a
+numpy array of float64 values. In the database a track is stored as a
+few chunks of at most `CHUNK_SIZE` points, each chunk holding one
+compressed little-endian blob per column.
+"""
+import zlib, collections, math
+import numpy
+import simplify, metrics
+
+COLUMNS = ("timestamp", "latitude", "longitude", "elevation", "cumulative_length")
+CHUNK_SIZE = 4096
+DTYPE = numpy.dtype("<f8")
+# equatorial radius (m), as used by gpxpy
+EARTH_RADIUS = 6378137.0
+
+TrackPoint = collections.namedtuple("TrackPoint", COLUMNS)
+
+class BoundingBox(collections.namedtuple("BoundingBox",
+        ("latitude_min", "latitude_max", "longitude_min", "longitude_max"))):
+    """
+    Geographic area, in degrees
+    """
+    __slots__ = ()
+
+    def contains(self, latitude, longitude):
+        """
+        Tells (element-wise) whether positions lie within the box
+        """
+        return (latitude >= self.latitude_min) & (latitude <= self.latitude_max) &\
+            (longitude >= self.longitude_min) & (longitude <= self.longitude_max)
+
+    def intersects(self, other):
+        return self.latitude_max >= other.latitude_min and self.latitude_min <= other.latitude_max and\
+            self.longitude_max >= other.longitude_min and self.longitude_min <= other.longitude_max
+
+def pack_column(values):
+    """
+    Packs a sequence of floats into a compressed little-endian blob
+    """
+    return zlib.compress(numpy.ascontiguousarray(values, dtype=DTYPE).tobytes(), 1)
+
+def unpack_column(blob, count):
+    """
+    Unpacks a blob produced by `pack_column()` into a read-only numpy array
+    """
+    return numpy.frombuffer(zlib.decompress(blob), dtype=DTYPE, count=count)
+
+class TrackArrays(object):
+    """
+    Columns of a GPS track, one numpy array per field of `COLUMNS`.
+    """
+
+    def __init__(self, timestamp, latitude, longitude, elevation, cumulative_length):
+        self.timestamp = numpy.asarray(timestamp, dtype=DTYPE)
+        self.latitude = numpy.asarray(latitude, dtype=DTYPE)
+        self.longitude = numpy.asarray(longitude, dtype=DTYPE)
+        self.elevation = numpy.asarray(elevation, dtype=DTYPE)
+        self.cumulative_length = numpy.asarray(cumulative_length, dtype=DTYPE)
+
+    @classmethod
+    def empty(cls):
+        return cls(*([],) * len(COLUMNS))
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Builds a single track from consecutive parts (i.e. chunks)
+        """
+        parts = list(parts)
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls(*(numpy.concatenate([getattr(part, column) for part in parts])
+            for column in COLUMNS))
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def columns(self):
+        return tuple(getattr(self, column) for column in COLUMNS)
+
+    def slice(self, start, stop):
+        return TrackArrays(*(column[start:stop] for column in self.columns()))
+
+    def point(self, index):
+        """
+        Returns the point at `index` as a `TrackPoint`
+        """
+        return TrackPoint(*(float(column[index]) for column in self.columns()))
+
+    def iter_points(self):
+        """
+        Iterates over all points as `TrackPoint` tuples
+        """
+        for values in zip(*(column.tolist() for column in self.columns())):
+            yield TrackPoint(*values)
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns())
+
+    def to_chunk_rows(self, gps_track_id, first_chunk_index=0):
+        """
+        Splits the track into rows of the `gpstrackchunks` table
+        """
+        rows = []
+        for index, start in enumerate(range(0, len(self), CHUNK_SIZE), first_chunk_index):
+            chunk = self.slice(start, start + CHUNK_SIZE)
+            row = {"gps_track_id": gps_track_id, "chunk_index": index, "point_count": len(chunk)}
+            for column in COLUMNS:
+                row[column + "s"] = pack_column(getattr(chunk, column))
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def from_chunk_row(cls, row):
+        """
+        Rebuilds the part of a track stored in one `gpstrackchunks` row
+        """
+        return cls(*(unpack_column(getattr(row, column + "s"), row.point_count)
+            for column in COLUMNS))
+
+def segment_lengths(latitude, longitude, elevation):
+    """
+    Returns the 3D lengths of the `n - 1` segments joining `n` points:
+    haversine distance on the ground combined with the elevation change
+    (ignored where the elevation is unknown)
+    """
+    latitude = numpy.radians(latitude)
+    longitude = numpy.radians(longitude)
+    half_sin_latitude = numpy.sin(numpy.diff(latitude) / 2)
+    half_sin_longitude = numpy.sin(numpy.diff(longitude) / 2)
+    a = half_sin_latitude * half_sin_latitude +\
+        numpy.cos(latitude[:-1]) * numpy.cos(latitude[1:]) * half_sin_longitude * half_sin_longitude
+    ground = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+    climb = numpy.nan_to_num(numpy.diff(elevation))
+    return numpy.hypot(ground, climb)
+
+def _bounds(values):
+    """
+    (Private) returns the `(min, max)` of `values`, ignoring NaNs
+    """
+    if len(values) == 0 or numpy.isnan(values).all():
+        return math.inf, -math.inf
+    return float(numpy.nanmin(values)), float(numpy.nanmax(values))
+
+class TrackBuilder(object):
+    """
+    Builds a track from successive chunks of `(time, latitude, longitude,
+    elevation)` points, keeping only the running totals between chunks:
+    cumulative length, start and end times, bounds, simplified levels
+    (see `simplify`) and derived metrics (see `metrics`). Every chunk is processed with whole-array operations.
+    """
+
+    def __init__(self):
+        self.levels_builder = simplify.LevelsBuilder()
+        self.metrics_builder = metrics.MetricsBuilder()
+        self.point_count = 0
+        self.start_time = None
+        self.end_time = None
+        self.length = 0
+        self.last_point = None
+
+        self.elevation_min = math.inf
+        self.elevation_max = -math.inf
+        self.latitude_min = math.inf
+        self.latitude_max = -math.inf
+        self.longitude_min = math.inf
+        self.longitude_max = -math.inf
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time if self.point_count else 0
+
+    def levels(self):
+        return self.levels_builder.levels()
+
+    def metrics(self):
+        return self.metrics_builder.result(self.length)
+
+    def bounding_box(self):
+        return BoundingBox(self.latitude_min, self.latitude_max, self.longitude_min, self.longitude_max)
+
+    def add_points(self, points):
+        """
+        Appends a chunk of points and returns it as `TrackArrays`
+        """
+        if len(points) == 0:
+            return TrackArrays.empty()
+        values = numpy.array(points, dtype=DTYPE).reshape(-1, 4)
+        if self.last_point is not None:
+            # the first segment joins the end of the previous chunk
+            joined = numpy.vstack((self.last_point, values))
+        else:
+            joined = values
+        lengths = segment_lengths(joined[:, 1], joined[:, 2], joined[:, 3])
+        if self.last_point is None:
+            lengths = numpy.concatenate(([0.0], lengths))
+        cumulative_lengths = self.length + numpy.cumsum(lengths)
+        self.length = float(cumulative_lengths[-1])
+        self.last_point = values[-1].copy()
+
+        elevation_min, elevation_max = _bounds(values[:, 3])
+        latitude_min, latitude_max = _bounds(values[:, 1])
+        longitude_min, longitude_max = _bounds(values[:, 2])
+        self.elevation_min = min(elevation_min, self.elevation_min)
+        self.elevation_max = max(elevation_max, self.elevation_max)
+        self.latitude_min = min(latitude_min, self.latitude_min)
+        self.latitude_max = max(latitude_max, self.latitude_max)
+        self.longitude_min = min(longitude_min, self.longitude_min)
+        self.longitude_max = max(longitude_max, self.longitude_max)
+
+        self.levels_builder.add_chunk(values[:, 1], values[:, 2], self.point_count)
+
+        if self.start_time is None:
+            self.start_time = float(values[0, 0])
+        self.end_time = float(values[-1, 0])
+        self.point_count += len(values)
+
+        arrays = TrackArrays(values[:, 0], values[:, 1], values[:, 2], values[:, 3], cumulative_lengths)
+        self.metrics_builder.add(arrays)
+        return arrays
@@ -0,0 +1,107 @@
+"""
+Least recently used cache of loaded tracks, bounded in bytes. Tracks are
+kept as `track.TrackArrays` with their `simplify.TrackLevels`, so that
+selecting an activity again does not read its chunks back; activity
+summaries hold no points (see `Repository.load_activity_track()`).
+
+`CYCLINGTRACKER_TRACK_CACHE_MB` sets the budget, in megabytes.
+"""
+import collections, os, threading
+
+MAX_BYTES = int(float(os.environ.get("CYCLINGTRACKER_TRACK_CACHE_MB", "64")) * 1024 * 1024)
+
+def track_size(arrays, levels):
+    """
+    Bytes of the arrays of a loaded track
+    """
+    size = arrays.nbytes
+    if levels is not None:
+        size += sum(indices.nbytes for indices in levels.indices.values())
+    return size
+
+class CacheStatistics(object):
+    """
+    Counters of a `TrackCache`, as of a call to `TrackCache.statistics()`
+    """
+
+    def __init__(self, hits, misses, evictions, entries, size, max_size):
+        self.hits = hits
+        self.misses = misses
+        self.evictions = evictions
+        self.entries = entries
+        self.size = size
+        self.max_size = max_size
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return "Cache des traces : {} succès, {} échecs ({:.0%}), {} évictions, {} traces, {:.1f}/{:.1f} Mo".format(
+            self.hits, self.misses, self.hit_ratio, self.evictions, self.entries, self.size / 1e6,
+            self.max_size / 1e6)
+
+class TrackCache(object):
+    """
+    Thread-safe: tracks are loaded by the scheduler's threads
+    """
+
+    def __init__(self, max_size=MAX_BYTES):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # track id -> (arrays, levels, size), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, track_id):
+        """
+        Returns the `(arrays, levels)` of a cached track, or None
+        """
+        with self.lock:
+            entry = self.entries.get(track_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(track_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, track_id, arrays, levels):
+        """
+        Caches a track, evicting the least recently used ones beyond the
+        budget. Tracks larger than the budget are not cached.
+        """
+        size = track_size(arrays, levels)
+        with self.lock:
+            self._remove(track_id)
+            if size > self.max_size:
+                return
+            self.entries[track_id] = (arrays, levels, size)
+            self.size += size
+            while self.size > self.max_size:
+                evicted_id, (evicted_arrays, evicted_levels, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, track_id):
+        with self.lock:
+            self._remove(track_id)
+
+    def _remove(self, track_id):
+        entry = self.entries.pop(track_id, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def statistics(self):
+        with self.lock:
+            return CacheStatistics(self.hits, self.misses, self.evictions, len(self.entries), self.size,
+                self.max_size)
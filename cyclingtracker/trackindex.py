@@ -0,0 +1,152 @@
+"""
+Lookups in a track by distance, time or position, built once per track
+over its `track.TrackArrays`.
+"""
+import math
+import numpy
+from track import TrackPoint, EARTH_RADIUS
+
+class TrackIndex(object):
+    """
+    Answers distance -> point and timestamp -> point queries by binary
+    search (O(log n)) with linear interpolation between the two surrounding
+    points, and position -> nearest point queries through a uniform grid
+    (O(1) on average).
+    """
+
+    # average number of points per grid cell
+    POINTS_PER_CELL = 8
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.columns = arrays.columns()
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def _interpolate(self, values, value):
+        """
+        (Private) point where the increasing column `values` equals `value`,
+        interpolated between the two surrounding points
+        """
+        count = len(values)
+        if count == 0:
+            return None
+        index = int(numpy.searchsorted(values, value))
+        if index <= 0:
+            return self.arrays.point(0)
+        if index >= count:
+            return self.arrays.point(count - 1)
+        low = values[index - 1]
+        high = values[index]
+        ratio = (value - low) / (high - low) if high > low else 0
+        return TrackPoint(*(float(column[index - 1] + ratio * (column[index] - column[index - 1]))
+            for column in self.columns))
+
+    def _closest_index(self, values, value):
+        """
+        (Private) index of the point of increasing `values` closest to `value`
+        """
+        count = len(values)
+        if count == 0:
+            return None
+        index = int(numpy.searchsorted(values, value))
+        if index <= 0:
+            return 0
+        if index >= count:
+            return count - 1
+        return index if values[index] - value < value - values[index - 1] else index - 1
+
+    def point_at_distance(self, distance):
+        return self._interpolate(self.arrays.cumulative_length, distance)
+
+    def point_at_time(self, timestamp):
+        return self._interpolate(self.arrays.timestamp, timestamp)
+
+    def index_at_distance(self, distance):
+        return self._closest_index(self.arrays.cumulative_length, distance)
+
+    def index_at_time(self, timestamp):
+        return self._closest_index(self.arrays.timestamp, timestamp)
+
+    def _project(self, latitude, longitude):
+        """
+        (Private) local equirectangular projection, in meters
+        """
+        x = numpy.radians(numpy.asarray(longitude) - self.origin_longitude) * EARTH_RADIUS * self.longitude_scale
+        y = numpy.radians(numpy.asarray(latitude) - self.origin_latitude) * EARTH_RADIUS
+        return x, y
+
+    def _build_grid(self):
+        """
+        (Private) sorts the points by grid cell, so that the points of a cell
+        are a contiguous range of `cell_order`
+        """
+        count = len(self.arrays)
+        if count == 0:
+            return
+        self.origin_latitude = float(numpy.nanmin(self.arrays.latitude))
+        self.origin_longitude = float(numpy.nanmin(self.arrays.longitude))
+        self.longitude_scale = math.cos(math.radians(float(numpy.nanmean(self.arrays.latitude))))
+        self.x, self.y = self._project(self.arrays.latitude, self.arrays.longitude)
+
+        width = max(float(self.x.max()), 1.0)
+        height = max(float(self.y.max()), 1.0)
+        self.cell_size = max(math.sqrt(width * height * self.POINTS_PER_CELL / count), 1.0)
+        self.columns_count = int(width // self.cell_size) + 1
+        self.rows_count = int(height // self.cell_size) + 1
+        cells = self._cell(self.x, self.y)
+        self.cell_order = numpy.argsort(cells, kind="stable")
+        sorted_cells = cells[self.cell_order]
+        all_cells = numpy.arange(self.columns_count * self.rows_count)
+        self.cell_starts = numpy.searchsorted(sorted_cells, all_cells, side="left")
+        self.cell_ends = numpy.searchsorted(sorted_cells, all_cells, side="right")
+
+    def _cell(self, x, y):
+        column = numpy.clip((x // self.cell_size).astype(numpy.int64), 0, self.columns_count - 1)
+        row = numpy.clip((y // self.cell_size).astype(numpy.int64), 0, self.rows_count - 1)
+        return row * self.columns_count + column
+
+    def nearest_index(self, latitude, longitude):
+        """
+        Index of the point of the track nearest to `(latitude, longitude)`.
+        Rings of cells around the cell of the position are searched until no
+        closer point can be found.
+        """
+        if len(self.arrays) == 0:
+            return None
+        x, y = self._project(latitude, longitude)
+        column = int(min(max(x // self.cell_size, 0), self.columns_count - 1))
+        row = int(min(max(y // self.cell_size, 0), self.rows_count - 1))
+
+        best_index = None
+        best_distance = math.inf
+        for ring in range(max(self.columns_count, self.rows_count)):
+            # points of this ring are at least `(ring - 1) * cell_size` away
+            if best_index is not None and (ring - 1) * self.cell_size > best_distance:
+                break
+            candidates = []
+            for cell_row in range(row - ring, row + ring + 1):
+                if cell_row < 0 or cell_row >= self.rows_count:
+                    continue
+                on_edge = cell_row in (row - ring, row + ring)
+                for cell_column in ((range(column - ring, column + ring + 1)) if on_edge
+                        else (column - ring, column + ring)):
+                    if 0 <= cell_column < self.columns_count:
+                        cell = cell_row * self.columns_count + cell_column
+                        if self.cell_ends[cell] > self.cell_starts[cell]:
+                            candidates.append(self.cell_order[self.cell_starts[cell]:self.cell_ends[cell]])
+            if not candidates:
+                continue
+            candidates = numpy.concatenate(candidates)
+            distances = numpy.hypot(self.x[candidates] - x, self.y[candidates] - y)
+            closest = int(distances.argmin())
+            if distances[closest] < best_distance:
+                best_distance = float(distances[closest])
+                best_index = int(candidates[closest])
+        return best_index
+
+    def nearest_point(self, latitude, longitude):
+        index = self.nearest_index(latitude, longitude)
+        return None if index is None else self.arrays.point(index)
@@ -0,0 +1,8 @@
+"""
+The modules of `cyclingtracker` import each other by their flat names, as
+when the application runs from its directory
+"""
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cyclingtracker"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
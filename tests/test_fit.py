@@ -0,0 +1,110 @@
+"""
+`fit` on files written by `synthetic.write_fit()` and on small hand-built
+files
+"""
+import io, struct
+import numpy
+import pytest
+import fit, synthetic
+from numpy.testing import assert_allclose, assert_array_equal
+
+EVENT_MESSAGE = 21
+# base types of the FIT profile
+UINT16, SINT32, UINT32 = 0x84, 0x85, 0x86
+T0 = 1000000030
+
+def definition(local_type, global_number, fields, big_endian=False):
+    """
+    Definition message of `fields`, a list of `(number, size, base type)`
+    """
+    return struct.pack(">BBBHB" if big_endian else "<BBBHB", 0x40 | local_type, 0, int(big_endian),
+        global_number, len(fields)) + b"".join(struct.pack("BBB", *field) for field in fields)
+
+def fit_file(body, data_size=None):
+    """
+    FIT file of a 12 bytes header, `body` and the CRC (not checked). The
+    header declares `data_size`, by default the size of `body`.
+    """
+    header = struct.pack("<BBHI4s", 12, 0x10, 2100, len(body) if data_size is None else data_size, b".FIT")
+    return io.BytesIO(header + body + b"\0\0")
+
+RECORD = [(fit.TIMESTAMP_FIELD, 4, UINT32), (0, 4, SINT32), (1, 4, SINT32), (2, 2, UINT16)]
+POSITION = [(0, 4, SINT32), (1, 4, SINT32)]
+
+def record(timestamp, latitude, longitude, altitude, local_type=0, endian="<"):
+    return struct.pack(endian + "BIiiH", local_type, timestamp, latitude, longitude, altitude)
+
+def compressed(local_type, timestamp, latitude, longitude):
+    return struct.pack("<Bii", 0x80 | local_type << 5 | (timestamp & 0x1F), latitude, longitude)
+
+def test_synthetic_ride_round_trip(tmp_path):
+    points = synthetic.random_ride(2 * 4096 + 10, 1)
+    path = str(tmp_path / "ride.fit")
+    synthetic.write_fit(path, points)
+    with open(path, "rb") as activity_file:
+        chunks = list(fit.iter_chunks(activity_file, 4096))
+    assert [len(chunk) for chunk in chunks] == [4096, 4096, 10]
+    decoded = numpy.concatenate(chunks)
+    assert_array_equal(decoded[:, 0], numpy.floor(points[:, 0]))
+    # semicircles and altitude steps of 0.2 m
+    assert_allclose(decoded[:, 1:3], points[:, 1:3], rtol=0, atol=fit.SEMICIRCLE_TO_DEGREES)
+    assert_allclose(decoded[:, 3], points[:, 3], rtol=0, atol=0.1 + 1e-9)
+
+def test_compressed_timestamps_follow_any_message_type():
+    body = definition(2, EVENT_MESSAGE, [(fit.TIMESTAMP_FIELD, 4, UINT32)]) + struct.pack("<BI", 2, T0) +\
+        definition(1, fit.RECORD_MESSAGE, POSITION)
+    # T0 ends with 30 in its 5 low bits: offsets roll over, each relative to
+    # the timestamp before it, up to 31 s
+    for delta in (2, 5, 33):
+        body += compressed(1, T0 + delta, delta, -delta)
+    records = fit.read_records(fit_file(body))
+    assert_array_equal(records["time"], [fit.FIT_EPOCH + T0 + 2, fit.FIT_EPOCH + T0 + 5, fit.FIT_EPOCH + T0 + 33])
+    assert_array_equal(records["latitude"] / fit.SEMICIRCLE_TO_DEGREES, [2, 5, 33])
+
+def test_compressed_timestamps_after_a_full_record():
+    body = definition(0, fit.RECORD_MESSAGE, RECORD) + record(T0, 1, 1, 3000) +\
+        definition(1, fit.RECORD_MESSAGE, POSITION)
+    for delta in range(1, 5):
+        body += compressed(1, T0 + 10 * delta, 1, 1)
+    chunks = list(fit.iter_chunks(fit_file(body), 100))
+    assert_array_equal(chunks[0][:, 0], fit.FIT_EPOCH + T0 + numpy.arange(5) * 10)
+
+def test_big_endian_definition():
+    body = definition(0, fit.RECORD_MESSAGE, RECORD, big_endian=True) +\
+        record(T0, -2**30, 2**29, 3000, endian=">")
+    records = fit.read_records(fit_file(body))
+    assert records["time"].tolist() == [fit.FIT_EPOCH + T0]
+    assert records["latitude"].tolist() == [-90.0]
+    assert records["longitude"].tolist() == [45.0]
+    assert records["elevation"].tolist() == [100.0]
+
+def test_invalid_values_are_nan():
+    body = definition(0, fit.RECORD_MESSAGE, RECORD) +\
+        record(T0, 0x7FFFFFFF, 0x7FFFFFFF, 3000) + record(T0 + 1, 1, 1, 0xFFFF)
+    records = fit.read_records(fit_file(body))
+    assert numpy.isnan(records["latitude"][0]) and numpy.isnan(records["longitude"][0])
+    assert not numpy.isnan(records["latitude"][1])
+    assert records["elevation"][0] == 100.0 and numpy.isnan(records["elevation"][1])
+    # points without a position are left out
+    chunks = list(fit.iter_chunks(fit_file(body), 100))
+    assert len(chunks) == 1 and chunks[0][:, 0].tolist() == [fit.FIT_EPOCH + T0 + 1]
+
+@pytest.mark.parametrize("body, data_size", [
+    # data size beyond the end of the file
+    (definition(0, fit.RECORD_MESSAGE, RECORD) + record(T0, 1, 1, 1), 200),
+    # last message running past the declared data size
+    (definition(0, fit.RECORD_MESSAGE, RECORD) + record(T0, 1, 1, 1) * 4, 18 + 4 * 15 - 5),
+    # compressed message running past it
+    (definition(1, fit.RECORD_MESSAGE, POSITION) + compressed(1, 3, 1, 1), 6 + 6 + 9 - 3),
+    # definition fields running past it
+    (definition(0, fit.RECORD_MESSAGE, RECORD) + record(T0, 1, 1, 1), 10),
+    # data message without definition
+    (record(T0, 1, 1, 1), None),
+], ids=["file", "message", "compressed", "definition", "undefined"])
+def test_truncated_files_raise_fit_error(body, data_size):
+    with pytest.raises(fit.FitError):
+        fit.read_records(fit_file(body, data_size))
+
+def test_not_a_fit_file():
+    with pytest.raises(fit.FitError):
+        fit.read_records(io.BytesIO(b"<?xml version='1.0'?><gpx></gpx>"))
@@ -0,0 +1,53 @@
+"""
+Deviation bound of the levels of `simplify`
+"""
+import numpy
+import pytest
+import simplify, synthetic, track
+
+def arrays_of(points):
+    builder = track.TrackBuilder()
+    return builder, builder.add_points(points)
+
+def noisy_ride(count, seed):
+    """
+    Synthetic ride with GPS jitter, so that most points matter at high zooms
+    """
+    points = synthetic.random_ride(count, seed)
+    points[:, 1:3] += numpy.random.default_rng(seed).normal(0, 2e-5, (count, 2))
+    return points
+
+@pytest.mark.parametrize("points", [
+    synthetic.random_ride(3000, 1),
+    noisy_ride(3000, 2),
+    noisy_ride(3 * track.CHUNK_SIZE + 100, 3),
+], ids=["smooth", "noisy", "noisy-chunks"])
+@pytest.mark.parametrize("chunk_size", [track.CHUNK_SIZE, 500, 37])
+def test_levels_stay_within_tolerance(points, chunk_size):
+    builder, arrays = arrays_of(points)
+    x, y = simplify.mercator(arrays.latitude, arrays.longitude)
+    levels = simplify.build_levels(arrays, chunk_size)
+    for zoom in simplify.LEVEL_ZOOMS:
+        indices = levels.for_zoom(zoom)
+        assert indices[0] == 0 and indices[-1] == len(arrays) - 1
+        assert numpy.all(numpy.diff(indices) > 0)
+        assert simplify.max_deviation(x, y, indices) <= simplify.tolerance(zoom)
+
+def test_levels_built_on_import_match_build_levels():
+    points = noisy_ride(2 * track.CHUNK_SIZE + 1, 4)
+    builder, arrays = arrays_of(points)
+    chunked = track.TrackBuilder()
+    for start in range(0, len(points), track.CHUNK_SIZE):
+        chunked.add_points(points[start:start + track.CHUNK_SIZE])
+    expected = simplify.build_levels(arrays, track.CHUNK_SIZE)
+    levels = chunked.levels()
+    for zoom in simplify.LEVEL_ZOOMS:
+        numpy.testing.assert_array_equal(levels.indices[zoom], expected.indices[zoom])
+
+def test_levels_get_coarser_with_lower_zooms():
+    builder, arrays = arrays_of(noisy_ride(5000, 5))
+    levels = simplify.build_levels(arrays, track.CHUNK_SIZE)
+    sizes = [len(levels.indices[zoom]) for zoom in simplify.LEVEL_ZOOMS]
+    assert sizes == sorted(sizes)
+    assert sizes[0] < len(arrays) / 10
+    assert levels.for_zoom(simplify.LEVEL_ZOOMS[-1] + 1) is None
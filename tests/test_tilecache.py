@@ -0,0 +1,99 @@
+"""
+`tilecache` against a local stand-in tile server, given through
+`CYCLINGTRACKER_TILE_URL`
+"""
+import http.server, importlib, os, threading, time
+import pytest
+import tilecache
+from track import BoundingBox
+
+BOUNDS = BoundingBox(45.0, 45.1, 6.0, 6.1)
+
+class TileServer(http.server.ThreadingHTTPServer):
+    """
+    Serves `/<z>/<x>/<y>.png` as a few bytes naming the tile, or 404 for
+    the tiles of `missing`
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), TileRequestHandler)
+        self.requests = []
+        self.missing = set()
+
+class TileRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in self.server.missing:
+            self.send_error(404)
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = TileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def cache(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("CYCLINGTRACKER_TILE_URL", "http://127.0.0.1:{}/#Z#/#X#/#Y#.png".format(server.server_port))
+    importlib.reload(tilecache)
+    yield tilecache.TileCache(directory=str(tmp_path), prefetch_rate=1000)
+    monkeypatch.delenv("CYCLINGTRACKER_TILE_URL")
+    importlib.reload(tilecache)
+
+def test_prefetch_stores_tiles_where_the_map_reads_them(server, cache, tmp_path):
+    tiles = list(tilecache.tiles_in_bounds(BOUNDS, range(8, 11)))
+    assert cache.prefetch(BOUNDS, range(8, 11)) == (len(tiles), 0)
+    assert sorted(server.requests) == sorted("/{}/{}/{}.png".format(*tile) for tile in tiles)
+    for zoom, x, y in tiles:
+        path = os.path.join(str(tmp_path), tilecache.SOURCE_ID, str(zoom), str(x), str(y) + ".png")
+        with open(path, "rb") as tile_file:
+            assert tile_file.read() == "/{}/{}/{}.png".format(zoom, x, y).encode()
+
+def test_cached_tiles_need_no_network(server, cache):
+    cache.prefetch(BOUNDS, range(8, 11))
+    requests = len(server.requests)
+    assert cache.prefetch(BOUNDS, range(8, 11)) == (0, 0)
+    zoom, x, y = next(tilecache.tiles_in_bounds(BOUNDS, [10]))
+    assert cache.get(zoom, x, y) == "/{}/{}/{}.png".format(zoom, x, y).encode()
+    assert len(server.requests) == requests
+
+def test_prefetch_is_capped_and_counts_failures(server, cache):
+    tiles = list(tilecache.tiles_in_bounds(BOUNDS, range(8, 14)))
+    server.missing.add("/{}/{}/{}.png".format(*tiles[0]))
+    assert cache.prefetch(BOUNDS, range(8, 14), max_tiles=10) == (9, 1)
+    assert len(server.requests) == 10
+    assert cache.get(*tiles[0]) is None
+
+def test_prefetch_is_rate_limited(server, cache):
+    cache.prefetch_rate = 20
+    start = time.monotonic()
+    downloaded, failures = cache.prefetch(BOUNDS, range(8, 14), max_tiles=11)
+    assert downloaded == 11
+    assert time.monotonic() - start >= 10 / 20
+
+def test_least_recently_used_tiles_are_evicted(cache):
+    cache.max_size = 1000
+    for index in range(10):
+        cache.put(12, index, 0, bytes(100))
+        # access times are compared, with the resolution of the file system
+        os.utime(cache.path(12, index, 0), (1000 + index, 1000 + index))
+    cache._touch(cache.path(12, 0, 0))
+    cache.put(12, 10, 0, bytes(100))
+    assert cache.size <= cache.max_size * tilecache.EVICTION_RATIO
+    assert cache.get(12, 0, 0) is not None
+    assert cache.get(12, 10, 0) is not None
+    assert cache.get(12, 1, 0) is None and cache.get(12, 2, 0) is None
@@ -0,0 +1,132 @@
+"""
+`track.TrackBuilder` against per-point computations: gpxpy's distances,
+which the vectorised lengths replaced, and loops over the points for the
+bounds and metrics
+"""
+import math
+import numpy
+import pytest
+from numpy.testing import assert_allclose
+import metrics, synthetic, track
+
+# gpxpy approximates short segments as flat rather than with haversine: the
+# cumulative lengths may drift by this much relative to the distance ridden
+# (measured: under 3e-7)
+GPXPY_RELATIVE_TOLERANCE = 1e-6
+
+def reference_lengths(points):
+    """
+    Cumulative 3D lengths as computed before `track.segment_lengths()`,
+    one `gpxpy.geo.Location.distance_3d()` per pair of points (2D where an
+    elevation is missing)
+    """
+    import gpxpy.geo as geo
+    lengths = [0.0]
+    last_location = None
+    for time, latitude, longitude, elevation in points:
+        location = geo.Location(latitude, longitude, None if math.isnan(elevation) else elevation)
+        if last_location:
+            lengths.append(lengths[-1] + last_location.distance_3d(location))
+        last_location = location
+    return lengths
+
+def reference_ascent(elevations):
+    """
+    Zig-zag filter of `metrics.MetricsBuilder`, walking every point
+    """
+    ascent, state, low, high = 0.0, 0, None, None
+    for value in elevations:
+        if math.isnan(value):
+            continue
+        if low is None:
+            low = high = value
+        elif state == 1:
+            if value > high:
+                high = value
+            elif value < high - metrics.ASCENT_HYSTERESIS:
+                ascent += high - low
+                state, low = -1, value
+        elif state == -1:
+            if value < low:
+                low = value
+            elif value > low + metrics.ASCENT_HYSTERESIS:
+                state, high = 1, value
+        elif value > low + metrics.ASCENT_HYSTERESIS:
+            state, high = 1, value
+        elif value < high - metrics.ASCENT_HYSTERESIS:
+            state, low = -1, value
+        else:
+            low, high = min(low, value), max(high, value)
+    return ascent + (high - low if state == 1 else 0.0)
+
+def reference_moving_time(points, lengths):
+    moving_time = 0.0
+    for index in range(1, len(points)):
+        duration = points[index][0] - points[index - 1][0]
+        if duration > 0 and lengths[index] - lengths[index - 1] >= metrics.MIN_MOVING_SPEED * duration:
+            moving_time += duration
+    return moving_time
+
+def ride(count, seed):
+    points = synthetic.random_ride(count, seed)
+    random = numpy.random.default_rng(seed)
+    # stops, and points without elevation
+    points[random.integers(1, count, count // 50), 0] -= 0.9
+    points[random.integers(0, count, count // 100), 3] = numpy.nan
+    points[:, 0] = numpy.maximum.accumulate(points[:, 0])
+    return points
+
+def build(points, chunk_sizes):
+    """
+    Feeds `points` to a `TrackBuilder` in chunks of `chunk_sizes` (cycled)
+    """
+    builder = track.TrackBuilder()
+    parts = []
+    start = 0
+    while start < len(points):
+        for size in chunk_sizes:
+            parts.append(builder.add_points(points[start:start + size].tolist()))
+            start += size
+    return builder, track.TrackArrays.concatenate(parts)
+
+TRACKS = pytest.mark.parametrize("count, seed", [(2, 1), (1000, 2), (3 * track.CHUNK_SIZE + 17, 3)])
+CHUNK_SIZES = pytest.mark.parametrize("chunk_sizes", [(track.CHUNK_SIZE,), (1, 999, 4096), (333,)])
+
+@TRACKS
+@CHUNK_SIZES
+def test_lengths_match_gpxpy(count, seed, chunk_sizes):
+    pytest.importorskip("gpxpy")
+    points = ride(count, seed)
+    builder, arrays = build(points, chunk_sizes)
+    lengths = reference_lengths(points.tolist())
+    assert_allclose(arrays.cumulative_length, lengths, rtol=0,
+        atol=GPXPY_RELATIVE_TOLERANCE * lengths[-1] + 1e-9)
+    assert_allclose(builder.length, arrays.cumulative_length[-1])
+
+@TRACKS
+@CHUNK_SIZES
+def test_builder_matches_per_point_loop(count, seed, chunk_sizes):
+    points = ride(count, seed)
+    builder, arrays = build(points, chunk_sizes)
+    rows = points.tolist()
+
+    assert builder.point_count == len(points) == len(arrays)
+    assert builder.start_time == rows[0][0]
+    assert builder.duration == rows[-1][0] - rows[0][0]
+    known = [row[3] for row in rows if not math.isnan(row[3])]
+    assert (builder.latitude_min, builder.latitude_max) == (min(row[1] for row in rows), max(row[1] for row in rows))
+    assert (builder.longitude_min, builder.longitude_max) == (min(row[2] for row in rows), max(row[2] for row in rows))
+    assert (builder.elevation_min, builder.elevation_max) == (min(known), max(known))
+
+    values = builder.metrics()
+    moving_time = reference_moving_time(rows, arrays.cumulative_length.tolist())
+    assert_allclose(values["total_ascent"], reference_ascent([row[3] for row in rows]), rtol=1e-9, atol=1e-6)
+    assert_allclose(values["moving_time"], moving_time, rtol=1e-9)
+    assert_allclose(values["average_speed"], builder.length / moving_time if moving_time else 0.0, rtol=1e-9)
+
+def test_chunk_boundaries_do_not_change_results():
+    points = ride(2 * track.CHUNK_SIZE + 5, 4)
+    whole, whole_arrays = build(points, (len(points),))
+    chunked, chunked_arrays = build(points, (7, track.CHUNK_SIZE, 1))
+    assert_allclose(chunked_arrays.cumulative_length, whole_arrays.cumulative_length, rtol=1e-12)
+    assert chunked.metrics() == pytest.approx(whole.metrics())